@@ -0,0 +1,162 @@
+import sys
+import argparse
+from os.path import dirname, abspath
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+sys.path.append(dirname(dirname(abspath(__file__))) + '/regression_modeling')
+import config
+from model_grid import get_model_specs
+from instrumentation import instrument_stage
+
+race_categories    = ['White', 'Black or African American', 'Asian', 'No matching concept']
+race_probabilities = [.7, .15, .05, .1]
+
+def generate_synthetic_cohort(num_patients,
+                              num_providers          = None,
+                              provider_effect_sd     = .8,
+                              num_outlying_providers = 2,
+                              outlying_effect        = 3.,
+                              seed                   = 0):
+    '''
+    Generate a cohort with the columns of t2dm_cohort_data.csv
+    Metformin is drawn from a logistic model that decreases with eGFR below 45, age, and heart failure,
+    plus a normal random intercept per provider. Outlying providers get an extra intercept of +/- outlying_effect.
+    Patients per provider follow a lognormal distribution so some providers fall below min_patients_per_provider.
+    @param num_patients: int, number of rows
+    @param num_providers: int, number of providers, defaults to 1 per 40 patients
+    @param provider_effect_sd: float, standard deviation of provider random intercepts
+    @param num_outlying_providers: int, number of providers with injected outlying effects,
+                                   chosen among providers with at least min_patients_per_provider patients
+    @param outlying_effect: float, magnitude of the injected outlying effects
+    @param seed: int, seed for random number generator
+    @return: 1. pandas DataFrame, cohort
+             2. pandas DataFrame, npi, true provider effect, and whether provider is outlying, for each provider
+             3. numpy array, true logit of each patient without provider effects
+    '''
+    if num_providers is None:
+        num_providers = max(num_patients // 40, 1)
+    rng = np.random.default_rng(seed)
+
+    provider_weights = rng.lognormal(mean = 0, sigma = 1, size = num_providers)
+    # NPIs are 10 digits
+    npis             = 1000000000 + np.sort(rng.choice(1000000000, size = num_providers, replace = False))
+    provider_idxs    = rng.choice(num_providers, size = num_patients, p = provider_weights/provider_weights.sum())
+
+    provider_effects = rng.normal(0, provider_effect_sd, size = num_providers)
+    provider_counts  = np.bincount(provider_idxs, minlength = num_providers)
+    eligible_idxs    = np.flatnonzero(provider_counts >= config.min_patients_per_provider)
+    outlying_idxs    = rng.choice(eligible_idxs, size = min(num_outlying_providers, len(eligible_idxs)), replace = False)
+    provider_effects[outlying_idxs] += outlying_effect * np.where(np.arange(len(outlying_idxs)) % 2 == 0, -1, 1)
+
+    first_treatment_dates = np.datetime64('2010-01-01') + rng.integers(0, 4383, size = num_patients).astype('timedelta64[D]')
+    measurement_dates     = first_treatment_dates - rng.integers(0, 183, size = num_patients).astype('timedelta64[D]')
+    egfrs         = np.clip(np.round(rng.normal(75, 22, size = num_patients)), 5, 150)
+    ages          = np.clip(np.round(rng.normal(60, 12, size = num_patients)), 18, 90)
+    heart_failure = (rng.random(num_patients) < .08).astype(np.uint8)
+    male          = (rng.random(num_patients) < .5).astype(np.uint8)
+
+    fixed_logits  = 1. - .12 * np.maximum(45 - egfrs, 0) - .01 * (ages - 60) - .5 * heart_failure
+    logits        = fixed_logits + provider_effects[provider_idxs]
+    metformin     = (rng.random(num_patients) < 1./(1. + np.exp(-logits))).astype(np.uint8)
+
+    cohort_df = pd.DataFrame(data    = {'person_id'           : np.arange(1, num_patients + 1),
+                                        'first_treatment_date': first_treatment_dates,
+                                        'metformin'           : metformin,
+                                        'npi'                 : npis[provider_idxs],
+                                        'egfr'                : egfrs,
+                                        'egfr_lab_measured'   : np.ones(num_patients, dtype = np.uint8),
+                                        'measurement_date'    : measurement_dates,
+                                        'heart_failure'       : heart_failure,
+                                        'age'                 : ages,
+                                        'male'                : male,
+                                        'race'                : rng.choice(race_categories, size = num_patients,
+                                                                           p = race_probabilities)},
+                             columns = ['person_id', 'first_treatment_date', 'metformin', 'npi', 'egfr',
+                                        'egfr_lab_measured', 'measurement_date', 'heart_failure', 'age', 'male', 'race'])
+    provider_df = pd.DataFrame(data    = {'npi'            : npis,
+                                          'provider_effect': provider_effects,
+                                          'outlying'       : np.isin(np.arange(num_providers), outlying_idxs).astype(int)},
+                               columns = ['npi', 'provider_effect', 'outlying'])
+    return cohort_df, provider_df, fixed_logits
+
+def generate_synthetic_model_outputs(filtered_cohort_df,
+                                     provider_df,
+                                     fixed_logits,
+                                     max_num_knots = 3,
+                                     noise_sd      = .3,
+                                     seed          = 0):
+    '''
+    Generate logits for the model grid in place of fitting models
+    Models without random effects see the true fixed logits, models with random effects also see the provider effects,
+    and each model adds its own noise
+    @param filtered_cohort_df: pandas DataFrame, cohort after filter_frequent_providers
+    @param provider_df: pandas DataFrame, output from generate_synthetic_cohort
+    @param fixed_logits: numpy array, true logits without provider effects for the filtered rows
+    @param max_num_knots: int, passed to get_model_specs to choose the models
+    @param noise_sd: float, standard deviation of the noise added to each model's logits
+    @param seed: int, seed for random number generator
+    @return: 1. pandas DataFrame, logits in the format of model_predictions.csv
+             2. pandas DataFrame, model_name and num_params columns in the format of glm_num_params.csv
+    '''
+    rng             = np.random.default_rng(seed)
+    npi_effects     = pd.Series(provider_df['provider_effect'].values,
+                                index = provider_df['npi'].values)
+    provider_logits = npi_effects.loc[filtered_cohort_df['npi'].values].values
+    model_specs     = get_model_specs(max_num_knots)
+    prediction_data = dict()
+    for model_spec in model_specs:
+        model_logits = fixed_logits + rng.normal(0, noise_sd, size = len(fixed_logits))
+        if model_spec['family'] != 'without_random_effects':
+            model_logits += provider_logits
+        prediction_data[model_spec['model_name']] = model_logits
+    prediction_df = pd.DataFrame(data    = prediction_data,
+                                 columns = [model_spec['model_name'] for model_spec in model_specs])
+    num_params_df = pd.DataFrame(data    = {'model_name': [model_spec['model_name'] for model_spec in model_specs],
+                                            'num_params': [model_spec['num_params'] for model_spec in model_specs]},
+                                 columns = ['model_name', 'num_params'])
+    return prediction_df, num_params_df
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Write synthetic cohort to t2dm_cohort_data.csv in data_dir.')
+    parser.add_argument('--num_patients',
+                        action  = 'store',
+                        type    = int,
+                        default = 10000,
+                        help    = 'Specify number of patients.')
+    parser.add_argument('--num_providers',
+                        action  = 'store',
+                        type    = int,
+                        default = None,
+                        help    = 'Specify number of providers. Defaults to 1 per 40 patients.')
+    parser.add_argument('--provider_effect_sd',
+                        action  = 'store',
+                        type    = float,
+                        default = .8,
+                        help    = 'Specify standard deviation of provider random intercepts.')
+    parser.add_argument('--num_outlying_providers',
+                        action  = 'store',
+                        type    = int,
+                        default = 2,
+                        help    = 'Specify number of providers with injected outlying effects.')
+    parser.add_argument('--seed',
+                        action  = 'store',
+                        type    = int,
+                        default = 0,
+                        help    = 'Specify seed for random number generator.')
+    args = parser.parse_args()
+
+    with instrument_stage('generate_synthetic_cohort.py'):
+        cohort_df, provider_df, _ = generate_synthetic_cohort(args.num_patients,
+                                                              args.num_providers,
+                                                              args.provider_effect_sd,
+                                                              args.num_outlying_providers,
+                                                              seed = args.seed)
+        cohort_df.to_csv(config.data_dir + 't2dm_cohort_data.csv',
+                         index = False)
+        provider_df.to_csv(config.data_dir + 'synthetic_provider_effects.csv',
+                           index = False)
+        print('Outlying providers: ' + ', '.join(map(str, provider_df.loc[provider_df['outlying'] == 1]['npi'].values)))
@@ -0,0 +1,211 @@
+import io
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from datetime import datetime
+from contextlib import redirect_stdout
+from os.path import dirname, abspath
+
+import numpy as np
+import pandas as pd
+
+repo_dir = dirname(dirname(abspath(__file__)))
+sys.path.append(repo_dir)
+for sub_dir in ['data_extraction', 'regression_modeling', 'variation_tests', 'figure_creation']:
+    sys.path.append(repo_dir + '/' + sub_dir)
+import config
+from cohort_data import load_cohort_data
+from generate_synthetic_cohort import generate_synthetic_cohort, generate_synthetic_model_outputs
+from filter_data_with_frequent_providers import filter_frequent_providers
+from run_test_for_egfr_variation import run_egfr_variation_tests
+from select_best_models import identify_best_models
+from run_tests_for_provider_variation import perform_glrts
+from examine_outlying_providers import examine_outlying_providers
+from write_sample_input_csvs_for_plotting_predictions import write_sample_csvs
+from instrumentation import instrument_stage
+
+# stages of the pipeline after data extraction, in the order they run
+benchmark_stages = [('filter_frequent_providers' , filter_frequent_providers),
+                    ('run_egfr_variation_tests'  , run_egfr_variation_tests),
+                    ('identify_best_models'      , identify_best_models),
+                    ('perform_glrts'             , perform_glrts),
+                    ('examine_outlying_providers', examine_outlying_providers),
+                    ('write_sample_csvs'         , write_sample_csvs)]
+
+def write_synthetic_data(size_dir,
+                         num_patients,
+                         max_num_knots,
+                         seed):
+    '''
+    Write synthetic cohort, filtered cohort, and model outputs to size_dir
+    and point config at them so the pipeline stages read and write there
+    @param size_dir: str, directory ending in /
+    @param num_patients: int, number of rows in the cohort
+    @param max_num_knots: int, passed to get_model_specs to choose the models whose predictions are generated
+    @param seed: int, seed for random number generator
+    @return: None
+    '''
+    os.makedirs(size_dir, exist_ok = True)
+    config.data_dir   = size_dir
+    config.output_dir = size_dir
+
+    cohort_df, provider_df, fixed_logits = generate_synthetic_cohort(num_patients,
+                                                                     seed = seed)
+    cohort_df.to_csv(size_dir + 't2dm_cohort_data.csv',
+                     index = False)
+    provider_df.to_csv(size_dir + 'synthetic_provider_effects.csv',
+                       index = False)
+    # filter_frequent_providers keeps the row order, so the same mask lines up the true logits with the filtered cohort
+    prv_counts    = cohort_df['npi'].value_counts()
+    frequent_mask = (cohort_df['npi'].map(prv_counts) >= config.min_patients_per_provider).values
+    filtered_df   = cohort_df.loc[frequent_mask, ['npi']]
+    del cohort_df
+
+    filter_frequent_providers()
+    prediction_df, num_params_df = generate_synthetic_model_outputs(filtered_df,
+                                                                    provider_df,
+                                                                    fixed_logits[frequent_mask],
+                                                                    max_num_knots,
+                                                                    seed = seed)
+    prediction_df.to_csv(size_dir + 'model_predictions.csv',
+                         index = False)
+    num_params_df.to_csv(size_dir + 'glm_num_params.csv',
+                         index = False)
+
+    setting = 'e' + str(max_num_knots) + '_a' + str(max_num_knots) + '_t' + str(max_num_knots)
+    config.best_model_without_random_effects = 'glm_without_random_effects_' + setting
+    config.best_model_with_random_effects    = 'glm_with_random_intercepts_' + setting
+    config.outlying_npis = provider_df.loc[provider_df['outlying'] == 1]['npi'].tolist()
+
+def time_stages(num_repeats):
+    '''
+    Time each pipeline stage on the data config points to, silencing what the stages print
+    @param num_repeats: int, number of times to run each stage
+    @return: dict mapping stage name to list of wall-clock seconds for each repeat
+    '''
+    stage_times = dict()
+    for stage_name, stage_function in benchmark_stages:
+        stage_times[stage_name] = []
+        for _ in range(num_repeats):
+            start_time = time.perf_counter()
+            with redirect_stdout(io.StringIO()):
+                stage_function()
+            stage_times[stage_name].append(time.perf_counter() - start_time)
+    return stage_times
+
+def get_version_info():
+    '''
+    Get git commit and package versions so results can be compared across versions
+    @return: dict
+    '''
+    try:
+        git_commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                    cwd            = repo_dir,
+                                    capture_output = True,
+                                    text           = True,
+                                    check          = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        git_commit = None
+    return {'git_commit': git_commit,
+            'python'    : platform.python_version(),
+            'numpy'     : np.__version__,
+            'pandas'    : pd.__version__,
+            'machine'   : platform.machine(),
+            'cpu_count' : os.cpu_count()}
+
+def run_benchmarks(sizes,
+                   bench_dir,
+                   num_repeats   = 3,
+                   max_num_knots = 0,
+                   seed          = 0):
+    '''
+    Generate synthetic data of each size and time the pipeline stages on it
+    Results are written to benchmark_{timestamp}.json in bench_dir
+    @param sizes: list of int, number of patients in each synthetic cohort
+    @param bench_dir: str, directory for synthetic data and results, ending in /
+    @param num_repeats: int, number of times to run each stage
+    @param max_num_knots: int, models with at most this many knots per spline have generated predictions
+    @param seed: int, seed for random number generator
+    @return: dict, benchmark results
+    '''
+    results = {'timestamp'    : datetime.now().isoformat(timespec = 'seconds'),
+               'versions'     : get_version_info(),
+               'num_repeats'  : num_repeats,
+               'max_num_knots': max_num_knots,
+               'seed'         : seed,
+               'sizes'        : []}
+    for num_patients in sizes:
+        size_dir   = bench_dir + str(num_patients) + '/'
+        start_time = time.perf_counter()
+        write_synthetic_data(size_dir,
+                             num_patients,
+                             max_num_knots,
+                             seed)
+        generate_time = time.perf_counter() - start_time
+        # build the parquet cache outside the timed stages so every stage reads the cohort the same way
+        num_filtered_rows = len(load_cohort_data(columns = ['person_id']))
+        stage_times       = time_stages(num_repeats)
+        results['sizes'].append({'num_patients'     : num_patients,
+                                 'num_filtered_rows': num_filtered_rows,
+                                 'generate_seconds' : generate_time,
+                                 'stages'           : {stage_name: {'seconds'       : times,
+                                                                    'min_seconds'   : min(times),
+                                                                    'median_seconds': float(np.median(times))}
+                                                       for stage_name, times in stage_times.items()}})
+        print(str(num_patients) + ' patients: '
+              + ', '.join([stage_name + ' ' + '{0:.3f}'.format(min(times)) + ' s'
+                           for stage_name, times in stage_times.items()]))
+
+    results_file = bench_dir + 'benchmark_' + results['timestamp'].replace(':', '') + '.json'
+    with open(results_file, 'w') as f:
+        json.dump(results, f, indent = 2)
+    print('Wrote ' + results_file)
+    return results
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Time pipeline stages on synthetic cohorts.')
+    parser.add_argument('--sizes',
+                        action  = 'store',
+                        type    = str,
+                        default = '10000,1000000,10000000',
+                        help    = 'Specify comma-separated numbers of patients.')
+    parser.add_argument('--bench_dir',
+                        action  = 'store',
+                        type    = str,
+                        default = None,
+                        help    = 'Specify directory for synthetic data and results. Defaults to benchmarks/ in output_dir.')
+    parser.add_argument('--num_repeats',
+                        action  = 'store',
+                        type    = int,
+                        default = 3,
+                        help    = 'Specify number of times to run each stage.')
+    parser.add_argument('--max_num_knots',
+                        action  = 'store',
+                        type    = int,
+                        default = 0,
+                        help    = 'Specify maximum number of knots of models with generated predictions. '
+                                  + '(0 gives 3 models, 3 gives 24.)')
+    parser.add_argument('--seed',
+                        action  = 'store',
+                        type    = int,
+                        default = 0,
+                        help    = 'Specify seed for random number generator.')
+    args = parser.parse_args()
+
+    with instrument_stage('run_benchmarks.py'):
+        bench_dir = args.bench_dir
+        if bench_dir is None:
+            bench_dir = config.output_dir + 'benchmarks/'
+        if not bench_dir.endswith('/'):
+            bench_dir += '/'
+
+        run_benchmarks([int(size) for size in args.sizes.split(',')],
+                       bench_dir,
+                       args.num_repeats,
+                       args.max_num_knots,
+                       args.seed)
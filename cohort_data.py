@@ -0,0 +1,168 @@
+import os
+import json
+import hashlib
+
+import pandas as pd
+
+import config
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# types for columns in t2dm_cohort_data.csv and t2dm_cohort_data_frequent_prv_only.csv, other columns are inferred
+cohort_column_dtypes = {'person_id'        : 'int64',
+                        'npi'              : 'category',
+                        'prv_id'           : 'int32',
+                        'egfr'             : 'float64',
+                        'age'              : 'float64',
+                        'metformin'        : 'uint8',
+                        'heart_failure'    : 'uint8',
+                        'male'             : 'uint8',
+                        'egfr_lab_measured': 'uint8',
+                        'drug_class_name'  : 'category',
+                        'race'             : 'category'}
+cohort_date_columns  = ['first_treatment_date', 'measurement_date']
+
+def get_cache_paths(csv_path):
+    '''
+    Get paths of the columnar cache and its stamp file for a csv
+    @param csv_path: str, path to csv
+    @return: 1. str, path to parquet file
+             2. str, path to json file describing the csv the cache was built from
+    '''
+    cache_path = os.path.splitext(csv_path)[0] + '.parquet'
+    return cache_path, cache_path + '.source.json'
+
+def compute_file_hash(file_path,
+                      block_size = 1 << 24):
+    '''
+    Compute hash of file contents
+    @param file_path: str, path to file
+    @param block_size: int, number of bytes to read at a time
+    @return: str, hex digest
+    '''
+    file_hash = hashlib.blake2b()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def write_cache_stamp(csv_path,
+                      file_hash = None):
+    '''
+    Record the size, modification time, and hash of the csv the cache was built from
+    @param csv_path: str, path to csv
+    @param file_hash: str, hash of csv if already computed
+    @return: None
+    '''
+    _, stamp_path = get_cache_paths(csv_path)
+    csv_stat = os.stat(csv_path)
+    if file_hash is None:
+        file_hash = compute_file_hash(csv_path)
+    # write to a file named by process and replace, so scripts running at the same time never see a partial stamp
+    tmp_stamp_path = stamp_path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_stamp_path, 'w') as f:
+        json.dump({'size'    : csv_stat.st_size,
+                   'mtime_ns': csv_stat.st_mtime_ns,
+                   'hash'    : file_hash}, f)
+    os.replace(tmp_stamp_path, stamp_path)
+
+def is_cache_valid(csv_path):
+    '''
+    Check whether the columnar cache matches the csv
+    The modification time is checked first. If only the modification time changed, the contents are hashed,
+    and the stamp is refreshed when the contents are unchanged.
+    @param csv_path: str, path to csv
+    @return: bool
+    '''
+    cache_path, stamp_path = get_cache_paths(csv_path)
+    if not os.path.exists(cache_path):
+        return False
+    if not os.path.exists(csv_path):
+        # export_cohort.py can write the cache without the csv
+        return True
+    if not os.path.exists(stamp_path):
+        return False
+    with open(stamp_path, 'r') as f:
+        stamp = json.load(f)
+    csv_stat = os.stat(csv_path)
+    if csv_stat.st_size != stamp['size']:
+        return False
+    if csv_stat.st_mtime_ns == stamp['mtime_ns']:
+        return True
+    file_hash = compute_file_hash(csv_path)
+    if file_hash != stamp['hash']:
+        return False
+    write_cache_stamp(csv_path, file_hash)
+    return True
+
+def read_typed_csv(csv_path,
+                   columns = None):
+    '''
+    Read cohort csv with compact types: npi and race as categories, dates as datetimes, flags as uint8
+    @param csv_path: str, path to csv
+    @param columns: list of str, columns to read, None to read all
+    @return: pandas DataFrame
+    '''
+    header = pd.read_csv(csv_path, nrows = 0).columns
+    if columns is not None:
+        header = [col_name for col_name in header if col_name in set(columns)]
+    # read categories with their inferred types first so integer npis do not become string categories
+    df = pd.read_csv(csv_path,
+                     usecols     = columns,
+                     dtype       = {col_name: cohort_column_dtypes[col_name] for col_name in header
+                                    if cohort_column_dtypes.get(col_name, 'category') != 'category'},
+                     parse_dates = [col_name for col_name in cohort_date_columns if col_name in header])
+    for col_name in header:
+        if cohort_column_dtypes.get(col_name) == 'category':
+            df[col_name] = df[col_name].astype('category')
+    return df
+
+def build_cohort_cache(csv_path):
+    '''
+    Convert cohort csv to a typed parquet file next to it
+    @param csv_path: str, path to csv
+    @return: pandas DataFrame, contents of csv
+    '''
+    cache_path, _ = get_cache_paths(csv_path)
+    df = read_typed_csv(csv_path)
+    # scripts running at the same time may build the same cache, each replaces it with a complete file
+    tmp_cache_path = cache_path + '.' + str(os.getpid()) + '.tmp'
+    df.to_parquet(tmp_cache_path,
+                  engine = 'pyarrow',
+                  index  = False)
+    os.replace(tmp_cache_path, cache_path)
+    write_cache_stamp(csv_path)
+    return df
+
+def load_cohort_data(file_name = 't2dm_cohort_data_frequent_prv_only.csv',
+                     columns   = None):
+    '''
+    Load cohort data from the typed columnar cache, building the cache if the csv is new or has changed
+    Falls back to reading the csv with compact types if pyarrow is not installed
+    @param file_name: str, name of csv in data_dir
+    @param columns: list of str, columns to load, None to load all
+    @return: pandas DataFrame
+    '''
+    csv_path = config.data_dir + file_name
+    if pyarrow is None:
+        return read_typed_csv(csv_path, columns)
+    if not is_cache_valid(csv_path):
+        df = build_cohort_cache(csv_path)
+        if columns is not None:
+            df = df[list(columns)]
+        return df
+    cache_path, _ = get_cache_paths(csv_path)
+    df = pd.read_parquet(cache_path,
+                         engine  = 'pyarrow',
+                         columns = columns)
+    # parquet only keeps dictionary encoding for strings, restore integer categories such as npi
+    # export_cohort.py streams npi as a nullable integer, use plain integers as the csv does if none are missing
+    for col_name in df.columns:
+        if cohort_column_dtypes.get(col_name) == 'category' and df[col_name].dtype.name != 'category':
+            if df[col_name].dtype.name == 'Int64' and not df[col_name].hasnans:
+                df[col_name] = df[col_name].astype('int64')
+            df[col_name] = df[col_name].astype('category')
+    return df
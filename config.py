@@ -5,3 +5,7 @@ best_model_without_random_effects = '' # Put name (starting with glm) of model w
 best_model_with_random_effects    = '' # Put name (starting with glm) of model with random effects that has highest log likelihood in step 5 of fitting regression models
 
 outlying_npis = [] # Put NPIs with small p-values here in step 2 under testing for provider variation
+
+min_patients_per_provider = 10 # Providers with fewer patients are removed in filter_data_with_frequent_providers.py
+
+profile_stages = False # Set to True to write cProfile stats for each instrumented stage to profiles/ in output_dir
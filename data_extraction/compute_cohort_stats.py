@@ -1,26 +1,178 @@
 import os
 import sys
+import decimal
+import logging
 from os.path import dirname, abspath
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 import sqlalchemy
+import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 
 sys.path.append(dirname(dirname(abspath(__file__))))
 import config
-from utils import session_scope, create_sql_engine
+from utils import session_scope, create_sql_engine, stream_query
+from instrumentation import instrument_stage, instrumented
 
+def summarize_distribution_in_database(session,
+                                       query,
+                                       is_date  = False,
+                                       num_bins = 50):
+    '''
+    Compute summary statistics and a binned histogram of the stat column of a query inside postgres
+    so only the summaries are transferred instead of every row
+    @param session: sqlalchemy session
+    @param query: str, query with a stat column, without trailing semicolon
+    @param is_date: bool, whether stat is a date, bins are then computed on days since 1970-01-01
+    @param num_bins: int, number of equal-width histogram bins between the min and max
+    @return: 1. dict mapping min, percentile_25, median, mean, percentile_75, std, and max to values,
+                values are None if stat has no non-null rows
+             2. numpy array of bin edges, length num_bins + 1, empty if stat has no non-null rows
+             3. numpy array of counts per bin, length num_bins, empty if stat has no non-null rows
+    '''
+    if is_date:
+        value_expression = "(stat - DATE '1970-01-01')"
+    else:
+        value_expression = 'stat'
+    with open('sql/summarize_distribution.sql', 'r') as f:
+        summary_sql = f.read().format(query            = query,
+                                      value_expression = value_expression)
+    summary = dict(session.execute(sqlalchemy.text(summary_sql)).fetchone())
+    for stat_name in summary:
+        # numeric columns are returned as decimals, pd.read_sql would have converted them to floats
+        if isinstance(summary[stat_name], decimal.Decimal):
+            summary[stat_name] = float(summary[stat_name])
+    
+    min_value = summary.pop('min_value')
+    max_value = summary.pop('max_value')
+    if min_value is None:
+        return summary, np.zeros(0), np.zeros(0, dtype = np.int64)
+    min_value = float(min_value)
+    max_value = float(max_value)
+    with open('sql/bin_distribution.sql', 'r') as f:
+        bin_sql = f.read().format(query            = query,
+                                  value_expression = value_expression,
+                                  min_value        = repr(min_value),
+                                  max_value        = repr(max_value),
+                                  num_bins         = int(num_bins))
+    bin_counts = np.zeros(num_bins, dtype = np.int64)
+    for bin_idx, count in session.execute(sqlalchemy.text(bin_sql)).fetchall():
+        bin_counts[bin_idx - 1] = count
+    if max_value == min_value:
+        bin_edges = np.linspace(min_value - .5, max_value + .5, num_bins + 1)
+    else:
+        bin_edges = np.linspace(min_value, max_value, num_bins + 1)
+    return summary, bin_edges, bin_counts
+
+def run_stats_query(engine,
+                    query_description,
+                    query,
+                    aggregate_in_database = False,
+                    num_bins              = 50):
+    '''
+    Run one statistics query in its own session
+    Plotting is left to the caller since pyplot is not thread-safe
+    @param engine: sqlalchemy engine
+    @param query_description: str, description from comment above query
+    @param query: str, query ending in a semicolon
+    @param aggregate_in_database: bool, whether to compute summaries and histogram counts in postgres
+    @param num_bins: int, number of histogram bins when aggregating in database
+    @return: 1. str, lines to write to cohort_stats.txt
+             2. None for counts, pandas DataFrame with stat column for distributions,
+                or tuple of numpy arrays with bin edges and counts when aggregating in database
+    '''
+    is_date = query_description.startswith('first treatment date')
+    with session_scope(engine) as session:
+        if query_description.startswith('number of ') \
+            and not query_description.startswith('number of patients per provider'):
+            result = session.execute(sqlalchemy.text(query)).fetchone()
+            return query_description + ': ' + str(result['stat']) + '\n', None
+        if aggregate_in_database:
+            summary, bin_edges, bin_counts = summarize_distribution_in_database(session,
+                                                                                query[:-1],
+                                                                                is_date,
+                                                                                num_bins)
+            if is_date:
+                bin_edges = pd.to_datetime(bin_edges, unit = 'D')
+            plot_data = (bin_edges, bin_counts)
+        else:
+            df = pd.concat(stream_query(engine, query[:-1]),
+                           ignore_index = True)
+            summary = {'min': df['stat'].min(),
+                       'max': df['stat'].max()}
+            if not is_date:
+                summary['percentile_25'] = df['stat'].quantile(q = .25)
+                summary['median']        = df['stat'].quantile(q = .5)
+                summary['mean']          = df['stat'].mean()
+                summary['percentile_75'] = df['stat'].quantile(q = .75)
+                summary['std']           = df['stat'].std()
+            plot_data = df
+    
+    # compute summary stats
+    output  = query_description + ':\n'
+    output += 'min: ' + str(summary['min']) + '\n'
+    if not is_date:
+        output += '25th percentile: ' + str(summary['percentile_25']) + '\n'
+        output += 'median: ' + str(summary['median']) + '\n'
+        output += 'mean: ' + str(summary['mean']) + '\n'
+        output += '75th percentile: ' + str(summary['percentile_75']) + '\n'
+        output += 'std: ' + str(summary['std']) + '\n'
+    output += 'max: ' + str(summary['max']) + '\n'
+    return output, plot_data
+
+def plot_stats_histogram(query_description,
+                         plot_data,
+                         output_dir):
+    '''
+    Plot histogram of a distribution returned by run_stats_query
+    @param query_description: str, description from comment above query, used for x-axis label and file name
+    @param plot_data: pandas DataFrame with stat column or tuple of numpy arrays with bin edges and counts
+    @param output_dir: str, directory to save plot in
+    @return: None
+    '''
+    plt.clf()
+    if isinstance(plot_data, pd.DataFrame):
+        df = plot_data.rename(columns = {'stat': query_description})
+        sns.histplot(data = df,
+                     x    = query_description)
+    else:
+        # plot histogram from pre-binned counts
+        bin_edges, bin_counts = plot_data
+        if len(bin_counts) > 0:
+            plt.hist(bin_edges[:-1],
+                     bins    = bin_edges,
+                     weights = bin_counts)
+        plt.ylabel('Count')
+        plt.xlabel(query_description)
+    plt.savefig(output_dir + query_description.replace(' ', '_') + '_hist.pdf')
+
+@instrumented
 def compute_cohort_stats(database_name,
-                         schema_name):
+                         schema_name,
+                         aggregate_in_database = False,
+                         num_bins              = 50,
+                         num_workers           = 1,
+                         statement_timeout     = None,
+                         backend               = 'postgres'):
     '''
     Compute statistics about T2DM cohort that was created in database schema
     @param database_name: str, name of database
     @param schema_name: str, schema tables were created in
+    @param aggregate_in_database: bool, whether to compute percentiles, standard deviations, and histogram counts
+                                  in postgres instead of reading every value into pandas
+    @param num_bins: int, number of histogram bins when aggregating in database
+    @param num_workers: int, number of queries to run concurrently, each on its own pooled connection
+    @param statement_timeout: int, seconds after which postgres cancels a query, None for no limit
+    @param backend: str, postgres or duckdb, see utils.sql_backends
     @return: None
     '''
-    engine = create_sql_engine(omop_version)
+    engine = create_sql_engine(database_name,
+                               pool_size         = num_workers,
+                               statement_timeout = statement_timeout,
+                               backend           = backend)
     
     with open('sql/compute_cohort_stats.sql', 'r') as f:
         stats_sql = f.read().format(schema_name = schema_name)
@@ -29,42 +181,29 @@ def compute_cohort_stats(database_name,
     if queries[-1].strip() == '':
         queries.pop()
     assert len(queries) % 2 == 0
+    query_descriptions = [queries[2*query_idx].strip()[3:] for query_idx in range(int(len(queries)/2))]
+    queries            = [queries[2*query_idx+1].strip() + ';' for query_idx in range(int(len(queries)/2))]
     
     output = ''
     output_dir = config.output_dir + 'cohort_stats/'
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     
-    with session_scope(engine) as session:
-        for query_idx in range(int(len(queries)/2)):
-            query_description = queries[2*query_idx].strip()[3:]
-            query = queries[2*query_idx+1].strip() + ';'
-            if query_description.startswith('number of ') \
-                and not query_description.startswith('number of patients per provider'):
-                result = session.execute(sqlalchemy.text(query)).fetchone()
-                output += query_description + ': ' + str(result['stat']) + '\n'
-            else:
-                df = pd.read_sql(query, engine)
-                # compute summary stats
-                output += query_description + ':\n'
-                output += 'min: ' + str(df['stat'].min()) + '\n'
-                if not query_description.startswith('first treatment date'):
-                    output += '25th percentile: ' + str(df['stat'].quantile(q = .25)) + '\n'
-                    output += 'median: ' + str(df['stat'].quantile(q = .5)) + '\n'
-                    output += 'mean: ' + str(df['stat'].mean()) + '\n'
-                    output += '75th percentile: ' + str(df['stat'].quantile(q = .75)) + '\n'
-                    output += 'std: ' + str(df['stat'].std()) + '\n'
-                output += 'max: ' + str(df['stat'].max()) + '\n'
-                
-                # plot histogram
-                df.rename(columns = {'stat': query_description},
-                          inplace = True)
-                plt.clf()
-                sns.histplot(data = df,
-                             x    = query_description)
-                plt.savefig(output_dir + query_description.replace(' ', '_') + '_hist.pdf')
-                
-            session.commit()
+    num_queries = len(queries)
+    with ThreadPoolExecutor(max_workers = num_workers) as executor:
+        # map returns results in query order, so cohort_stats.txt has the same order as the sql file
+        results = executor.map(run_stats_query,
+                               [engine] * num_queries,
+                               query_descriptions,
+                               queries,
+                               [aggregate_in_database] * num_queries,
+                               [num_bins] * num_queries)
+        for query_description, (query_output, plot_data) in zip(query_descriptions, results):
+            output += query_output
+            if plot_data is not None:
+                plot_stats_histogram(query_description,
+                                     plot_data,
+                                     output_dir)
     
     with open(output_dir + 'cohort_stats.txt', 'w') as f:
         f.write(output)
@@ -80,7 +219,39 @@ if __name__ == '__main__':
                         action  = 'store',
                         type    = str,
                         help    = 'Specify schema name to read data from.')
+    parser.add_argument('--aggregate_in_database',
+                        action  = 'store_true',
+                        default = False,
+                        help    = 'Specify to compute summaries and histogram counts in postgres.')
+    parser.add_argument('--num_bins',
+                        action  = 'store',
+                        type    = int,
+                        default = 50,
+                        help    = 'Specify number of histogram bins when aggregating in postgres.')
+    parser.add_argument('--num_workers',
+                        action  = 'store',
+                        type    = int,
+                        default = 1,
+                        help    = 'Specify number of queries to run concurrently.')
+    parser.add_argument('--statement_timeout',
+                        action  = 'store',
+                        type    = int,
+                        default = None,
+                        help    = 'Specify number of seconds after which a query is cancelled.')
+    parser.add_argument('--backend',
+                        action  = 'store',
+                        type    = str,
+                        default = 'postgres',
+                        help    = 'Specify postgres, or duckdb to run on local OMOP extracts. '
+                                  + '(--database_name is then the directory containing the extracts.)')
     args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO)
     
-    compute_cohort_stats(args.database_name,
-                         args.schema_name)
\ No newline at end of file
+    with instrument_stage('compute_cohort_stats.py'):
+        compute_cohort_stats(args.database_name,
+                             args.schema_name,
+                             args.aggregate_in_database,
+                             args.num_bins,
+                             args.num_workers,
+                             args.statement_timeout,
+                             args.backend)
\ No newline at end of file
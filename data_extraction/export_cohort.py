@@ -0,0 +1,200 @@
+import io
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+from os.path import dirname, abspath
+
+import sqlalchemy
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+import config
+from utils import create_sql_engine, session_scope, log_query
+from cohort_data import cohort_column_dtypes, cohort_date_columns, get_cache_paths, write_cache_stamp, build_cohort_cache
+from instrumentation import instrument_stage, instrumented
+
+# category columns are streamed with fixed types, since the first chunk sets the parquet schema for every chunk,
+# and a chunk with a missing npi or only missing races would otherwise be inferred as float
+streamed_category_dtypes = {'npi'            : 'Int64',
+                            'drug_class_name': 'string',
+                            'race'           : 'string'}
+
+class _TeeWriter(object):
+    '''
+    File-like object that writes each block from COPY ... TO STDOUT to several files
+    '''
+    def __init__(self, *files):
+        self.files = files
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+        return len(data)
+
+def _copy_to_files(engine,
+                   copy_sql,
+                   files,
+                   errors):
+    '''
+    Run COPY ... TO STDOUT on a raw connection and write the output to files, closing them when finished
+    @param engine: sqlalchemy engine
+    @param copy_sql: str, COPY statement
+    @param files: list of binary file objects
+    @param errors: list, exceptions are appended here so the calling thread can re-raise them
+    @return: None
+    '''
+    start_time = time.perf_counter()
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.copy_expert(copy_sql, _TeeWriter(*files))
+            log_query(copy_sql, start_time, cursor.rowcount)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        connection.close()
+        for f in files:
+            try:
+                f.close()
+            except BrokenPipeError:
+                # the reader stopped after an error of its own, which is raised instead
+                pass
+
+@instrumented
+def export_cohort(database_name,
+                  schema_name,
+                  min_patients_per_provider = None,
+                  write_csv                 = True,
+                  chunksize                 = 1000000,
+                  backend                   = 'postgres'):
+    '''
+    Stream the cohort table out of postgres with COPY ... TO STDOUT straight into the typed parquet cohort file,
+    replacing the manual \\copy step. The csv that the R scripts read is written from the same stream.
+    @param database_name: str, name of database
+    @param schema_name: str, schema containing t2dm_cohort_covariates
+    @param min_patients_per_provider: int, if specified, filter to frequent providers and number them in SQL
+                                      and write t2dm_cohort_data_frequent_prv_only instead of t2dm_cohort_data
+    @param write_csv: bool, whether to also write the csv
+    @param chunksize: int, number of rows converted to parquet at a time
+    @param backend: str, postgres or duckdb, see utils.sql_backends
+    @return: None
+    '''
+    if min_patients_per_provider is None:
+        with open('sql/export_cohort.sql', 'r') as f:
+            query = f.read().format(schema_name = schema_name)
+        csv_path = config.data_dir + 't2dm_cohort_data.csv'
+    else:
+        with open('sql/export_frequent_provider_cohort.sql', 'r') as f:
+            query = f.read().format(schema_name               = schema_name,
+                                    min_patients_per_provider = int(min_patients_per_provider))
+        csv_path = config.data_dir + 't2dm_cohort_data_frequent_prv_only.csv'
+    cache_path, _ = get_cache_paths(csv_path)
+    tmp_csv_path   = csv_path + '.tmp'
+    tmp_cache_path = cache_path + '.tmp'
+
+    if backend != 'postgres':
+        # embedded databases run in this process, so they write the csv directly and it is converted afterwards
+        with session_scope(create_sql_engine(database_name, backend = backend)) as session:
+            session.execute(sqlalchemy.text("COPY (" + query + ") TO '" + tmp_csv_path + "' (FORMAT CSV, HEADER)"))
+        os.replace(tmp_csv_path, csv_path)
+        build_cohort_cache(csv_path)
+        if not write_csv:
+            os.remove(csv_path)
+        print('Exported cohort to ' + cache_path)
+        return
+
+    copy_sql = 'COPY (' + query + ') TO STDOUT WITH (FORMAT CSV, HEADER)'
+
+    read_fd, write_fd = os.pipe()
+    copy_files = [os.fdopen(write_fd, 'wb')]
+    if write_csv:
+        copy_files.append(open(tmp_csv_path, 'wb'))
+    errors      = []
+    copy_thread = threading.Thread(target = _copy_to_files,
+                                   args   = (create_sql_engine(database_name), copy_sql, copy_files, errors))
+    copy_thread.start()
+
+    num_rows = 0
+    writer   = None
+    try:
+        try:
+            with os.fdopen(read_fd, 'rb') as copy_output:
+                # parse the header line on its own so read_csv does not buffer past it
+                header = pd.read_csv(io.BytesIO(copy_output.readline()), nrows = 0).columns
+                for chunk_df in pd.read_csv(copy_output,
+                                            names       = header,
+                                            header      = None,
+                                            dtype       = {col_name: streamed_category_dtypes.get(col_name,
+                                                                                                  cohort_column_dtypes[col_name])
+                                                           for col_name in header if col_name in cohort_column_dtypes},
+                                            parse_dates = [col_name for col_name in cohort_date_columns if col_name in header],
+                                            chunksize   = chunksize):
+                    if writer is None:
+                        table  = pa.Table.from_pandas(chunk_df, preserve_index = False)
+                        writer = pq.ParquetWriter(tmp_cache_path, table.schema)
+                    else:
+                        table  = pa.Table.from_pandas(chunk_df, schema = writer.schema, preserve_index = False)
+                    writer.write_table(table)
+                    num_rows += len(chunk_df)
+        finally:
+            if writer is not None:
+                writer.close()
+            # closing the pipe ends a copy that is still running with a broken pipe,
+            # and a failed copy leaves nothing to parse, so its database error is raised instead of the parse error
+            copy_thread.join()
+            if len(errors) > 0 and not isinstance(errors[0], BrokenPipeError):
+                raise errors[0]
+
+        if writer is None:
+            pq.write_table(pa.Table.from_pandas(pd.DataFrame(columns = header), preserve_index = False), tmp_cache_path)
+    except BaseException:
+        for tmp_path in [tmp_csv_path, tmp_cache_path]:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+    os.replace(tmp_cache_path, cache_path)
+    if write_csv:
+        os.replace(tmp_csv_path, csv_path)
+        write_cache_stamp(csv_path)
+    print('Exported ' + str(num_rows) + ' rows to ' + cache_path)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Export cohort and covariates from database.')
+    parser.add_argument('--database_name',
+                        action  = 'store',
+                        type    = str,
+                        help    = 'Specify name of database containing cohort and covariates.')
+    parser.add_argument('--schema_name',
+                        action  = 'store',
+                        type    = str,
+                        help    = 'Specify schema name to read data from.')
+    parser.add_argument('--min_patients_per_provider',
+                        action  = 'store',
+                        type    = int,
+                        default = None,
+                        help    = 'Specify to filter to providers with at least this many patients in SQL.')
+    parser.add_argument('--skip_csv',
+                        action  = 'store_true',
+                        default = False,
+                        help    = 'Specify to only write the parquet file. (The R scripts need the csv.)')
+    parser.add_argument('--backend',
+                        action  = 'store',
+                        type    = str,
+                        default = 'postgres',
+                        help    = 'Specify postgres, or duckdb to run on local OMOP extracts. '
+                                  + '(--database_name is then the directory containing the extracts.)')
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO)
+
+    with instrument_stage('export_cohort.py'):
+        export_cohort(args.database_name,
+                      args.schema_name,
+                      args.min_patients_per_provider,
+                      not args.skip_csv,
+                      backend = args.backend)
@@ -1,32 +1,328 @@
+import sys
+import json
+import time
+import logging
 import argparse
+from os.path import dirname, abspath
+from concurrent.futures import ThreadPoolExecutor
+
 import sqlalchemy
 
-from utils import session_scope, create_sql_engine
+sys.path.append(dirname(dirname(abspath(__file__))))
+import config
+from utils import session_scope, create_sql_engine, table_exists
+from instrumentation import instrument_stage, instrumented
+
+# OMOP tables whose new rows can change a person's cohort membership or covariates, mapped to their id columns
+# Watermarks are the largest ids that have been processed
+watermark_sources = {'drug_exposure'       : 'drug_exposure_id',
+                     'measurement'         : 'measurement_id',
+                     'condition_occurrence': 'condition_occurrence_id'}
+
+# non-negative hash of person_id used to split persons into partitions, the sign bit is masked in postgres
+person_hash_expressions = {'postgres': '(hashint8(de.person_id) & 2147483647)',
+                           'duckdb'  : 'hash(de.person_id)'}
+
+def get_source_max_ids(session):
+    '''
+    Get the largest id currently in each watermark source table
+    @param session: sqlalchemy session
+    @return: dict mapping source table name to int
+    '''
+    max_ids = dict()
+    for source_table, id_column in watermark_sources.items():
+        result = session.execute(sqlalchemy.text('SELECT COALESCE(MAX(' + id_column + '), 0) AS max_id '
+                                                 + 'FROM cdm.' + source_table + ';')).fetchone()
+        max_ids[source_table] = int(result['max_id'])
+    return max_ids
+
+def get_watermarks(session,
+                   schema_name):
+    '''
+    Get the watermarks recorded by the last extraction
+    @param session: sqlalchemy session
+    @param schema_name: str, schema containing extraction_watermarks and cohort tables
+    @return: dict mapping source table name to int, None if the tables or any watermark are missing
+    '''
+    for table_name in ['extraction_watermarks', 't2dm_cohort_with_missing_data', 't2dm_cohort', 't2dm_cohort_covariates']:
+        if not table_exists(session, schema_name, table_name):
+            return None
+    watermarks = {row['source_table']: int(row['max_id'])
+                  for row in session.execute(sqlalchemy.text('SELECT source_table, max_id '
+                                                             + 'FROM ' + schema_name + '.extraction_watermarks;'))}
+    if set(watermarks.keys()) != set(watermark_sources.keys()):
+        return None
+    return watermarks
+
+def update_watermarks(session,
+                      schema_name,
+                      max_ids):
+    '''
+    Record watermarks after a successful extraction
+    @param session: sqlalchemy session
+    @param schema_name: str, schema containing extraction_watermarks
+    @param max_ids: dict mapping source table name to largest processed id
+    @return: None
+    '''
+    with open('sql/create_watermarks.sql', 'r') as f:
+        session.execute(sqlalchemy.text(f.read().format(schema_name = schema_name)))
+    values = ', '.join(["('" + source_table + "', " + str(max_ids[source_table]) + ", NOW())"
+                        for source_table in watermark_sources])
+    session.execute(sqlalchemy.text('INSERT INTO ' + schema_name + '.extraction_watermarks '
+                                    + '(source_table, max_id, updated_at) VALUES ' + values + ' '
+                                    + 'ON CONFLICT (source_table) DO UPDATE '
+                                    + 'SET max_id = EXCLUDED.max_id, updated_at = EXCLUDED.updated_at;'))
+
+def extract_partition(engine,
+                      schema_name,
+                      table_suffix,
+                      person_filter,
+                      skip_cohort,
+                      max_retries = 2):
+    '''
+    Create cohort and covariate tables for the persons selected by person_filter on a connection from the pool
+    The SQL drops its tables before creating them, so a failed partition can be rerun alone
+    @param engine: sqlalchemy engine
+    @param schema_name: str, schema to create tables in
+    @param table_suffix: str, appended to names of the tables created
+    @param person_filter: str, condition on de.person_id starting with AND, empty to extract everyone
+    @param skip_cohort: bool, whether to skip cohort table creation, assumes already exists
+    @param max_retries: int, number of times to rerun the partition after a database error
+    @return: None
+    '''
+    if not skip_cohort:
+        with open('sql/extract_cohort.sql', 'r') as f:
+            cohort_sql = f.read().format(schema_name   = schema_name,
+                                         table_suffix  = table_suffix,
+                                         person_filter = person_filter)
+    with open('sql/extract_covariates.sql', 'r') as f:
+        covariate_sql = f.read().format(schema_name  = schema_name,
+                                        table_suffix = table_suffix)
+
+    for attempt_idx in range(max_retries + 1):
+        try:
+            with session_scope(engine) as session:
+                if not skip_cohort:
+                    session.execute(sqlalchemy.text(cohort_sql))
+                    session.commit()
+                session.execute(sqlalchemy.text(covariate_sql))
+                session.commit()
+            return
+        except sqlalchemy.exc.DBAPIError as e:
+            if attempt_idx == max_retries:
+                raise
+            print('Extraction into tables ending in "' + table_suffix + '" failed, retrying: ' + str(e.orig))
+
+def merge_partitions(session,
+                     schema_name,
+                     partition_suffixes,
+                     table_suffix):
+    '''
+    Combine partition tables into the cohort and covariate tables and drop the partitions
+    @param session: sqlalchemy session
+    @param schema_name: str, schema containing tables
+    @param partition_suffixes: list of str, suffixes of partition tables
+    @param table_suffix: str, suffix of merged tables
+    @return: None
+    '''
+    merge_sql = ''
+    for table_name in ['t2dm_cohort_with_missing_data', 't2dm_cohort', 't2dm_cohort_covariates']:
+        merge_sql += 'DROP TABLE IF EXISTS ' + schema_name + '.' + table_name + table_suffix + ';\n'
+        merge_sql += 'CREATE TABLE ' + schema_name + '.' + table_name + table_suffix + ' AS (\n    ' \
+                   + '\n    UNION ALL\n    '.join(['SELECT * FROM ' + schema_name + '.' + table_name + partition_suffix
+                                                  for partition_suffix in partition_suffixes]) \
+                   + '\n    ORDER BY person_id\n);\n'
+        for partition_suffix in partition_suffixes:
+            merge_sql += 'DROP TABLE ' + schema_name + '.' + table_name + partition_suffix + ';\n'
+    session.execute(sqlalchemy.text(merge_sql))
 
+@instrumented
 def extract_cohort_and_covariates(database_name,
                                   schema_name,
-                                  skip_cohort):
+                                  skip_cohort,
+                                  incremental       = False,
+                                  statement_timeout = None,
+                                  num_partitions    = 1,
+                                  max_retries       = 2,
+                                  backend           = 'postgres'):
     '''
     Create cohort and covariate tables in database schema
     @param database_name: str, name of database
     @param schema_name: str, schema to create tables in
     @param skip_cohort: bool, whether to skip cohort table creation, assumes already exists
+    @param incremental: bool, whether to only re-extract persons with drug exposures, measurements,
+                        or conditions added since the watermarks recorded by the last extraction
+                        and replace their rows in the existing tables,
+                        falls back to a full rebuild if there are no watermarks
+    @param statement_timeout: int, seconds after which postgres cancels a statement, None for no limit
+    @param num_partitions: int, number of person_id hash partitions to extract concurrently on separate connections
+                           into partition tables that are then merged
+    @param max_retries: int, number of times to rerun a failed partition
+    @param backend: str, postgres or duckdb, see utils.sql_backends
     @return: None
     '''
-    if not skip_cohort:
-        with open('sql/extract_cohort.sql', 'r') as f:
-            cohort_sql = f.read().format(schema_name = schema_name)
-    with open('sql/extract_covariates.sql', 'r') as f:
-        covariate_sql = f.read().format(schema_name   = schema_name)
+    if skip_cohort and incremental:
+        raise ValueError('skip_cohort cannot be combined with incremental extraction')
+    if skip_cohort and num_partitions > 1:
+        raise ValueError('skip_cohort cannot be combined with partitioned extraction')
 
-    engine = create_sql_engine(database_name)
+    engine = create_sql_engine(database_name,
+                               pool_size         = num_partitions + 1,
+                               statement_timeout = statement_timeout,
+                               backend           = backend)
     with session_scope(engine) as session:
-        if not skip_cohort:
-            session.execute(sqlalchemy.text(cohort_sql))
+        # fix the upper bounds first so rows loaded during extraction are picked up by the next run
+        max_ids    = get_source_max_ids(session)
+        watermarks = get_watermarks(session, schema_name) if incremental else None
+        if incremental and watermarks is None:
+            print('No watermarks found in ' + schema_name + ', running full extraction')
+
+        if watermarks is None:
+            table_suffix  = ''
+            person_filter = ''
+        else:
+            with open('sql/find_changed_persons.sql', 'r') as f:
+                changed_persons_sql = f.read().format(schema_name = schema_name,
+                                                      **{source_table + '_watermark': watermarks[source_table]
+                                                         for source_table in watermark_sources},
+                                                      **{source_table + '_max_id': max_ids[source_table]
+                                                         for source_table in watermark_sources})
+            session.execute(sqlalchemy.text(changed_persons_sql))
             session.commit()
-        session.execute(sqlalchemy.text(covariate_sql))
+            num_changed = session.execute(sqlalchemy.text('SELECT COUNT(*) AS num_persons '
+                                                          + 'FROM ' + schema_name + '.changed_persons;')).fetchone()
+            print('Re-extracting ' + str(num_changed['num_persons']) + ' persons with new data')
+            table_suffix  = '_staging'
+            person_filter = 'AND de.person_id IN (SELECT person_id FROM ' + schema_name + '.changed_persons)'
         session.commit()
 
+        if num_partitions == 1:
+            partition_suffixes = [table_suffix]
+            partition_filters  = [person_filter]
+        else:
+            partition_suffixes = [table_suffix + '_part' + str(partition_idx) for partition_idx in range(num_partitions)]
+            partition_filters  = [person_filter + ' AND ' + person_hash_expressions[backend] + ' % '
+                                  + str(num_partitions) + ' = ' + str(partition_idx)
+                                  for partition_idx in range(num_partitions)]
+        with ThreadPoolExecutor(max_workers = num_partitions) as executor:
+            futures = [executor.submit(extract_partition,
+                                       engine,
+                                       schema_name,
+                                       partition_suffix,
+                                       partition_filter,
+                                       skip_cohort,
+                                       max_retries)
+                       for partition_suffix, partition_filter in zip(partition_suffixes, partition_filters)]
+            for future in futures:
+                future.result()
+        if num_partitions > 1:
+            merge_partitions(session,
+                             schema_name,
+                             partition_suffixes,
+                             table_suffix)
+            session.commit()
+
+        if watermarks is not None:
+            # replace rows of changed persons and advance watermarks in one transaction
+            with open('sql/upsert_cohort.sql', 'r') as f:
+                session.execute(sqlalchemy.text(f.read().format(schema_name  = schema_name,
+                                                                table_suffix = table_suffix)))
+        if not skip_cohort:
+            update_watermarks(session, schema_name, max_ids)
+        session.commit()
+
+def create_omop_indexes(database_name):
+    '''
+    Create indexes on the OMOP tables read by the extraction and case study SQL and update their statistics
+    Indexes that already exist are skipped
+    @param database_name: str, name of database
+    @return: None
+    '''
+    with open('sql/create_omop_indexes.sql', 'r') as f:
+        index_sql = f.read()
+    engine = create_sql_engine(database_name)
+    with session_scope(engine) as session:
+        for statement in index_sql.split(';'):
+            if statement.strip() != '':
+                session.execute(sqlalchemy.text(statement.strip() + ';'))
+                session.commit()
+
+def explain_statements(session,
+                       sql,
+                       sql_name):
+    '''
+    Run each statement in sql, statements that produce rows or create tables are run under EXPLAIN (ANALYZE, BUFFERS)
+    @param session: sqlalchemy session
+    @param sql: str, semicolon-separated statements
+    @param sql_name: str, name of sql file to record with each plan
+    @return: list of dicts with sql file name, statement index and text, wall time in seconds,
+             and planning time, execution time, and plan from postgres for explained statements
+    '''
+    profiles = []
+    for statement_idx, statement in enumerate([statement.strip() for statement in sql.split(';')
+                                               if statement.strip() != '']):
+        profile    = {'sql_file'       : sql_name,
+                      'statement_index': statement_idx,
+                      'statement'      : statement}
+        start_time = time.perf_counter()
+        if statement.upper().startswith(('CREATE TABLE', 'SELECT', 'WITH', 'INSERT', 'DELETE')):
+            result = session.execute(sqlalchemy.text('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + statement + ';'))
+            plan   = result.fetchone()[0][0]
+            profile['planning_time_ms']  = plan['Planning Time']
+            profile['execution_time_ms'] = plan['Execution Time']
+            profile['plan']              = plan['Plan']
+        else:
+            session.execute(sqlalchemy.text(statement + ';'))
+        session.commit()
+        profile['wall_time_s'] = time.perf_counter() - start_time
+        profiles.append(profile)
+    return profiles
+
+def profile_extraction(database_name,
+                       schema_name,
+                       statement_timeout = None):
+    '''
+    Run the cohort and covariate extraction with each statement under EXPLAIN (ANALYZE, BUFFERS),
+    then the case study feature SQL for one case study patient if the case study cohort table exists
+    The extraction tables are created as in a full extraction
+    Plans and timings are written to extraction_profile.json in the output directory
+    @param database_name: str, name of database
+    @param schema_name: str, schema to create tables in
+    @param statement_timeout: int, seconds after which postgres cancels a statement, None for no limit
+    @return: None
+    '''
+    with open('sql/extract_cohort.sql', 'r') as f:
+        cohort_sql = f.read().format(schema_name   = schema_name,
+                                     table_suffix  = '',
+                                     person_filter = '')
+    with open('sql/extract_covariates.sql', 'r') as f:
+        covariate_sql = f.read().format(schema_name  = schema_name,
+                                        table_suffix = '')
+
+    engine = create_sql_engine(database_name,
+                               statement_timeout = statement_timeout)
+    with session_scope(engine) as session:
+        profiles  = explain_statements(session, cohort_sql, 'extract_cohort.sql')
+        profiles += explain_statements(session, covariate_sql, 'extract_covariates.sql')
+
+        if table_exists(session, schema_name, 'small_pval_provider_patients'):
+            case_study_patient = session.execute(sqlalchemy.text('SELECT person_id, end_date FROM ' + schema_name
+                                                                 + '.small_pval_provider_patients LIMIT 1;')).fetchone()
+            if case_study_patient is not None:
+                feature_sql_dir = dirname(dirname(abspath(__file__))) + '/patient_case_studies/sql/'
+                for feature_name in ['drugs', 'conditions', 'procedures', 'visit_types', 'visit_specialties', 'labs']:
+                    with open(feature_sql_dir + feature_name + '.sql', 'r') as f:
+                        feature_sql = f.read().format(cdm_schema = 'cdm',
+                                                      person_id  = case_study_patient['person_id'],
+                                                      end_date   = case_study_patient['end_date'])
+                    profiles += explain_statements(session, feature_sql, feature_name + '.sql')
+
+    with open(config.output_dir + 'extraction_profile.json', 'w') as f:
+        json.dump(profiles, f, indent = 2, default = str)
+    for profile in profiles:
+        print(profile['sql_file'] + ' statement ' + str(profile['statement_index']) + ': '
+              + str(round(profile['wall_time_s'], 3)) + ' s')
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description = 'Extract type 2 diabetes cohort and covariates.')
@@ -42,7 +338,56 @@ if __name__ == '__main__':
                         action  = 'store_true',
                         default = False,
                         help    = 'Specify to skip cohort table creation. (Assumes already created.)')
+    parser.add_argument('--incremental',
+                        action  = 'store_true',
+                        default = False,
+                        help    = 'Specify to only re-extract persons with data added since the last extraction. '
+                                  + '(Runs a full extraction if no previous extraction is recorded.)')
+    parser.add_argument('--statement_timeout',
+                        action  = 'store',
+                        type    = int,
+                        default = None,
+                        help    = 'Specify number of seconds after which a statement is cancelled.')
+    parser.add_argument('--num_partitions',
+                        action  = 'store',
+                        type    = int,
+                        default = 1,
+                        help    = 'Specify number of person_id hash partitions to extract concurrently.')
+    parser.add_argument('--max_retries',
+                        action  = 'store',
+                        type    = int,
+                        default = 2,
+                        help    = 'Specify number of times to rerun a failed partition.')
+    parser.add_argument('--profile',
+                        action  = 'store_true',
+                        default = False,
+                        help    = 'Specify to run a full extraction under EXPLAIN (ANALYZE, BUFFERS) '
+                                  + 'and write plans and timings to extraction_profile.json in the output directory.')
+    parser.add_argument('--create_indexes',
+                        action  = 'store_true',
+                        default = False,
+                        help    = 'Specify to create indexes on the OMOP tables used before extraction.')
+    parser.add_argument('--backend',
+                        action  = 'store',
+                        type    = str,
+                        default = 'postgres',
+                        help    = 'Specify postgres, or duckdb to run on local OMOP extracts. '
+                                  + '(--database_name is then the directory containing the extracts.)')
     args = parser.parse_args()
-    extract_cohort_and_covariates(args.database_name,
-                                  args.schema_name,
-                                  args.skip_cohort)
\ No newline at end of file
+    logging.basicConfig(level = logging.INFO)
+    with instrument_stage('extract_data.py'):
+        if args.create_indexes:
+            create_omop_indexes(args.database_name)
+        if args.profile:
+            profile_extraction(args.database_name,
+                               args.schema_name,
+                               args.statement_timeout)
+        else:
+            extract_cohort_and_covariates(args.database_name,
+                                          args.schema_name,
+                                          args.skip_cohort,
+                                          args.incremental,
+                                          args.statement_timeout,
+                                          args.num_partitions,
+                                          args.max_retries,
+                                          args.backend)
\ No newline at end of file
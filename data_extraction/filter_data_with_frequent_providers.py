@@ -1,31 +1,90 @@
+import os
 import sys
+import argparse
 from os.path import dirname, abspath
 
+import numpy as np
 import pandas as pd
 
 sys.path.append(dirname(dirname(abspath(__file__))))
 import config
+from instrumentation import instrument_stage, instrumented, record_rows
 
-def filter_frequent_providers():
+def count_patients_per_provider(cohort_file,
+                                chunksize):
     '''
-    Read in T2DM cohort and filter down to providers with at least 10 patients
-    Add prv_id column that numbers providers from 1 to N_prv
+    Count rows per npi by streaming the cohort csv in chunks
+    @param cohort_file: str, path to cohort csv
+    @param chunksize: int, number of rows to read at a time
+    @return: pandas Series mapping npi to count
+    '''
+    prv_counts = pd.Series(dtype = np.int64)
+    for chunk_df in pd.read_csv(cohort_file,
+                                usecols   = ['npi'],
+                                chunksize = chunksize):
+        prv_counts = prv_counts.add(chunk_df['npi'].value_counts(), fill_value = 0)
+    return prv_counts
+
+@instrumented
+def filter_frequent_providers(min_patients_per_provider = None,
+                              chunksize                 = None):
+    '''
+    Read in T2DM cohort and filter down to providers with at least min_patients_per_provider patients
+    Add prv_id column that numbers providers from 1 to N_prv in order of npi
+    @param min_patients_per_provider: int, minimum number of patients, defaults to config.min_patients_per_provider
+    @param chunksize: int, if specified, make two passes over the csv in chunks of this many rows:
+                      count patients per provider, then filter and write each chunk,
+                      so cohorts larger than memory can be filtered
     @return: None
     '''
-    df = pd.read_csv(config.data_dir + 't2dm_cohort_data.csv')
-    prv_counts = df.npi.value_counts().to_dict()
-    frequent_npi = set()
-    for npi in prv_counts:
-        if prv_counts[npi] >= 10:
-            frequent_npi.add(npi)
-    filtered_df = df.loc[df['npi'].isin(frequent_npi)]
-    frequent_npi = list(frequent_npi)
-    frequent_npi.sort()
-    npi_ids = {frequent_npi[i]: i + 1 for i in range(len(frequent_npi))}
-    filtered_df['prv_id'] = [npi_ids[filtered_df['npi'].values[i]] for i in range(len(filtered_df))]
-    filtered_df.to_csv(config.data_dir + 't2dm_cohort_data_frequent_prv_only.csv',
-                       index = False)
-    
+    if min_patients_per_provider is None:
+        min_patients_per_provider = config.min_patients_per_provider
+    cohort_file   = config.data_dir + 't2dm_cohort_data.csv'
+    filtered_file = config.data_dir + 't2dm_cohort_data_frequent_prv_only.csv'
+
+    if chunksize is None:
+        df           = pd.read_csv(cohort_file)
+        record_rows(len(df))
+        prv_counts   = df['npi'].value_counts()
+        frequent_npi = np.sort(prv_counts.index[prv_counts >= min_patients_per_provider].values)
+        filtered_df  = df.loc[df['npi'].isin(frequent_npi)].copy()
+        filtered_df['prv_id'] = np.searchsorted(frequent_npi, filtered_df['npi'].values) + 1
+        filtered_df.to_csv(filtered_file,
+                           index = False)
+        return
+
+    prv_counts   = count_patients_per_provider(cohort_file, chunksize)
+    frequent_npi = np.sort(prv_counts.index[prv_counts >= min_patients_per_provider].values)
+    # write to a temporary file so an interrupted run does not leave a partial cohort behind
+    tmp_filtered_file = filtered_file + '.tmp'
+    write_header      = True
+    for chunk_df in pd.read_csv(cohort_file,
+                                chunksize = chunksize):
+        record_rows(len(chunk_df))
+        filtered_chunk_df = chunk_df.loc[chunk_df['npi'].isin(frequent_npi)].copy()
+        filtered_chunk_df['prv_id'] = np.searchsorted(frequent_npi, filtered_chunk_df['npi'].values) + 1
+        filtered_chunk_df.to_csv(tmp_filtered_file,
+                                 mode   = 'w' if write_header else 'a',
+                                 header = write_header,
+                                 index  = False)
+        write_header = False
+    os.replace(tmp_filtered_file, filtered_file)
+
 if __name__ == '__main__':
-    
-    filter_frequent_providers()
\ No newline at end of file
+
+    parser = argparse.ArgumentParser(description = 'Filter cohort to providers with many patients.')
+    parser.add_argument('--min_patients_per_provider',
+                        action  = 'store',
+                        type    = int,
+                        default = None,
+                        help    = 'Specify minimum number of patients per provider. Defaults to value in config.py.')
+    parser.add_argument('--chunksize',
+                        action  = 'store',
+                        type    = int,
+                        default = None,
+                        help    = 'Specify to stream the cohort in chunks of this many rows for cohorts larger than memory.')
+    args = parser.parse_args()
+
+    with instrument_stage('filter_data_with_frequent_providers.py'):
+        filter_frequent_providers(args.min_patients_per_provider,
+                                  args.chunksize)
@@ -0,0 +1,12 @@
+WITH distribution AS (
+    SELECT {value_expression} AS value
+    FROM ({query}) AS q
+    WHERE stat IS NOT NULL
+)
+SELECT CASE WHEN {max_value} = {min_value} THEN 1
+            ELSE LEAST(CAST(FLOOR((CAST(value AS DOUBLE PRECISION) - {min_value}) * {num_bins} / ({max_value} - {min_value})) AS INTEGER) + 1, {num_bins})
+       END AS bin,
+       COUNT(*) AS count
+FROM distribution
+GROUP BY bin
+ORDER BY bin;
\ No newline at end of file
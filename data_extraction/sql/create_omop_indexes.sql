@@ -0,0 +1,18 @@
+CREATE INDEX IF NOT EXISTS t2dm_idx_drug_exposure_person_date ON cdm.drug_exposure (person_id, drug_exposure_start_date);
+CREATE INDEX IF NOT EXISTS t2dm_idx_drug_exposure_concept ON cdm.drug_exposure (drug_concept_id);
+CREATE INDEX IF NOT EXISTS t2dm_idx_measurement_person_date ON cdm.measurement (person_id, measurement_date);
+CREATE INDEX IF NOT EXISTS t2dm_idx_measurement_concept ON cdm.measurement (measurement_concept_id);
+CREATE INDEX IF NOT EXISTS t2dm_idx_condition_occurrence_person_date ON cdm.condition_occurrence (person_id, condition_start_date);
+CREATE INDEX IF NOT EXISTS t2dm_idx_condition_occurrence_concept ON cdm.condition_occurrence (condition_concept_id);
+CREATE INDEX IF NOT EXISTS t2dm_idx_procedure_occurrence_person_date ON cdm.procedure_occurrence (person_id, procedure_date);
+CREATE INDEX IF NOT EXISTS t2dm_idx_visit_occurrence_person_date ON cdm.visit_occurrence (person_id, visit_start_date);
+CREATE INDEX IF NOT EXISTS t2dm_idx_observation_period_person ON cdm.observation_period (person_id);
+CREATE INDEX IF NOT EXISTS t2dm_idx_provider_provider ON cdm.provider (provider_id);
+CREATE INDEX IF NOT EXISTS t2dm_idx_drug_strength_ingredient ON cdm.drug_strength (ingredient_concept_id);
+CREATE INDEX IF NOT EXISTS t2dm_idx_concept_ancestor_ancestor ON cdm.concept_ancestor (ancestor_concept_id, descendant_concept_id);
+ANALYZE cdm.drug_exposure;
+ANALYZE cdm.measurement;
+ANALYZE cdm.condition_occurrence;
+ANALYZE cdm.procedure_occurrence;
+ANALYZE cdm.visit_occurrence;
+ANALYZE cdm.observation_period;
\ No newline at end of file
@@ -0,0 +1,5 @@
+CREATE TABLE IF NOT EXISTS {schema_name}.extraction_watermarks (
+    source_table TEXT PRIMARY KEY,
+    max_id BIGINT NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
\ No newline at end of file
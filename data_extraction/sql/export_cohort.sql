@@ -0,0 +1,3 @@
+SELECT *
+FROM {schema_name}.t2dm_cohort_covariates
+ORDER BY person_id
\ No newline at end of file
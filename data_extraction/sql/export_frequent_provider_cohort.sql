@@ -0,0 +1,12 @@
+WITH frequent_providers AS (
+    SELECT npi
+    FROM {schema_name}.t2dm_cohort_covariates
+    GROUP BY npi
+    HAVING COUNT(*) >= {min_patients_per_provider}
+)
+SELECT c.*,
+       DENSE_RANK() OVER (ORDER BY c.npi) AS prv_id
+FROM {schema_name}.t2dm_cohort_covariates c
+JOIN frequent_providers p
+ON c.npi = p.npi
+ORDER BY c.person_id
\ No newline at end of file
@@ -1,5 +1,5 @@
-DROP TABLE IF EXISTS {schema_name}.t2dm_cohort_with_missing_data;
-CREATE TABLE {schema_name}.t2dm_cohort_with_missing_data AS (
+DROP TABLE IF EXISTS {schema_name}.t2dm_cohort_with_missing_data{table_suffix};
+CREATE TABLE {schema_name}.t2dm_cohort_with_missing_data{table_suffix} AS (
     WITH diabetes_ingredient_concepts AS ( 
         SELECT DISTINCT 
             concept_id AS ingredient_concept_id, 
@@ -33,6 +33,7 @@ CREATE TABLE {schema_name}.t2dm_cohort_with_missing_data AS (
         JOIN cdm.drug_exposure de 
         ON de.drug_concept_id = ddc.drug_concept_id 
         WHERE de.person_id != -1 
+        {person_filter}
     ),
     diabetes_first_treatment_date AS ( 
         SELECT person_id, 
@@ -132,7 +133,7 @@ CREATE TABLE {schema_name}.t2dm_cohort_with_missing_data AS (
         SELECT ci.person_id 
         FROM cohort_with_diabetes ci 
         WHERE NOT EXISTS ( 
-            SELECT 
+            SELECT 1
             FROM cohort_with_t1dm_gestational ce 
             WHERE ci.person_id = ce.person_id 
         ) 
@@ -195,18 +196,18 @@ CREATE TABLE {schema_name}.t2dm_cohort_with_missing_data AS (
     ORDER BY person_id
 );
 
-DROP TABLE IF EXISTS {schema_name}.t2dm_cohort;
-CREATE TABLE {schema_name}.t2dm_cohort AS (
+DROP TABLE IF EXISTS {schema_name}.t2dm_cohort{table_suffix};
+CREATE TABLE {schema_name}.t2dm_cohort{table_suffix} AS (
     WITH n_treatment_types AS (
         SELECT person_id,
                COUNT(DISTINCT metformin) AS treatment_types
-        FROM {schema_name}.t2dm_cohort_with_missing_data
+        FROM {schema_name}.t2dm_cohort_with_missing_data{table_suffix}
         GROUP BY person_id
     ),
     n_providers_per_patient AS (
         SELECT person_id,
                COUNT(DISTINCT npi) AS n_providers
-        FROM {schema_name}.t2dm_cohort_with_missing_data
+        FROM {schema_name}.t2dm_cohort_with_missing_data{table_suffix}
         WHERE npi IS NOT NULL
         GROUP BY person_id
     )
@@ -218,7 +219,7 @@ CREATE TABLE {schema_name}.t2dm_cohort AS (
         c.egfr, 
         COALESCE(c.egfr_lab_measured, 0) AS egfr_lab_measured,
         c.measurement_date 
-    FROM {schema_name}.t2dm_cohort_with_missing_data c
+    FROM {schema_name}.t2dm_cohort_with_missing_data{table_suffix} c
     JOIN n_treatment_types t
     ON c.person_id = t.person_id
     JOIN n_providers_per_patient p
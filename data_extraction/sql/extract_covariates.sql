@@ -1,11 +1,11 @@
-DROP TABLE IF EXISTS {schema_name}.t2dm_cohort_covariates; 
-CREATE TABLE {schema_name}.t2dm_cohort_covariates AS
+DROP TABLE IF EXISTS {schema_name}.t2dm_cohort_covariates{table_suffix}; 
+CREATE TABLE {schema_name}.t2dm_cohort_covariates{table_suffix} AS
 (
     with heart_failure AS (
         SELECT DISTINCT
             co.person_id,
             1 AS occurred
-        FROM {schema_name}.t2dm_cohort p
+        FROM {schema_name}.t2dm_cohort{table_suffix} p
         JOIN cdm.condition_occurrence co
         ON co.person_id = p.person_id
         WHERE
@@ -29,7 +29,7 @@ CREATE TABLE {schema_name}.t2dm_cohort_covariates AS
                  ELSE 0 
             END AS male,
             c.concept_name AS race
-        FROM {schema_name}.t2dm_cohort tc
+        FROM {schema_name}.t2dm_cohort{table_suffix} tc
         JOIN cdm.person p
         ON p.person_id = tc.person_id
         JOIN cdm.concept c
@@ -41,7 +41,7 @@ CREATE TABLE {schema_name}.t2dm_cohort_covariates AS
         d.age,
         d.male,
         d.race
-    FROM {schema_name}.t2dm_cohort c
+    FROM {schema_name}.t2dm_cohort{table_suffix} c
     LEFT JOIN heart_failure hd
     ON c.person_id = hd.person_id
     JOIN demographics d
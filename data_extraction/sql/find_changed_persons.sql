@@ -0,0 +1,18 @@
+DROP TABLE IF EXISTS {schema_name}.changed_persons;
+CREATE TABLE {schema_name}.changed_persons AS (
+    SELECT person_id
+    FROM cdm.drug_exposure
+    WHERE drug_exposure_id > {drug_exposure_watermark}
+    AND drug_exposure_id <= {drug_exposure_max_id}
+    UNION
+    SELECT person_id
+    FROM cdm.measurement
+    WHERE measurement_id > {measurement_watermark}
+    AND measurement_id <= {measurement_max_id}
+    UNION
+    SELECT person_id
+    FROM cdm.condition_occurrence
+    WHERE condition_occurrence_id > {condition_occurrence_watermark}
+    AND condition_occurrence_id <= {condition_occurrence_max_id}
+);
+CREATE INDEX changed_persons_person_id ON {schema_name}.changed_persons (person_id);
\ No newline at end of file
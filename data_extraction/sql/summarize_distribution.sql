@@ -0,0 +1,16 @@
+WITH distribution AS (
+    SELECT stat,
+           {value_expression} AS value
+    FROM ({query}) AS q
+    WHERE stat IS NOT NULL
+)
+SELECT MIN(stat) AS min,
+       percentile_cont(0.25) WITHIN GROUP (ORDER BY value) AS percentile_25,
+       percentile_cont(0.5) WITHIN GROUP (ORDER BY value) AS median,
+       AVG(value) AS mean,
+       percentile_cont(0.75) WITHIN GROUP (ORDER BY value) AS percentile_75,
+       STDDEV_SAMP(value) AS std,
+       MAX(stat) AS max,
+       MIN(value) AS min_value,
+       MAX(value) AS max_value
+FROM distribution;
\ No newline at end of file
@@ -0,0 +1,19 @@
+DELETE FROM {schema_name}.t2dm_cohort_with_missing_data
+WHERE person_id IN (SELECT person_id FROM {schema_name}.changed_persons);
+INSERT INTO {schema_name}.t2dm_cohort_with_missing_data
+SELECT * FROM {schema_name}.t2dm_cohort_with_missing_data{table_suffix};
+
+DELETE FROM {schema_name}.t2dm_cohort
+WHERE person_id IN (SELECT person_id FROM {schema_name}.changed_persons);
+INSERT INTO {schema_name}.t2dm_cohort
+SELECT * FROM {schema_name}.t2dm_cohort{table_suffix};
+
+DELETE FROM {schema_name}.t2dm_cohort_covariates
+WHERE person_id IN (SELECT person_id FROM {schema_name}.changed_persons);
+INSERT INTO {schema_name}.t2dm_cohort_covariates
+SELECT * FROM {schema_name}.t2dm_cohort_covariates{table_suffix};
+
+DROP TABLE {schema_name}.t2dm_cohort_with_missing_data{table_suffix};
+DROP TABLE {schema_name}.t2dm_cohort{table_suffix};
+DROP TABLE {schema_name}.t2dm_cohort_covariates{table_suffix};
+DROP TABLE {schema_name}.changed_persons;
\ No newline at end of file
@@ -8,15 +8,18 @@ import seaborn as sns
 
 sys.path.append(dirname(dirname(abspath(__file__))))
 import config
+from cohort_data import load_cohort_data
+from instrumentation import instrument_stage, instrumented
 
+@instrumented
 def make_plot():
     '''
     Plot eGFR values colored by treatment decisions for different providers
     Order providers by metformin prescription rate
     Keep first 10 providers, every 3rd provider in the middle, and last 10 providers so plot is not too tall.
     '''
-    patient_df = pd.read_csv(config.data_dir + 't2dm_cohort_data_frequent_prv_only.csv')
-    metformin_prescription_rate_df = patient_df.groupby(by = 'npi')['metformin'].mean().reset_index().sort_values(by='metformin')
+    patient_df = load_cohort_data()
+    metformin_prescription_rate_df = patient_df.groupby(by = 'npi', observed = True)['metformin'].mean().reset_index().sort_values(by='metformin')
     npis_sorted = metformin_prescription_rate_df['npi'].values
     keep_idxs = np.concatenate((np.arange(10),
                                 np.arange(int((len(npis_sorted) - 20)/3)) * 3 + 11,
@@ -70,4 +73,5 @@ def make_plot():
     
 if __name__ == '__main__':
     
-    make_plot()
\ No newline at end of file
+    with instrument_stage('create_provider_v_egfr_plot.py'):
+        make_plot()
\ No newline at end of file
@@ -8,15 +8,18 @@ import seaborn as sns
 
 sys.path.append(dirname(dirname(abspath(__file__))))
 import config
+from cohort_data import load_cohort_data
+from instrumentation import instrument_stage, instrumented
 
+@instrumented
 def make_plot():
     '''
     Plot eGFR values colored by treatment decisions for different providers
     Order providers by metformin prescription rate
     For graphical abstract, only plot 10 providers
     '''
-    patient_df = pd.read_csv(config.data_dir + 't2dm_cohort_data_frequent_prv_only.csv')
-    metformin_prescription_rate_df = patient_df.groupby(by = 'npi')['metformin'].mean().reset_index().sort_values(by='metformin')
+    patient_df = load_cohort_data()
+    metformin_prescription_rate_df = patient_df.groupby(by = 'npi', observed = True)['metformin'].mean().reset_index().sort_values(by='metformin')
     npis_sorted = metformin_prescription_rate_df['npi'].values
     keep_idxs = np.array([0, 2, 8, 22, 52, 82, 111, 141, 161, 171])
     npis_sorted = npis_sorted[keep_idxs]
@@ -60,4 +63,5 @@ def make_plot():
     
 if __name__ == '__main__':
     
-    make_plot()
\ No newline at end of file
+    with instrument_stage('make_graphical_abstract.py'):
+        make_plot()
\ No newline at end of file
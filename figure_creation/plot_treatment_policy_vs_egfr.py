@@ -1,4 +1,6 @@
 import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from os.path import dirname, abspath
 
 import numpy as np
@@ -6,12 +8,70 @@ import pandas as pd
 import matplotlib.lines as mlines
 import matplotlib.patches as mpatches
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba_array
 import seaborn as sns
+from scipy.special import expit
 
 sys.path.append(dirname(dirname(abspath(__file__))))
 import config
+from cohort_data import load_cohort_data
+from stratification import build_stratification_index, get_stratum_code, get_stratum_rows
+from predict_policy_curves import predict_policy_curves, have_model_coefficients, read_category_predictions
+from instrumentation import instrument_stage, instrumented, record_rows
 
-def plot_treatment_policy_vs_egfr():
+render_modes = ['collection', 'lineplot']
+
+def compute_curve_segments(egfr_vals_to_plot,
+                           category_logits,
+                           npi_idxs):
+    '''
+    Convert the logits of one category into metformin probability curves,
+    indexing providers along the first axis of the logits instead of masking a data frame per provider
+    @param egfr_vals_to_plot: numpy array, eGFR values
+    @param category_logits: numpy array, # providers x # eGFR values, may be a memory map
+    @param npi_idxs: numpy array or slice, providers to convert
+    @return: numpy array, # providers x # eGFR values x 2, eGFR and metformin probability along each curve
+    '''
+    npi_logits = category_logits[npi_idxs]
+    segments   = np.empty(npi_logits.shape + (2,))
+    segments[:, :, 0] = egfr_vals_to_plot
+    expit(npi_logits, out = segments[:, :, 1])
+    return segments
+
+def draw_curves(ax,
+                segments,
+                colors,
+                render_mode = 'collection',
+                rasterized  = False):
+    '''
+    Draw probability curves on an axis
+    @param ax: matplotlib Axes
+    @param segments: numpy array, # curves x # eGFR values x 2, output from compute_curve_segments
+    @param colors: numpy array, # curves x 4, RGBA color of each curve
+    @param render_mode: str, collection to draw all curves as one LineCollection artist,
+                        lineplot to draw one line artist per curve
+    @param rasterized: bool, whether to rasterize the curves when saving to a vector format
+    @return: None
+    '''
+    if render_mode == 'collection':
+        ax.add_collection(LineCollection(segments,
+                                         colors     = colors,
+                                         linewidths = plt.rcParams['lines.linewidth'],
+                                         rasterized = rasterized))
+    else:
+        for curve_idx in range(len(segments)):
+            ax.plot(segments[curve_idx, :, 0],
+                    segments[curve_idx, :, 1],
+                    color      = colors[curve_idx],
+                    rasterized = rasterized)
+
+@instrumented
+def plot_treatment_policy_vs_egfr(from_csv    = None,
+                                  memmap_path = None,
+                                  render_mode = 'collection',
+                                  rasterize   = False,
+                                  num_workers = 1):
     '''
     Plot estimated metformin probability vs eGFR
     1. black solid line for model without random effects
@@ -29,7 +89,18 @@ def plot_treatment_policy_vs_egfr():
     No heart failure, M, age 70, treatment date middle between 2013-02-18 and 2015-08-29
     No heart failure, M, age 70, treatment date middle between 2017-09-26 and 2020-10-21
     Also create a stand-alone plot with just estimated metformin probability vs eGFR for the first category
+    @param from_csv: bool, whether to read predictions written by make_predictions_for_plots.R
+                     instead of predicting from the coefficients of models fit in Python,
+                     defaults to reading them only if the coefficients are not saved
+    @param memmap_path: str, path of .npy file to hold predictions for every provider, see predict_policy_curves
+    @param render_mode: str, collection to draw the curves of all other providers in each panel as one artist,
+                        lineplot to draw one artist per provider
+    @param rasterize: bool, whether to rasterize the curves of all other providers in the pdfs
+    @param num_workers: int, number of threads computing the curves of the category panels
+    @return: None
     '''
+    if render_mode not in render_modes:
+        raise ValueError('render_mode must be one of ' + ', '.join(render_modes))
     plt.rcParams.update({'axes.titlesize' : 14,
                          'axes.labelsize' : 14,
                          'xtick.labelsize': 12,
@@ -45,10 +116,9 @@ def plot_treatment_policy_vs_egfr():
                                        ncols = 1,
                                        figsize = (6.4, 4.8))
     
-    sample_df           = pd.read_csv(config.data_dir + 't2dm_cohort_data_frequent_prv_only.csv')
-    npi_df              = pd.read_csv(config.output_dir + 'npi_glrt_pvalues.csv')
-    pred_df_without_npi = pd.read_csv(config.output_dir + 'category_predictions_for_plotting.csv')
-    pred_df_with_npi    = pd.read_csv(config.output_dir + 'category_predictions_with_npis_for_plotting.csv')
+    sample_df = load_cohort_data()
+    npi_df    = pd.read_csv(config.output_dir + 'npi_glrt_pvalues.csv')
+    record_rows(len(sample_df))
     
     sample_df.rename(columns = {'egfr': 'eGFR'},
                      inplace = True)
@@ -56,11 +126,23 @@ def plot_treatment_policy_vs_egfr():
     egfr_max          = sample_df['eGFR'].max()
     egfr_vals_to_plot = np.arange(egfr_min, egfr_max + 1)
     
+    # logits are # categories x # eGFR values without random effects and # categories x # npis x # eGFR values with
+    if from_csv is None:
+        from_csv = not have_model_coefficients()
+    if from_csv:
+        logits_without_random_effects, logits_with_random_effects = read_category_predictions(len(npi_df),
+                                                                                              len(egfr_vals_to_plot))
+    else:
+        egfr_vals_to_plot, logits_without_random_effects, logits_with_random_effects \
+            = predict_policy_curves(npi_df['NPI'].values,
+                                    memmap_path)
+    
     sample_df['Treatment'] = np.where(sample_df['metformin'] == 1, 'Metformin', 'DPP-4i / Sulfonylurea')
     treatment_order        = ['Metformin', 'DPP-4i / Sulfonylurea']
     
     npis               = npi_df['NPI'].values
     num_npis           = len(npis)
+    outlying_npi_idxs  = pd.Index(npis).get_indexer(config.outlying_npis)
     outlying_colors    = ['darkgreen', 'indigo']
     # use line below to set alpha by p-value rank so less "normal" providers are more faded
     # nonoutlying_alphas = [.2 + .3 * i / (num_npis - len(config.outlying_npis) - 1) for i in range(num_npis - len(config.outlying_npis))]
@@ -68,12 +150,33 @@ def plot_treatment_policy_vs_egfr():
     metformin_color    = 'steelblue'
     other_color        = 'orange'
     
+    # providers are ordered by p-value, so the outlying providers come first
+    nonoutlying_npi_idxs = slice(len(config.outlying_npis), num_npis)
+    nonoutlying_colors   = to_rgba_array(metformin_color, alpha = nonoutlying_alphas)
+    outlying_npi_mask    = outlying_npi_idxs >= 0
+    outlying_line_colors = to_rgba_array([outlying_colors[npi_idx % 2] for npi_idx in range(len(config.outlying_npis))])
+    
+    # curves of every category panel are computed in parallel, matplotlib draws them in this thread
+    with ThreadPoolExecutor(max_workers = num_workers) as executor:
+        nonoutlying_segments = list(executor.map(compute_curve_segments,
+                                                 [egfr_vals_to_plot for _ in range(len(logits_with_random_effects))],
+                                                 logits_with_random_effects,
+                                                 [nonoutlying_npi_idxs for _ in range(len(logits_with_random_effects))]))
+    
     category_titles           = ['F50 2014-05-25', 'F70 2014-05-25', 'F70 2019-04-09', 'M50 2014-05-25', 'M70 2014-05-25', 'M70 2019-04-09']
     category_sexes            = [0, 0, 0, 1, 1, 1]
-    category_age_ranges       = [[45, 54], [45, 54], [65, 74], [45, 54], [45, 54], [65, 74]]
+    category_age_ranges       = [[45, 54], [65, 74], [65, 74], [45, 54], [65, 74], [65, 74]]
     category_trt_date_ranges  = [['2013-02-18', '2015-08-29'], ['2013-02-18', '2015-08-29'], ['2017-09-26', '2020-10-21'],
                                  ['2013-02-18', '2015-08-29'], ['2013-02-18', '2015-08-29'], ['2017-09-26', '2020-10-21']]
     
+    # index the patients of every category in one pass instead of masking the cohort for each category
+    category_strata = [('heart_failure'       , [0]),
+                       ('male'                , [0, 1]),
+                       ('age'                 , [[45, 54], [65, 74]]),
+                       ('first_treatment_date', [['2013-02-18', '2015-08-29'], ['2017-09-26', '2020-10-21']])]
+    stratum_codes, strata_shape = build_stratification_index(sample_df, category_strata)
+    stratum_rows = get_stratum_rows(stratum_codes, int(np.prod(strata_shape)))
+    
     for category_idx in range(len(category_titles)):
         if category_idx < 3:
             row_idx = 0
@@ -87,12 +190,11 @@ def plot_treatment_policy_vs_egfr():
         trt_date_range = category_trt_date_ranges[category_idx]
         
         # create histograms
-        category_df = sample_df.loc[np.logical_and.reduce((sample_df['heart_failure'] == 0,
-                                                           sample_df['male'] == sex,
-                                                           sample_df['age'] >= age_range[0],
-                                                           sample_df['age'] <= age_range[1],
-                                                           sample_df['first_treatment_date'] >= trt_date_range[0],
-                                                           sample_df['first_treatment_date'] <= trt_date_range[1]))]
+        category_df = sample_df.iloc[stratum_rows[get_stratum_code(category_strata,
+                                                                   {'heart_failure'       : 0,
+                                                                    'male'                : sex,
+                                                                    'age'                 : age_range,
+                                                                    'first_treatment_date': trt_date_range})]]
         sns.histplot(data      = category_df,
                      x         = 'eGFR',
                      hue       = 'Treatment',
@@ -119,69 +221,33 @@ def plot_treatment_policy_vs_egfr():
                             legend      = False,
                             ax          = ax[2 * row_idx, col_idx])
         
-        # plot predictions with random effects for outlying providers and all other providers
-        logits_with_random_effects  = pred_df_with_npi['category_' + str(category_idx) + '_npi_pred'].values
-        probs_with_random_effects   = 1./(1. + np.exp(-1*logits_with_random_effects))
-        plot_df_with_random_effects = pd.DataFrame(data    = {'eGFR': np.tile(egfr_vals_to_plot, num_npis),
-                                                              'Metformin probability': probs_with_random_effects,
-                                                              'NPI': np.repeat(npis, len(egfr_vals_to_plot))},
-                                                   columns = ['eGFR', 'Metformin probability', 'NPI'])
-        
-        for npi_idx in range(num_npis - len(config.outlying_npis)):
-            npi = npis[npi_idx + len(config.outlying_npis)]
-            npi_plot_df = plot_df_with_random_effects.loc[plot_df_with_random_effects['NPI'] == npi]
-            sns.lineplot(data   = npi_plot_df,
-                         x      = 'eGFR',
-                         y      = 'Metformin probability',
-                         c      = metformin_color,
-                         alpha  = nonoutlying_alphas[npi_idx],
-                         legend = False,
-                         ax     = ax[2 * row_idx + 1, col_idx])
-            if row_idx == 0 and col_idx == 0:
-                sns.lineplot(data   = npi_plot_df,
-                             x      = 'eGFR',
-                             y      = 'Metformin probability',
-                             c      = metformin_color,
-                             alpha  = nonoutlying_alphas[npi_idx],
-                             legend = False,
-                             ax     = indiv_ax)
-        
-        for npi_idx in range(len(config.outlying_npis)):
-            npi_plot_df = plot_df_with_random_effects.loc[plot_df_with_random_effects['NPI'] 
-                                                          == config.outlying_npis[npi_idx]]
-            sns.lineplot(data   = npi_plot_df,
-                         x      = 'eGFR',
-                         y      = 'Metformin probability',
-                         c      = outlying_colors[npi_idx % 2],
-                         legend = False,
-                         ax     = ax[2 * row_idx + 1, col_idx])
-            if row_idx == 0 and col_idx == 0:
-                sns.lineplot(data   = npi_plot_df,
-                             x      = 'eGFR',
-                             y      = 'Metformin probability',
-                             c      = outlying_colors[npi_idx % 2],
-                             legend = False,
-                             ax     = indiv_ax)
-        
-        # plot predictions without random effects
-        logits_without_random_effects  = pred_df_without_npi['category_' + str(category_idx) + '_pred'].values
-        probs_without_random_effects   = 1./(1. + np.exp(-1*logits_without_random_effects))
-        plot_df_without_random_effects = pd.DataFrame(data    = {'eGFR': egfr_vals_to_plot,
-                                                                 'Metformin probability': probs_without_random_effects},
-                                                      columns = ['eGFR', 'Metformin probability'])
-        sns.lineplot(data   = plot_df_without_random_effects,
-                     x      = 'eGFR',
-                     y      = 'Metformin probability',
-                     c      = 'black',
-                     legend = False,
-                     ax     = ax[2 * row_idx + 1, col_idx])
+        # plot predictions with random effects for all other providers, then outlying providers and without random effects
+        # the first category is also drawn on the stand-alone plot from the same curves
+        outlying_segments = compute_curve_segments(egfr_vals_to_plot,
+                                                   logits_with_random_effects[category_idx],
+                                                   outlying_npi_idxs[outlying_npi_mask])
+        general_segments  = compute_curve_segments(egfr_vals_to_plot,
+                                                   logits_without_random_effects[category_idx:category_idx + 1],
+                                                   slice(None))
+        line_axes = [ax[2 * row_idx + 1, col_idx]]
         if row_idx == 0 and col_idx == 0:
-            sns.lineplot(data   = plot_df_without_random_effects,
-                         x      = 'eGFR',
-                         y      = 'Metformin probability',
-                         c      = 'black',
-                         legend = False,
-                         ax     = indiv_ax)
+            line_axes.append(indiv_ax)
+        for line_ax in line_axes:
+            draw_curves(line_ax,
+                        nonoutlying_segments[category_idx],
+                        nonoutlying_colors,
+                        render_mode,
+                        rasterize)
+            draw_curves(line_ax,
+                        outlying_segments,
+                        outlying_line_colors[outlying_npi_mask],
+                        'lineplot')
+            draw_curves(line_ax,
+                        general_segments,
+                        to_rgba_array('black'),
+                        'lineplot')
+            line_ax.set_xlabel('eGFR')
+            line_ax.set_ylabel('Metformin probability')
         
         ax[2 * row_idx, col_idx].set_title(category_titles[category_idx])
         ax[2 * row_idx, col_idx].set_xlim([egfr_min, egfr_max + 1])
@@ -266,12 +332,48 @@ def plot_treatment_policy_vs_egfr():
 
     indiv_ax.legend(handles = line_legend_handles, loc = 'lower center')
     
+    # rasterized curves are written at 300 dpi, the rest of the pdfs stay vector
     fig.tight_layout()
-    fig.savefig(config.output_dir + 'treatment_policy_plot.pdf')
+    fig.savefig(config.output_dir + 'treatment_policy_plot.pdf',
+                dpi = 300)
 
     indiv_fig.tight_layout()
-    indiv_fig.savefig(config.output_dir + 'single_category_treatment_policy_plot.pdf')
+    indiv_fig.savefig(config.output_dir + 'single_category_treatment_policy_plot.pdf',
+                      dpi = 300)
     
 if __name__ == '__main__':
     
-    plot_treatment_policy_vs_egfr()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description = 'Plot treatment policy vs eGFR.')
+    parser.add_argument('--from_csv',
+                        action  = 'store_true',
+                        default = None,
+                        help    = 'Specify to read predictions written by make_predictions_for_plots.R. '
+                                  + 'Defaults to this only if the best models were not fit in Python.')
+    parser.add_argument('--memmap',
+                        action  = 'store_true',
+                        default = False,
+                        help    = 'Specify to hold predictions for every provider in category_npi_logits.npy in output_dir '
+                                  + 'instead of memory.')
+    parser.add_argument('--render_mode',
+                        action  = 'store',
+                        type    = str,
+                        default = 'collection',
+                        help    = 'Specify collection to draw all other providers in each panel as one artist '
+                                  + 'or lineplot to draw one artist per provider.')
+    parser.add_argument('--rasterize',
+                        action  = 'store_true',
+                        default = False,
+                        help    = 'Specify to rasterize the curves of all other providers in the pdfs.')
+    parser.add_argument('--num_workers',
+                        action  = 'store',
+                        type    = int,
+                        default = 1,
+                        help    = 'Specify number of threads computing the curves of the category panels.')
+    args = parser.parse_args()
+    
+    with instrument_stage('plot_treatment_policy_vs_egfr.py'):
+        plot_treatment_policy_vs_egfr(args.from_csv,
+                                      config.output_dir + 'category_npi_logits.npy' if args.memmap else None,
+                                      args.render_mode,
+                                      args.rasterize,
+                                      args.num_workers)
\ No newline at end of file
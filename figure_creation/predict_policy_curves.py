@@ -0,0 +1,160 @@
+import os
+import sys
+from os.path import dirname, abspath
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+sys.path.append(dirname(dirname(abspath(__file__))) + '/regression_modeling')
+import config
+from cohort_data import load_cohort_data
+from analysis_setup import compute_standardization, compute_standardized_features, compute_knot_positions, \
+    build_feature_matrix, load_feature_transforms
+from instrumentation import instrumented, record_rows
+
+# categories of patients in the treatment policy plot
+# No heart failure, F, age 50, treatment date middle between 2013-02-18 and 2015-08-29
+# No heart failure, F, age 70, treatment date middle between 2013-02-18 and 2015-08-29
+# No heart failure, F, age 70, treatment date middle between 2017-09-26 and 2020-10-21
+# No heart failure, M, age 50, treatment date middle between 2013-02-18 and 2015-08-29
+# No heart failure, M, age 70, treatment date middle between 2013-02-18 and 2015-08-29
+# No heart failure, M, age 70, treatment date middle between 2017-09-26 and 2020-10-21
+plot_category_heart_failures  = [0, 0, 0, 0, 0, 0]
+plot_category_sexes           = [0, 0, 0, 1, 1, 1]
+plot_category_ages            = [50, 70, 70, 50, 70, 70]
+plot_category_trt_date_ranges = [['2013-02-18', '2015-08-29'], ['2013-02-18', '2015-08-29'], ['2017-09-26', '2020-10-21'],
+                                 ['2013-02-18', '2015-08-29'], ['2013-02-18', '2015-08-29'], ['2017-09-26', '2020-10-21']]
+
+def get_plot_category_trt_dates():
+    '''
+    Get the middle of the treatment date range of each plot category
+    @return: list of str, dates formatted as %Y-%m-%d
+    '''
+    category_trt_dates = []
+    for trt_date_range in plot_category_trt_date_ranges:
+        ref_datetime          = pd.to_datetime('2000-01-01')
+        range_start_timedelta = pd.to_datetime(trt_date_range[0]) - ref_datetime
+        range_end_timedelta   = pd.to_datetime(trt_date_range[1]) - ref_datetime
+        range_mid_timedelta   = (range_start_timedelta + range_end_timedelta)/2.
+        mid_datetime          = ref_datetime + range_mid_timedelta
+        category_trt_dates.append(mid_datetime.strftime('%Y-%m-%d'))
+    return category_trt_dates
+
+def build_category_grid(egfr_vals_to_plot):
+    '''
+    Build one sample per plot category and eGFR value, categories vary slowest
+    @param egfr_vals_to_plot: numpy array, eGFR values
+    @return: pandas DataFrame with heart_failure, male, age, first_treatment_date, and egfr columns
+    '''
+    num_egfr_vals = len(egfr_vals_to_plot)
+    return pd.DataFrame(data    = {'heart_failure'       : np.repeat(plot_category_heart_failures, num_egfr_vals),
+                                   'male'                : np.repeat(plot_category_sexes, num_egfr_vals),
+                                   'age'                 : np.repeat(plot_category_ages, num_egfr_vals),
+                                   'first_treatment_date': np.repeat(get_plot_category_trt_dates(), num_egfr_vals),
+                                   'egfr'                : np.tile(egfr_vals_to_plot, len(plot_category_sexes))},
+                        columns = ['heart_failure', 'male', 'age', 'first_treatment_date', 'egfr'])
+
+def load_model_coefficients(model_name):
+    '''
+    Load coefficients written by save_coefficients in fit_glms.py or fit_glmms.py
+    @param model_name: str, name of model, starts with glm
+    @return: dict with fixed_terms and fixed_coefs,
+             and random_terms, npis, and random_effects for models with random effects
+    '''
+    with np.load(config.output_dir + 'model_coefficients/' + model_name + '.npz') as coefs:
+        return {key: coefs[key] for key in coefs.files}
+
+def have_model_coefficients():
+    '''
+    Check whether the best models were fit in Python, models fit in R do not save coefficients
+    @return: bool
+    '''
+    coefs_dir = config.output_dir + 'model_coefficients/'
+    return all([os.path.exists(coefs_dir + model_name + '.npz')
+                for model_name in [config.best_model_without_random_effects, config.best_model_with_random_effects]])
+
+@instrumented
+def predict_policy_curves(npis,
+                          memmap_path = None):
+    '''
+    Predict logit of metformin for each plot category over the range of eGFR values in the cohort
+    from the best models without and with random effects, without writing samples to csv
+    Predictions for every provider come from one matrix product of the random effect features and the random effects,
+    so memory is 8 bytes x # categories x # providers x # eGFR values
+    @param npis: numpy array, providers to predict for, in the order of the second axis of the output
+    @param memmap_path: str, path of .npy file to hold the logits with random effects instead of memory, None to keep in memory,
+                        read back with np.load(memmap_path, mmap_mode = 'r')
+    @return: 1. numpy array, eGFR values
+             2. numpy array, # categories x # eGFR values, logits without random effects
+             3. numpy array, # categories x # providers x # eGFR values, logits with random effects for each provider
+    '''
+    # normalize and place knots as when the models were fit,
+    # recomputed from the cohort if the models were fit before the transforms were saved
+    standardization, knot_positions = load_feature_transforms()
+    if standardization is None:
+        sample_df = load_cohort_data(columns = ['egfr', 'age', 'first_treatment_date'])
+        standardization = compute_standardization(sample_df)
+        knot_positions  = compute_knot_positions(compute_standardized_features(sample_df, standardization),
+                                                 standardization)
+    else:
+        sample_df = load_cohort_data(columns = ['egfr'])
+    record_rows(len(sample_df))
+    egfr_vals_to_plot = np.arange(sample_df['egfr'].min(), sample_df['egfr'].max() + 1)
+    del sample_df
+
+    grid_df = build_category_grid(egfr_vals_to_plot)
+    num_categories = len(plot_category_sexes)
+    num_egfr_vals  = len(egfr_vals_to_plot)
+    # both models use the same spline bases of the grid
+    basis_cache = dict()
+
+    coefs_without_random_effects = load_model_coefficients(config.best_model_without_random_effects)
+    fixed_logits = build_feature_matrix(grid_df, coefs_without_random_effects['fixed_terms'][1:],
+                                        standardization, knot_positions, basis_cache) \
+                 @ coefs_without_random_effects['fixed_coefs']
+
+    coefs_with_random_effects = load_model_coefficients(config.best_model_with_random_effects)
+    npi_idxs = pd.Index(coefs_with_random_effects['npis']).get_indexer(npis)
+    if np.any(npi_idxs < 0):
+        raise ValueError('No random effects for NPIs ' + ', '.join(map(str, np.asarray(npis)[npi_idxs < 0])))
+    fixed_part_logits = build_feature_matrix(grid_df, coefs_with_random_effects['fixed_terms'][1:],
+                                             standardization, knot_positions, basis_cache) \
+                      @ coefs_with_random_effects['fixed_coefs']
+    random_design     = build_feature_matrix(grid_df, coefs_with_random_effects['random_terms'][1:],
+                                             standardization, knot_positions, basis_cache)
+    random_effects    = coefs_with_random_effects['random_effects'][npi_idxs]
+
+    if memmap_path is None:
+        npi_logits = np.empty((num_categories, len(npis), num_egfr_vals))
+    else:
+        npi_logits = np.lib.format.open_memmap(memmap_path,
+                                               mode  = 'w+',
+                                               shape = (num_categories, len(npis), num_egfr_vals))
+    # one category at a time so a memory map is written without holding the whole tensor
+    for category_idx in range(num_categories):
+        category_rows = slice(category_idx * num_egfr_vals, (category_idx + 1) * num_egfr_vals)
+        npi_logits[category_idx] = random_effects @ random_design[category_rows].T \
+                                 + fixed_part_logits[None, category_rows]
+    if memmap_path is not None:
+        npi_logits.flush()
+    return egfr_vals_to_plot, fixed_logits.reshape(num_categories, num_egfr_vals), npi_logits
+
+def read_category_predictions(num_npis,
+                              num_egfr_vals):
+    '''
+    Read predictions written by make_predictions_for_plots.R for models fit in R
+    @param num_npis: int, number of providers in npi_glrt_pvalues.csv
+    @param num_egfr_vals: int, number of eGFR values
+    @return: 1. numpy array, # categories x # eGFR values, logits without random effects
+             2. numpy array, # categories x # providers x # eGFR values, logits with random effects for each provider
+    '''
+    pred_df_without_npi = pd.read_csv(config.output_dir + 'category_predictions_for_plotting.csv')
+    pred_df_with_npi    = pd.read_csv(config.output_dir + 'category_predictions_with_npis_for_plotting.csv')
+    record_rows(len(pred_df_without_npi) + len(pred_df_with_npi))
+    num_categories = len(plot_category_sexes)
+    # samples with npis were written with npis varying slowest
+    return (np.stack([pred_df_without_npi['category_' + str(category_idx) + '_pred'].values
+                      for category_idx in range(num_categories)]),
+            np.stack([pred_df_with_npi['category_' + str(category_idx) + '_npi_pred'].values.reshape(num_npis, num_egfr_vals)
+                      for category_idx in range(num_categories)]))
@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import functools
+from datetime import datetime
+from contextlib import contextmanager
+
+import config
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# stages running in this process, innermost last, so rows are counted against the stage doing the work
+_active_stages = []
+# stages from the same process share a run id in the report
+_run_id = datetime.now().strftime('%Y%m%dT%H%M%S') + '_' + str(os.getpid())
+
+def get_peak_rss_mb():
+    '''
+    Get the peak resident set size of this process and of its largest finished child process
+    @return: 1. float, peak RSS of this process in MB, None if the resource module is not available
+             2. float, peak RSS of largest child process in MB, None if the resource module is not available
+    '''
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024. * 1024. if sys.platform == 'darwin' else 1024.
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+def get_children_cpu_seconds():
+    '''
+    Get CPU time used by finished child processes, such as the workers of a process pool
+    @return: float, user and system seconds, 0 if the resource module is not available
+    '''
+    if resource is None:
+        return 0.
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def record_rows(num_rows):
+    '''
+    Add to the number of rows processed by the innermost running stage, does nothing outside a stage
+    @param num_rows: int, number of rows
+    @return: None
+    '''
+    if len(_active_stages) > 0:
+        stage = _active_stages[-1]
+        stage['rows_processed'] = (stage['rows_processed'] or 0) + int(num_rows)
+
+def write_run_report(stage):
+    '''
+    Append a stage to run_report.jsonl in output_dir, one json object per line
+    @param stage: dict, stage measurements
+    @return: None
+    '''
+    with open(config.output_dir + 'run_report.jsonl', 'a') as f:
+        f.write(json.dumps(stage) + '\n')
+
+@contextmanager
+def instrument_stage(stage_name,
+                     profile = None):
+    '''
+    Measure wall time, CPU time, peak RSS, and rows processed for the code in the block,
+    and append them to run_report.jsonl in output_dir when the block finishes or fails
+    Peak RSS is the high-water mark of the process, peak_rss_increase_mb is how much this stage raised it
+    CPU time includes child processes that finished during the stage
+    Rows are counted by calling record_rows inside the block
+    @param stage_name: str, name of stage in the report
+    @param profile: bool, whether to write cProfile stats to profiles/{run id}_{stage_name}.prof in output_dir,
+                    defaults to config.profile_stages, nested stages are covered by the profile of the outer stage
+    @return: dict, stage measurements, filled in when the block finishes
+    '''
+    if profile is None:
+        profile = config.profile_stages
+    start_peak_rss_mb, _ = get_peak_rss_mb()
+    stage = {'run_id'        : _run_id,
+             'stage'         : stage_name,
+             'parent_stage'  : _active_stages[-1]['stage'] if len(_active_stages) > 0 else None,
+             'script'        : os.path.basename(sys.argv[0]),
+             'start_time'    : datetime.now().isoformat(timespec = 'seconds'),
+             'status'        : 'running',
+             'rows_processed': None,
+             'profiled'      : False}
+    # only one cProfile profiler can be active at a time
+    profiler = None
+    if profile and not any(active_stage['profiled'] for active_stage in _active_stages):
+        profiler = cProfile.Profile()
+        stage['profiled'] = True
+    _active_stages.append(stage)
+
+    start_wall_time      = time.perf_counter()
+    start_cpu_time       = time.process_time()
+    start_child_cpu_time = get_children_cpu_seconds()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield stage
+        stage['status'] = 'completed'
+    except BaseException:
+        stage['status'] = 'failed'
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        peak_rss_mb, child_peak_rss_mb = get_peak_rss_mb()
+        stage['wall_seconds']         = time.perf_counter() - start_wall_time
+        stage['cpu_seconds']          = time.process_time() - start_cpu_time
+        stage['child_cpu_seconds']    = get_children_cpu_seconds() - start_child_cpu_time
+        stage['peak_rss_mb']          = peak_rss_mb
+        stage['peak_rss_increase_mb'] = peak_rss_mb - start_peak_rss_mb if peak_rss_mb is not None else None
+        stage['child_peak_rss_mb']    = child_peak_rss_mb
+        _active_stages.pop()
+        if profiler is not None:
+            profile_dir = config.output_dir + 'profiles/'
+            if not os.path.exists(profile_dir):
+                os.makedirs(profile_dir)
+            profiler.dump_stats(profile_dir + _run_id + '_' + stage_name + '.prof')
+        write_run_report(stage)
+
+def instrumented(function):
+    '''
+    Decorator that runs each call of a function as an instrumented stage named after the function
+    @param function: function
+    @return: function
+    '''
+    @functools.wraps(function)
+    def instrumented_function(*args, **kwargs):
+        with instrument_stage(function.__name__):
+            return function(*args, **kwargs)
+    return instrumented_function
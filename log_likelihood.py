@@ -0,0 +1,57 @@
+import numpy as np
+
+def compute_log_likelihood_per_sample(logits,
+                                      labels,
+                                      dtype = np.float64,
+                                      out   = None):
+    '''
+    Compute Bernoulli log likelihood of each sample from logits
+    Evaluated as -log(1 + exp(-logit)) for label 1 and -log(1 + exp(logit)) for label 0 with logaddexp,
+    so no probabilities are formed and large logits do not give -inf
+    @param logits: numpy array, # samples or # samples x # models
+    @param labels: numpy array, # samples, binary labels
+    @param dtype: numpy dtype, precision of output if out is not specified, e.g. np.float32 to halve memory
+    @param out: numpy array, optional output array with the same shape as logits,
+                can be logits itself to compute in place
+    @return: numpy array with the same shape as logits
+    '''
+    logits = np.asarray(logits)
+    labels = np.asarray(labels)
+    if labels.ndim < logits.ndim:
+        labels = labels.reshape(labels.shape + (1,) * (logits.ndim - labels.ndim))
+    if out is None:
+        out = np.empty(logits.shape, dtype = dtype)
+    if out is not logits:
+        np.copyto(out, logits, casting = 'same_kind')
+    np.negative(out, out = out, where = np.broadcast_to(labels == 1, out.shape))
+    np.logaddexp(0, out, out = out)
+    np.negative(out, out = out)
+    return out
+
+def compute_log_likelihood(logits,
+                           labels,
+                           dtype     = np.float64,
+                           chunksize = 1000000):
+    '''
+    Compute Bernoulli log likelihood summed over samples
+    Rows are processed in chunks with one reused buffer, so only chunksize x # models temporaries are allocated
+    @param logits: numpy array, # samples or # samples x # models
+    @param labels: numpy array, # samples, binary labels
+    @param dtype: numpy dtype, precision of per-sample computations, sums are accumulated in float64
+    @param chunksize: int, number of rows processed at a time
+    @return: float if logits is 1-dimensional, otherwise numpy array with log likelihood of each model
+    '''
+    logits = np.asarray(logits)
+    labels = np.asarray(labels)
+    buffer = np.empty((min(chunksize, len(logits)),) + logits.shape[1:], dtype = dtype)
+    log_likelihood = np.zeros(logits.shape[1:])
+    for chunk_start in range(0, len(logits), chunksize):
+        chunk_logits = logits[chunk_start:chunk_start + chunksize]
+        chunk_out    = buffer[:len(chunk_logits)]
+        compute_log_likelihood_per_sample(chunk_logits,
+                                          labels[chunk_start:chunk_start + chunksize],
+                                          out = chunk_out)
+        log_likelihood += np.sum(chunk_out, axis = 0, dtype = np.float64)
+    if logits.ndim == 1:
+        return float(log_likelihood)
+    return log_likelihood
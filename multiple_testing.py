@@ -0,0 +1,126 @@
+import numpy as np
+
+qvalue_methods = ['bh', 'by', 'storey']
+
+def sort_p_values(p_values):
+    '''
+    Sort p-values once so the sorted shard can be saved and merged with shards from other runs
+    @param p_values: numpy array, p-values in row order
+    @return: 1. numpy array, p-values in increasing order
+             2. numpy array, row of each sorted p-value
+    '''
+    p_values = np.asarray(p_values, dtype = np.float64)
+    assert np.all(np.logical_and(p_values >= 0, p_values <= 1))
+    order = np.argsort(p_values, kind = 'stable')
+    return p_values[order], order
+
+def merge_sorted_shards(sorted_shards):
+    '''
+    Merge shards of sorted p-values, such as the tests for several cohorts or years
+    The stable sort finds the sorted runs, so merging k shards of n p-values takes O(n log k)
+    @param sorted_shards: list of numpy arrays, each sorted in increasing order
+    @return: 1. numpy array, all p-values in increasing order
+             2. numpy array, shard of each merged p-value
+             3. numpy array, position of each merged p-value in its shard
+    '''
+    shard_ids       = np.repeat(np.arange(len(sorted_shards)), [len(shard) for shard in sorted_shards])
+    shard_positions = np.concatenate([np.arange(len(shard)) for shard in sorted_shards])
+    p_values        = np.concatenate(sorted_shards)
+    merged_order    = np.argsort(p_values, kind = 'stable')
+    return p_values[merged_order], shard_ids[merged_order], shard_positions[merged_order]
+
+def estimate_pi0(sorted_p_values,
+                 lambda_threshold = .5):
+    '''
+    Estimate the proportion of true null hypotheses as in Storey (2002)
+    from the p-values above lambda_threshold, which are mostly from null hypotheses
+    If no p-value is above lambda_threshold, the estimate would be 0 and every q-value 0,
+    so 1 is returned instead and Storey q-values are the same as Benjamini-Hochberg
+    @param sorted_p_values: numpy array, p-values in increasing order
+    @param lambda_threshold: float, p-values above this are counted
+    @return: float, greater than 0 and at most 1
+    '''
+    num_tests = len(sorted_p_values)
+    if num_tests == 0:
+        return 1.
+    num_above = num_tests - np.searchsorted(sorted_p_values, lambda_threshold, side = 'right')
+    if num_above == 0:
+        return 1.
+    pi0 = min(1., num_above / (num_tests * (1. - lambda_threshold)))
+    assert pi0 > 0
+    return pi0
+
+def compute_sorted_qvalues(sorted_p_values,
+                           method           = 'bh',
+                           lambda_threshold = .5):
+    '''
+    Compute q-values for p-values that are already sorted, without copying them more than once
+    q-value of the i-th smallest p-value is the minimum over j >= i of p_(j) x # tests / j,
+    multiplied by sum_k 1/k for Benjamini-Yekutieli or by the estimated proportion of true nulls for Storey
+    @param sorted_p_values: numpy array, p-values in increasing order
+    @param method: str, bh for Benjamini-Hochberg, by for Benjamini-Yekutieli under arbitrary dependence,
+                   or storey for Storey's q-values
+    @param lambda_threshold: float, threshold for estimating the proportion of true nulls with storey
+    @return: numpy array, q-values in the same order
+    '''
+    if method not in qvalue_methods:
+        raise ValueError('method must be one of ' + ', '.join(qvalue_methods))
+    num_tests = len(sorted_p_values)
+    ranks     = np.arange(1, num_tests + 1, dtype = np.float64)
+    qvalues   = np.asarray(sorted_p_values, dtype = np.float64) * num_tests / ranks
+    if method == 'by':
+        qvalues *= np.sum(1. / ranks)
+    elif method == 'storey':
+        qvalues *= estimate_pi0(sorted_p_values, lambda_threshold)
+    # running minimum from the largest p-value down makes q-values monotone in the p-values
+    qvalues = np.minimum.accumulate(qvalues[::-1])[::-1]
+    np.minimum(qvalues, 1., out = qvalues)
+    return qvalues
+
+def compute_qvalues(p_values,
+                    method           = 'bh',
+                    lambda_threshold = .5):
+    '''
+    Compute q-values in the original row order
+    @param p_values: numpy array, p-values in row order
+    @param method: str, bh, by, or storey, see compute_sorted_qvalues
+    @param lambda_threshold: float, threshold for estimating the proportion of true nulls with storey
+    @return: numpy array, q-value of each row
+    '''
+    sorted_p_values, order = sort_p_values(p_values)
+    qvalues = np.empty(len(order), dtype = np.float64)
+    qvalues[order] = compute_sorted_qvalues(sorted_p_values,
+                                            method,
+                                            lambda_threshold)
+    return qvalues
+
+def compute_shard_qvalues(p_value_shards,
+                          method           = 'bh',
+                          lambda_threshold = .5,
+                          sort_orders      = None):
+    '''
+    Compute q-values over the hypotheses of all shards together, such as per-provider tests in several cohorts,
+    and return them in the row order of each shard
+    @param p_value_shards: list of numpy arrays, p-values of each shard in row order,
+                           or in increasing order if sort_orders is specified
+    @param method: str, bh, by, or storey, see compute_sorted_qvalues
+    @param lambda_threshold: float, threshold for estimating the proportion of true nulls with storey
+    @param sort_orders: list of numpy arrays, row of each sorted p-value from sort_p_values,
+                        to reuse shards that were sorted in separate runs
+    @return: list of numpy arrays, q-values of each shard in row order
+    '''
+    if sort_orders is None:
+        sorted_shards, sort_orders = zip(*[sort_p_values(p_values) for p_values in p_value_shards])
+    else:
+        sorted_shards = p_value_shards
+    merged_p_values, shard_ids, shard_positions = merge_sorted_shards(sorted_shards)
+    merged_qvalues = compute_sorted_qvalues(merged_p_values,
+                                            method,
+                                            lambda_threshold)
+    # rows of all shards laid end to end, so every q-value is written back in one pass
+    shard_offsets = np.concatenate(([0], np.cumsum([len(sort_order) for sort_order in sort_orders])))
+    sorted_idxs   = shard_offsets[shard_ids] + shard_positions
+    merged_rows   = shard_offsets[shard_ids] + np.concatenate(sort_orders)[sorted_idxs]
+    qvalues = np.empty(len(merged_qvalues), dtype = np.float64)
+    qvalues[merged_rows] = merged_qvalues
+    return np.split(qvalues, shard_offsets[1:-1])
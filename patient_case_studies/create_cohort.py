@@ -1,14 +1,16 @@
 import os
 import sys
+import logging
 import argparse
 from os.path import dirname, abspath
 
-import pandas as pd
 import sqlalchemy
 
 sys.path.append(dirname(dirname(abspath(__file__))))
 import config
+from cohort_data import load_cohort_data
 from utils import session_scope, create_sql_engine
+from instrumentation import instrument_stage
 
 def create_case_study_csv():
     '''
@@ -18,7 +20,7 @@ def create_case_study_csv():
     output_subdir = config.output_dir + 'case_studies/'
     if not os.path.exists(output_subdir):
         os.makedirs(output_subdir)
-    sample_df     = pd.read_csv(config.data_dir + 't2dm_cohort_data_frequent_prv_only.csv')
+    sample_df     = load_cohort_data()
     columns       = ['person_id', 'first_treatment_date', 'metformin', 'npi', 'egfr', 'heart_failure', 'age', 'male', 'race']
     case_study_patients_df = sample_df.loc[sample_df['npi'].isin(set(config.outlying_npis))][columns]
     case_study_file_name   = output_subdir + 'case_study_patients.csv'
@@ -55,7 +57,9 @@ if __name__ == '__main__':
                         type    = str,
                         help    = 'Specify schema name to create tables in.')
     args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO)
 
-    create_case_study_csv()
-    create_empty_cohort_table(args.database_name,
-                              args.schema_name)
\ No newline at end of file
+    with instrument_stage('create_cohort.py'):
+        create_case_study_csv()
+        create_empty_cohort_table(args.database_name,
+                                  args.schema_name)
\ No newline at end of file
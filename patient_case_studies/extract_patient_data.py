@@ -15,7 +15,9 @@ from omop_learn.omop import OMOPDataset
 from omop_learn.backends.postgres import PostgresBackend
 
 sys.path.append(dirname(dirname(abspath(__file__))))
-import config_private as config
+import config
+from utils import get_connect_args
+from instrumentation import instrument_stage, instrumented, record_rows
 
 def extract_omop_dataset(database_name,
                          t2dm_schema):
@@ -34,7 +36,7 @@ def extract_omop_dataset(database_name,
                      "datasets_dir" : omop_dir,
                      "path"         : "postgresql://localhost/" + str(database_name)}
     omop_config   = Config(config_params)
-    connect_args  = {"host": '/var/run/postgresql/'}
+    connect_args  = get_connect_args()
     omop_backend  = PostgresBackend(omop_config, connect_args)
 
     # extract cohort
@@ -42,7 +44,7 @@ def extract_omop_dataset(database_name,
                      "schema_name"      : t2dm_schema}
     sql_dir = "sql/"
     omop_cohort   = Cohort.from_prebuilt(omop_backend, params = cohort_params)
-    print("omop_v" + str(omop_version) + " cohort has " + str(len(omop_cohort)) + " patients")
+    print(database_name + " cohort has " + str(len(omop_cohort)) + " patients")
     
     # extract features
     feature_paths = [sql_dir + "drugs.sql", 
@@ -64,6 +66,7 @@ def extract_omop_dataset(database_name,
     }
     omop_dataset = OMOPDataset(**omop_dataset_args)
     
+@instrumented
 def write_features_to_file(database_name,
                            schema_name):
     '''
@@ -91,6 +94,7 @@ def write_features_to_file(database_name,
             visits       = patient_data['visits']
             dates        = patient_data['dates']
             patient_dates_to_visits[person_id] = {dates[i]: visits[i] for i in range(len(visits))}
+    record_rows(len(patient_dates_to_visits))
 
     for person_id in patient_dates_to_visits:
         person_dates  = sorted(patient_dates_to_visits[person_id])[::-1]
@@ -120,10 +124,7 @@ def write_features_to_file(database_name,
             for concept in set(patient_dates_to_visits[person_id][date]):
                 if concept is not None:
                     person_output += concept + '\n'
-        if databases != 'both':
-            output_file = output_subdir + str(person_id) + '_' + databases + '_concepts.txt'
-        else:
-            output_file = output_subdir + str(person_id) + '_concepts.txt'
+        output_file = output_subdir + str(person_id) + '_' + database_name + '_concepts.txt'
         with open(output_file, 'w') as f:
             f.write(person_output)
             
@@ -140,5 +141,6 @@ if __name__ == '__main__':
                         help    = 'Specify schema name that contains cohort table for case studies.')
     args = parser.parse_args()
     
-    write_features_to_file(args.database_name,
-                           args.schema_name)
\ No newline at end of file
+    with instrument_stage('extract_patient_data.py'):
+        write_features_to_file(args.database_name,
+                               args.schema_name)
\ No newline at end of file
@@ -0,0 +1,203 @@
+import os
+import re
+import sys
+import json
+from os.path import dirname, abspath
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+import config
+from cohort_data import load_cohort_data
+
+# Use suggested knot positions in terms of quantiles from Harrell (2001)
+knot_quantiles = {3: [.1, .5, .9],
+                  4: [.05, .35, .65, .95],
+                  5: [.05, .275, .5, .725, .95],
+                  6: [.05, .23, .41, .59, .77, .95]}
+
+# Also try 5 knots for eGFR at inflection points where changes are known to occur based on kidney disease stages
+egfr_stage_splits = [30, 45, 60, 75, 90]
+
+# spline feature names are {normalized column}_knot{i}of{number of knots}
+spline_term_pattern = re.compile(r'^(.+)_knot(\d+)of(\d+)$')
+
+def convert_dates_to_days(dates):
+    '''
+    Convert dates to number of days since 1970-01-01, matching numeric value of dates in R
+    @param dates: pandas Series or numpy array, dates as strings or datetimes
+    @return: numpy array of floats
+    '''
+    return pd.to_datetime(dates).values.astype('datetime64[D]').astype(np.float64)
+
+def compute_standardization(df):
+    '''
+    Compute means and standard deviations used to normalize eGFR, age, and treatment date
+    Matches analysis_setup.R, standard deviations use N - 1 degrees of freedom
+    @param df: pandas DataFrame, contains egfr, age, and first_treatment_date columns
+    @return: dict mapping egfr, age, and trt_date to (mean, standard deviation)
+    '''
+    trt_date_days = convert_dates_to_days(df['first_treatment_date'])
+    return {'egfr'    : (df['egfr'].mean(), df['egfr'].std()),
+            'age'     : (df['age'].mean(),  df['age'].std()),
+            'trt_date': (trt_date_days.mean(), trt_date_days.std(ddof = 1))}
+
+def compute_standardized_features(df,
+                                  standardization):
+    '''
+    Normalize eGFR, age, and treatment date to mean 0 and standard deviation 1 in the training data
+    @param df: pandas DataFrame, contains egfr, age, and first_treatment_date columns
+    @param standardization: dict, output from compute_standardization on training data
+    @return: dict mapping egfr_z, age_z, trt_date_z, and egfr_z_stage to numpy arrays,
+             egfr_z_stage is egfr_z with knots at the kidney disease stages
+    '''
+    mu_egfr,     sd_egfr     = standardization['egfr']
+    mu_age,      sd_age      = standardization['age']
+    mu_trt_date, sd_trt_date = standardization['trt_date']
+    egfr_z = (df['egfr'].values - mu_egfr)/sd_egfr
+    return {'egfr_z'      : egfr_z,
+            'age_z'       : (df['age'].values - mu_age)/sd_age,
+            'trt_date_z'  : (convert_dates_to_days(df['first_treatment_date']) - mu_trt_date)/sd_trt_date,
+            'egfr_z_stage': egfr_z}
+
+def compute_knot_positions(standardized_features,
+                           standardization):
+    '''
+    Compute knot positions in normalized units for each spline feature in the model grid
+    The quantiles for every number of knots are found in one pass over each column
+    @param standardized_features: dict, output from compute_standardized_features on training data
+    @param standardization: dict, output from compute_standardization
+    @return: dict mapping (column name, number of knots) to numpy array of knot positions
+    '''
+    knot_counts    = sorted(knot_quantiles)
+    all_quantiles  = np.concatenate([knot_quantiles[num_knots] for num_knots in knot_counts])
+    split_idxs     = np.cumsum([len(knot_quantiles[num_knots]) for num_knots in knot_counts])[:-1]
+    knot_positions = dict()
+    for col_name in ['egfr_z', 'age_z', 'trt_date_z']:
+        col_knot_positions = np.split(np.quantile(standardized_features[col_name], all_quantiles), split_idxs)
+        for num_knots, positions in zip(knot_counts, col_knot_positions):
+            knot_positions[(col_name, num_knots)] = positions
+    mu_egfr, sd_egfr = standardization['egfr']
+    knot_positions[('egfr_z_stage', 5)] = (np.array(egfr_stage_splits) - mu_egfr)/sd_egfr
+    return knot_positions
+
+def compute_rcs_basis(values,
+                      knot_positions):
+    '''
+    Compute restricted cubic spline basis, matches create_transformed_rcs_features in analysis_setup.R
+    Every basis column is computed in one broadcast over the samples
+    @param values: numpy array, # samples
+    @param knot_positions: numpy array, knot positions in units of values
+    @return: numpy array, # samples x (# knots - 2)
+    '''
+    knot_positions = np.asarray(knot_positions, dtype = np.float64)
+    values         = np.asarray(values, dtype = np.float64)
+    norm_factor    = (knot_positions[-1] - knot_positions[0])**2
+    last_knot_gap  = knot_positions[-1] - knot_positions[-2]
+    cubic_with_last_knot           = np.maximum(values - knot_positions[-1], 0)**3
+    cubic_with_second_to_last_knot = np.maximum(values - knot_positions[-2], 0)**3
+    basis = np.subtract.outer(values, knot_positions[:-2])
+    np.maximum(basis, 0, out = basis)
+    basis **= 3
+    basis -= np.multiply.outer(cubic_with_second_to_last_knot, (knot_positions[-1] - knot_positions[:-2]) / last_knot_gap)
+    basis += np.multiply.outer(cubic_with_last_knot, (knot_positions[-2] - knot_positions[:-2]) / last_knot_gap)
+    basis /= norm_factor
+    return basis
+
+def build_feature_matrix(df,
+                         columns,
+                         standardization,
+                         knot_positions,
+                         basis_cache = None):
+    '''
+    Build design matrix with an intercept and the given features from the cohort columns,
+    the same way for fitting, for predictions for plots, and for scoring new patients
+    Each spline basis is computed once per (feature, number of knots) and shared by every column and model that uses it
+    @param df: pandas DataFrame, contains egfr, age, first_treatment_date, and any other columns in columns
+    @param columns: list of str, features such as egfr_z, heart_failure, or age_z_knot2of5, intercept is implicit
+    @param standardization: dict, output from compute_standardization on training data
+    @param knot_positions: dict, output from compute_knot_positions on training data
+    @param basis_cache: dict mapping (feature, number of knots) to basis for the rows of df,
+                        filled in so later calls on the same rows reuse the bases, None to not keep them
+    @return: numpy array, # samples x (1 + # columns), first column is intercept
+    '''
+    if basis_cache is None:
+        basis_cache = dict()
+    standardized_features = compute_standardized_features(df, standardization)
+    design_matrix = np.empty((len(df), len(columns) + 1))
+    design_matrix[:, 0] = 1.
+    for col_idx, col_name in enumerate(columns):
+        spline_match = spline_term_pattern.match(col_name)
+        if spline_match is not None:
+            feature, knot_idx, num_knots = spline_match.group(1), int(spline_match.group(2)), int(spline_match.group(3))
+            if (feature, num_knots) not in basis_cache:
+                basis_cache[(feature, num_knots)] = compute_rcs_basis(standardized_features[feature],
+                                                                      knot_positions[(feature, num_knots)])
+            design_matrix[:, col_idx + 1] = basis_cache[(feature, num_knots)][:, knot_idx - 1]
+        elif col_name in standardized_features:
+            design_matrix[:, col_idx + 1] = standardized_features[col_name]
+        else:
+            design_matrix[:, col_idx + 1] = df[col_name].values
+    return design_matrix
+
+def save_feature_transforms(standardization,
+                            knot_positions):
+    '''
+    Save the training standardization and knot positions with the model coefficients,
+    so new patients are scored with the features the models were fit on
+    @param standardization: dict, output from compute_standardization
+    @param knot_positions: dict, output from compute_knot_positions
+    @return: None
+    '''
+    coefs_dir = config.output_dir + 'model_coefficients/'
+    if not os.path.exists(coefs_dir):
+        os.makedirs(coefs_dir)
+    transforms_path     = coefs_dir + 'feature_transforms.json'
+    tmp_transforms_path = transforms_path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_transforms_path, 'w') as f:
+        json.dump({'standardization': {col_name: [float(mean), float(sd)]
+                                       for col_name, (mean, sd) in standardization.items()},
+                   'knot_positions' : [{'column'   : col_name,
+                                        'num_knots': num_knots,
+                                        'positions': positions.tolist()}
+                                       for (col_name, num_knots), positions in knot_positions.items()]},
+                  f,
+                  indent = 2)
+    os.replace(tmp_transforms_path, transforms_path)
+
+def load_feature_transforms():
+    '''
+    Load the standardization and knot positions saved with the model coefficients
+    @return: 1. dict, in the format of compute_standardization, None if not saved
+             2. dict, in the format of compute_knot_positions, None if not saved
+    '''
+    transforms_path = config.output_dir + 'model_coefficients/feature_transforms.json'
+    if not os.path.exists(transforms_path):
+        return None, None
+    with open(transforms_path, 'r') as f:
+        transforms = json.load(f)
+    standardization = {col_name: tuple(mean_sd) for col_name, mean_sd in transforms['standardization'].items()}
+    knot_positions  = {(knots['column'], knots['num_knots']): np.array(knots['positions'])
+                       for knots in transforms['knot_positions']}
+    return standardization, knot_positions
+
+def load_analysis_design_matrix(columns):
+    '''
+    Load data including only providers with >= 10 patients and build the design matrix for the given features
+    without adding normalized or spline columns to the cohort
+    @param columns: list of str, features, see build_feature_matrix
+    @return: 1. pandas DataFrame, cohort
+             2. numpy array, # samples x (1 + # columns), first column is intercept
+             3. dict, output from compute_standardization
+             4. dict, output from compute_knot_positions
+    '''
+    df              = load_cohort_data()
+    standardization = compute_standardization(df)
+    knot_positions  = compute_knot_positions(compute_standardized_features(df, standardization),
+                                             standardization)
+    design_matrix   = build_feature_matrix(df,
+                                           columns,
+                                           standardization,
+                                           knot_positions)
+    return df, design_matrix, standardization, knot_positions
@@ -0,0 +1,346 @@
+import os
+import sys
+import argparse
+import tempfile
+from os.path import dirname, abspath
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.optimize import minimize, minimize_scalar
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+import config
+from log_likelihood import compute_log_likelihood
+from analysis_setup import load_analysis_design_matrix, save_feature_transforms
+from model_grid import get_model_specs
+from fit_glms import fit_glm_batch, write_model_outputs, save_coefficients
+from instrumentation import instrument_stage, instrumented
+
+random_effect_families = ['with_random_intercepts', 'with_random_slopes']
+
+def _theta_to_cov_factor(theta,
+                         num_random_effects):
+    '''
+    Convert vector of parameters to lower-triangular relative covariance factor,
+    random effects per npi are cov_factor @ spherical effects with spherical effects ~ N(0, I)
+    @param theta: numpy array, lower-triangular entries in row-major order
+    @param num_random_effects: int, number of random effects per npi
+    @return: numpy array, # random effects x # random effects
+    '''
+    cov_factor = np.zeros((num_random_effects, num_random_effects))
+    cov_factor[np.tril_indices(num_random_effects)] = theta
+    return cov_factor
+
+def _compute_random_effect_blocks(transformed_random_design,
+                                  weights,
+                                  npi_codes,
+                                  num_npis):
+    '''
+    Compute the diagonal blocks of transformed Z^T W Z + I, one block per npi since each patient has one npi
+    @param transformed_random_design: numpy array, # samples x # random effects, random design times covariance factor
+    @param weights: numpy array, IRLS weight per sample
+    @param npi_codes: numpy array, integer code of npi per sample
+    @param num_npis: int, number of npis
+    @return: numpy array, # npis x # random effects x # random effects
+    '''
+    num_random_effects = transformed_random_design.shape[1]
+    blocks = np.empty((num_npis, num_random_effects, num_random_effects))
+    for row_idx in range(num_random_effects):
+        for col_idx in range(row_idx + 1):
+            blocks[:, row_idx, col_idx] = np.bincount(npi_codes,
+                                                      weights   = weights * transformed_random_design[:, row_idx]
+                                                                  * transformed_random_design[:, col_idx],
+                                                      minlength = num_npis)
+            blocks[:, col_idx, row_idx] = blocks[:, row_idx, col_idx]
+    blocks += np.eye(num_random_effects)
+    return blocks
+
+def run_pirls(cov_factor,
+              design_matrix,
+              random_design,
+              labels,
+              npi_codes,
+              num_npis,
+              fixed_coefs,
+              spherical_effects,
+              max_iter = 30,
+              tol      = 1e-10):
+    '''
+    Run penalized iteratively reweighted least squares for fixed covariance factor
+    Fixed effects and spherical random effects are updated jointly. Since the random effect blocks are
+    block-diagonal by npi, the joint system is solved with a Schur complement onto the fixed effects,
+    so each iteration is linear in # samples and # npis.
+    @param cov_factor: numpy array, # random effects x # random effects, lower-triangular relative covariance factor
+    @param design_matrix: numpy array, # samples x # fixed effects, first column is intercept
+    @param random_design: numpy array, # samples x # random effects, first column is intercept
+    @param labels: numpy array, binary outcome per sample
+    @param npi_codes: numpy array, integer code of npi per sample from 0 to # npis - 1
+    @param num_npis: int, number of npis
+    @param fixed_coefs: numpy array, initial fixed effect coefficients
+    @param spherical_effects: numpy array, # npis x # random effects, initial spherical random effects
+    @param max_iter: int, maximum number of iterations
+    @param tol: float, relative change in penalized deviance to declare convergence
+    @return: 1. numpy array, fixed effect coefficients
+             2. numpy array, # npis x # random effects, spherical random effects
+             3. float, Laplace approximation to the deviance
+             4. numpy array, logits conditional on random effects
+             5. bool, whether converged
+    '''
+    num_samples, num_random_effects = random_design.shape
+    transformed_random_design = random_design @ cov_factor
+    random_design_matrix = sparse.csr_matrix((transformed_random_design.ravel(),
+                                              (npi_codes[:, None] * num_random_effects
+                                               + np.arange(num_random_effects)).ravel(),
+                                              np.arange(0, num_samples * num_random_effects + 1, num_random_effects)),
+                                             shape = (num_samples, num_npis * num_random_effects))
+
+    def compute_logits(fixed_coefs, spherical_effects):
+        return design_matrix @ fixed_coefs + random_design_matrix @ spherical_effects.ravel()
+
+    def compute_penalized_deviance(logits, spherical_effects):
+        return -2 * compute_log_likelihood(logits, labels) + np.sum(np.square(spherical_effects))
+
+    logits    = compute_logits(fixed_coefs, spherical_effects)
+    pdev      = compute_penalized_deviance(logits, spherical_effects)
+    converged = False
+    for iter_idx in range(max_iter):
+        probs     = 1./(1. + np.exp(-logits))
+        weights   = np.maximum(probs * (1. - probs), 1e-10)
+        work_resp = logits + (labels - probs)/weights
+
+        weighted_design = design_matrix * weights[:, None]
+        fixed_gram      = design_matrix.T @ weighted_design
+        cross_gram      = np.asarray(random_design_matrix.T @ weighted_design).reshape((num_npis, num_random_effects, -1))
+        fixed_resp      = weighted_design.T @ work_resp
+        random_resp     = np.asarray(random_design_matrix.T @ (weights * work_resp)).reshape((num_npis, num_random_effects, 1))
+        blocks          = _compute_random_effect_blocks(transformed_random_design, weights, npi_codes, num_npis)
+
+        blocks_inv_cross_gram  = np.linalg.solve(blocks, cross_gram)
+        blocks_inv_random_resp = np.linalg.solve(blocks, random_resp)[:, :, 0]
+        schur_complement = fixed_gram - np.einsum('gkp,gkq->pq', cross_gram, blocks_inv_cross_gram)
+        new_fixed_coefs  = np.linalg.solve(schur_complement,
+                                           fixed_resp - np.einsum('gkp,gk->p', cross_gram, blocks_inv_random_resp))
+        new_spherical_effects = blocks_inv_random_resp - np.einsum('gkp,p->gk', blocks_inv_cross_gram, new_fixed_coefs)
+
+        # step halving if the penalized deviance increases
+        step_size = 1.
+        for _ in range(10):
+            step_fixed_coefs       = fixed_coefs + step_size * (new_fixed_coefs - fixed_coefs)
+            step_spherical_effects = spherical_effects + step_size * (new_spherical_effects - spherical_effects)
+            step_logits = compute_logits(step_fixed_coefs, step_spherical_effects)
+            step_pdev   = compute_penalized_deviance(step_logits, step_spherical_effects)
+            if step_pdev <= pdev * (1 + 1e-12):
+                break
+            step_size /= 2.
+        fixed_coefs, spherical_effects, logits = step_fixed_coefs, step_spherical_effects, step_logits
+        pdev_change = np.abs(pdev - step_pdev)/(np.abs(step_pdev) + .1)
+        pdev        = step_pdev
+        if pdev_change < tol:
+            converged = True
+            break
+
+    probs   = 1./(1. + np.exp(-logits))
+    weights = np.maximum(probs * (1. - probs), 1e-10)
+    blocks  = _compute_random_effect_blocks(transformed_random_design, weights, npi_codes, num_npis)
+    laplace_deviance = pdev + np.sum(np.linalg.slogdet(blocks)[1])
+    return fixed_coefs, spherical_effects, laplace_deviance, logits, converged
+
+def fit_glmm(design_matrix,
+             random_design,
+             labels,
+             npi_codes,
+             num_npis):
+    '''
+    Fit logistic regression with correlated random effects grouped by npi using the Laplace approximation,
+    fixed effects are estimated in the penalized IRLS step as with nAGQ = 0 in glmer
+    @param design_matrix: numpy array, # samples x # fixed effects, first column is intercept
+    @param random_design: numpy array, # samples x # random effects, first column is intercept
+    @param labels: numpy array, binary outcome per sample
+    @param npi_codes: numpy array, integer code of npi per sample from 0 to # npis - 1
+    @param num_npis: int, number of npis
+    @return: dict with keys
+             1. fixed_coefs: numpy array, fixed effect coefficients
+             2. random_effects: numpy array, # npis x # random effects, conditional modes of random effects
+             3. cov_factor: numpy array, relative covariance factor
+             4. logits: numpy array, logits conditional on random effects
+             5. deviance: float, Laplace approximation to the deviance
+             6. converged: bool
+    '''
+    num_random_effects = random_design.shape[1]
+    init_fixed_coefs, _ = fit_glm_batch(design_matrix,
+                                        labels,
+                                        np.arange(design_matrix.shape[1])[None, :])
+    # warm start each evaluation of the deviance from the previous mode
+    state = {'fixed_coefs'      : init_fixed_coefs[0],
+             'spherical_effects': np.zeros((num_npis, num_random_effects))}
+
+    def compute_laplace_deviance(theta):
+        cov_factor = _theta_to_cov_factor(np.atleast_1d(theta), num_random_effects)
+        fixed_coefs, spherical_effects, laplace_deviance, _, _ \
+            = run_pirls(cov_factor,
+                        design_matrix,
+                        random_design,
+                        labels,
+                        npi_codes,
+                        num_npis,
+                        state['fixed_coefs'],
+                        state['spherical_effects'])
+        state['fixed_coefs']       = fixed_coefs
+        state['spherical_effects'] = spherical_effects
+        return laplace_deviance
+
+    if num_random_effects == 1:
+        result = minimize_scalar(compute_laplace_deviance,
+                                 bounds = (0., 10.),
+                                 method = 'bounded')
+        theta  = np.atleast_1d(result.x)
+    else:
+        init_theta = np.eye(num_random_effects)[np.tril_indices(num_random_effects)]
+        diag_mask  = np.equal(*np.tril_indices(num_random_effects))
+        result     = minimize(compute_laplace_deviance,
+                              init_theta,
+                              method  = 'L-BFGS-B',
+                              bounds  = [(0., None) if is_diag else (None, None) for is_diag in diag_mask],
+                              options = {'eps': 1e-5})
+        theta      = result.x
+
+    cov_factor = _theta_to_cov_factor(theta, num_random_effects)
+    fixed_coefs, spherical_effects, laplace_deviance, logits, converged \
+        = run_pirls(cov_factor,
+                    design_matrix,
+                    random_design,
+                    labels,
+                    npi_codes,
+                    num_npis,
+                    state['fixed_coefs'],
+                    state['spherical_effects'])
+    return {'fixed_coefs'   : fixed_coefs,
+            'random_effects': spherical_effects @ cov_factor.T,
+            'cov_factor'    : cov_factor,
+            'logits'        : logits,
+            'deviance'      : laplace_deviance,
+            'converged'     : converged and result.success}
+
+def _fit_glmm_from_file(design_matrix_file,
+                        fixed_column_idxs,
+                        random_column_idxs,
+                        labels,
+                        npi_codes,
+                        num_npis):
+    '''
+    Worker for the process pool, memory maps the shared design matrix instead of copying it to each worker
+    @param design_matrix_file: str, path to .npy file with intercept and all feature columns
+    @param fixed_column_idxs: list of int, columns of design matrix used as fixed effects
+    @param random_column_idxs: list of int, columns of design matrix used as random effects
+    @param labels: numpy array, binary outcome per sample
+    @param npi_codes: numpy array, integer code of npi per sample
+    @param num_npis: int, number of npis
+    @return: output from fit_glmm
+    '''
+    design_matrix = np.load(design_matrix_file, mmap_mode = 'r')
+    return fit_glmm(np.ascontiguousarray(design_matrix[:, fixed_column_idxs]),
+                    np.ascontiguousarray(design_matrix[:, random_column_idxs]),
+                    labels,
+                    npi_codes,
+                    num_npis)
+
+@instrumented
+def fit_models_with_random_effects(families      = ('with_random_intercepts', 'with_random_slopes'),
+                                   max_num_knots = 6,
+                                   num_workers   = 1):
+    '''
+    Fit models with random intercepts or random slopes per npi in the grid from write_R_script_to_fit_models.py
+    Write logits to model_predictions.csv, number of parameters to glm_num_params.csv,
+    and coefficients and random effects per npi to model_coefficients/
+    @param families: tuple of str, model families to fit, from random_effect_families
+    @param max_num_knots: int, skip knot settings with more knots than this
+    @param num_workers: int, number of processes, each fits one model at a time
+    @return: None
+    '''
+    if len(families) == 0 or not set(families) <= set(random_effect_families):
+        raise ValueError('families must be from ' + ', '.join(random_effect_families))
+    model_specs = [model_spec for model_spec in get_model_specs(max_num_knots)
+                   if model_spec['family'] in families]
+    columns     = sorted(set(term for model_spec in model_specs
+                             for term in model_spec['fixed_terms'] + model_spec['random_terms']))
+    column_ids  = {col_name: col_idx + 1 for col_idx, col_name in enumerate(columns)}
+    df, design_matrix, standardization, knot_positions = load_analysis_design_matrix(columns)
+    labels      = df['metformin'].values
+    npi_codes, unique_npis = pd.factorize(df['npi'], sort = True)
+    num_npis    = len(unique_npis)
+    fixed_column_idxs  = [[0] + [column_ids[term] for term in model_spec['fixed_terms']]  for model_spec in model_specs]
+    random_column_idxs = [[0] + [column_ids[term] for term in model_spec['random_terms']] for model_spec in model_specs]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        design_matrix_file = os.path.join(tmp_dir, 'design_matrix.npy')
+        np.save(design_matrix_file, design_matrix)
+        del design_matrix
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers = num_workers) as executor:
+                results = list(executor.map(_fit_glmm_from_file,
+                                            [design_matrix_file for _ in model_specs],
+                                            fixed_column_idxs,
+                                            random_column_idxs,
+                                            [labels for _ in model_specs],
+                                            [npi_codes for _ in model_specs],
+                                            [num_npis for _ in model_specs]))
+        else:
+            results = [_fit_glmm_from_file(design_matrix_file, fixed_idxs, random_idxs, labels, npi_codes, num_npis)
+                       for fixed_idxs, random_idxs in zip(fixed_column_idxs, random_column_idxs)]
+
+    predictions = dict()
+    for model_spec, result in zip(model_specs, results):
+        model_name = model_spec['model_name']
+        if not result['converged']:
+            print('Warning: ' + model_name + ' did not converge')
+        predictions[model_name] = result['logits']
+        save_coefficients(model_name,
+                          model_spec['fixed_terms'],
+                          result['fixed_coefs'],
+                          random_terms   = np.array(['(Intercept)'] + model_spec['random_terms']),
+                          npis           = np.asarray(unique_npis),
+                          random_effects = result['random_effects'],
+                          cov_factor     = result['cov_factor'])
+    save_feature_transforms(standardization,
+                            knot_positions)
+
+    model_names   = [model_spec['model_name'] for model_spec in model_specs]
+    prediction_df = pd.DataFrame(data    = predictions,
+                                 columns = model_names)
+    num_params_df = pd.DataFrame(data    = {'model_name': model_names,
+                                            'num_params': [model_spec['num_params'] for model_spec in model_specs]},
+                                 columns = ['model_name', 'num_params'])
+    write_model_outputs(prediction_df,
+                        num_params_df)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Fit models with random effects per provider.')
+    parser.add_argument('--families',
+                        action  = 'store',
+                        type    = str,
+                        default = 'with_random_intercepts,with_random_slopes',
+                        help    = 'Specify comma-separated model families: with_random_intercepts, with_random_slopes.')
+    parser.add_argument('--max_num_knots',
+                        action  = 'store',
+                        type    = int,
+                        default = 6,
+                        help    = 'Specify maximum number of knots per feature. Use 4 to only fit models considered in model selection.')
+    parser.add_argument('--num_workers',
+                        action  = 'store',
+                        type    = int,
+                        default = 1,
+                        help    = 'Specify number of processes for fitting models.')
+    args = parser.parse_args()
+    families = tuple(family for family in args.families.split(',') if family != '')
+    unknown_families = [family for family in families if family not in random_effect_families]
+    if len(families) == 0 or len(unknown_families) > 0:
+        parser.error('--families must be from ' + ', '.join(random_effect_families)
+                     + ', got ' + (', '.join(unknown_families) if len(unknown_families) > 0 else 'none'))
+
+    with instrument_stage('fit_glmms.py'):
+        fit_models_with_random_effects(families,
+                                       args.max_num_knots,
+                                       args.num_workers)
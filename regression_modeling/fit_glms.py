@@ -0,0 +1,226 @@
+import os
+import sys
+import argparse
+import tempfile
+from os.path import dirname, abspath
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+import config
+from log_likelihood import compute_log_likelihood
+from analysis_setup import load_analysis_design_matrix, save_feature_transforms
+from model_grid import get_model_specs
+from instrumentation import instrument_stage, instrumented
+
+def fit_glm_batch(design_matrix,
+                  labels,
+                  column_idxs,
+                  max_iter  = 25,
+                  tol       = 1e-8,
+                  chunksize = 50000):
+    '''
+    Fit logistic regression models that use the same number of columns with iteratively reweighted least squares
+    All models in the batch are updated together: each chunk of rows is gathered once per iteration
+    and the weighted Gram matrices for every model are accumulated with a single batched matrix product.
+    Initialization and convergence criterion match glm in R
+    @param design_matrix: numpy array, # samples x # columns, shared by all models
+    @param labels: numpy array, binary outcome per sample
+    @param column_idxs: numpy array, # models x # parameters, columns of design matrix used by each model
+    @param max_iter: int, maximum number of IRLS iterations
+    @param tol: float, relative change in deviance to declare convergence
+    @param chunksize: int, number of rows processed at a time to bound memory
+    @return: 1. numpy array, # models x # parameters, coefficients
+             2. numpy array of bools, whether each model converged
+    '''
+    num_samples = design_matrix.shape[0]
+    num_models, num_params = column_idxs.shape
+    labels      = labels.astype(np.float64)
+    coefs       = np.zeros((num_models, num_params))
+    deviances   = np.full(num_models, np.inf)
+    converged   = np.zeros(num_models, dtype = bool)
+    for iter_idx in range(max_iter):
+        gram_matrices  = np.zeros((num_models, num_params, num_params))
+        weighted_resps = np.zeros((num_models, num_params))
+        new_deviances  = np.zeros(num_models)
+        for chunk_start in range(0, num_samples, chunksize):
+            chunk_design = design_matrix[chunk_start:chunk_start + chunksize][:, column_idxs].transpose(1, 0, 2)
+            chunk_labels = labels[chunk_start:chunk_start + chunksize]
+            if iter_idx == 0:
+                chunk_probs  = np.broadcast_to((chunk_labels + .5)/2., (num_models, len(chunk_labels)))
+                chunk_logits = np.log(chunk_probs/(1. - chunk_probs))
+            else:
+                chunk_logits = np.matmul(chunk_design, coefs[:, :, None])[:, :, 0]
+                chunk_probs  = 1./(1. + np.exp(-chunk_logits))
+                new_deviances -= 2 * compute_log_likelihood(chunk_logits.T, chunk_labels)
+            chunk_weights   = np.maximum(chunk_probs * (1. - chunk_probs), 1e-10)
+            chunk_work_resp = chunk_weights * chunk_logits + chunk_labels - chunk_probs
+            weighted_design = chunk_design * chunk_weights[:, :, None]
+            gram_matrices  += np.matmul(weighted_design.transpose(0, 2, 1), chunk_design)
+            weighted_resps += np.matmul(chunk_design.transpose(0, 2, 1), chunk_work_resp[:, :, None])[:, :, 0]
+        if iter_idx > 0:
+            converged |= np.abs(new_deviances - deviances)/(np.abs(new_deviances) + .1) < tol
+            deviances  = new_deviances
+            if np.all(converged):
+                break
+        new_coefs = np.linalg.solve(gram_matrices, weighted_resps[:, :, None])[:, :, 0]
+        coefs     = np.where(converged[:, None], coefs, new_coefs)
+    return coefs, converged
+
+def _fit_glm_batch_from_file(design_matrix_file,
+                             labels,
+                             column_idxs,
+                             chunksize):
+    '''
+    Worker for the process pool, memory maps the shared design matrix instead of copying it to each worker
+    @param design_matrix_file: str, path to .npy file with design matrix
+    @param labels: numpy array, binary outcome per sample
+    @param column_idxs: numpy array, # models x # parameters
+    @param chunksize: int, number of rows processed at a time
+    @return: output from fit_glm_batch
+    '''
+    design_matrix = np.load(design_matrix_file, mmap_mode = 'r')
+    return fit_glm_batch(design_matrix,
+                         labels,
+                         column_idxs,
+                         chunksize = chunksize)
+
+def write_model_outputs(prediction_df,
+                        num_params_df):
+    '''
+    Write model logits to model_predictions.csv and number of parameters to glm_num_params.csv
+    If the files already exist, e.g. from fitting the other model families, replace or add the new columns and rows
+    @param prediction_df: pandas DataFrame, logits, one column per model, rows match t2dm_cohort_data_frequent_prv_only.csv
+    @param num_params_df: pandas DataFrame, model_name and num_params columns
+    @return: None
+    '''
+    predictions_file = config.output_dir + 'model_predictions.csv'
+    num_params_file  = config.output_dir + 'glm_num_params.csv'
+    if os.path.exists(predictions_file):
+        existing_prediction_df = pd.read_csv(predictions_file)
+        existing_prediction_df = existing_prediction_df.loc[:, ~existing_prediction_df.columns.str.startswith('Unnamed')]
+        assert len(existing_prediction_df) == len(prediction_df)
+        for model_name in prediction_df.columns:
+            existing_prediction_df[model_name] = prediction_df[model_name].values
+        prediction_df = existing_prediction_df
+    if os.path.exists(num_params_file):
+        existing_num_params_df = pd.read_csv(num_params_file)
+        existing_num_params_df = existing_num_params_df.loc[~existing_num_params_df['model_name'].isin(set(num_params_df['model_name']))]
+        num_params_df = pd.concat((existing_num_params_df, num_params_df))
+    prediction_df.to_csv(predictions_file,
+                         index = False)
+    num_params_df.to_csv(num_params_file,
+                         index = False)
+
+def save_coefficients(model_name,
+                      fixed_terms,
+                      fixed_coefs,
+                      **random_effects):
+    '''
+    Save fitted coefficients so predictions can be made without refitting
+    @param model_name: str, name of model, starts with glm
+    @param fixed_terms: list of str, names of fixed effect columns, intercept is implicit and first
+    @param fixed_coefs: numpy array, fixed effect coefficients starting with intercept
+    @param random_effects: numpy arrays, optional random effect terms, npis, and conditional modes
+    @return: None
+    '''
+    coefs_dir = config.output_dir + 'model_coefficients/'
+    if not os.path.exists(coefs_dir):
+        os.makedirs(coefs_dir)
+    np.savez(coefs_dir + model_name + '.npz',
+             fixed_terms = np.array(['(Intercept)'] + list(fixed_terms)),
+             fixed_coefs = fixed_coefs,
+             **random_effects)
+
+@instrumented
+def fit_models_without_random_effects(max_num_knots = 6,
+                                      num_workers   = 1,
+                                      chunksize     = 50000):
+    '''
+    Fit every model without random effects in the grid from write_R_script_to_fit_models.py
+    Models with the same number of parameters are fit together in one batch,
+    batches are spread across a process pool
+    Write logits to model_predictions.csv, number of parameters to glm_num_params.csv,
+    and coefficients to model_coefficients/
+    @param max_num_knots: int, skip knot settings with more knots than this
+    @param num_workers: int, number of processes
+    @param chunksize: int, number of rows processed at a time
+    @return: None
+    '''
+    model_specs = [model_spec for model_spec in get_model_specs(max_num_knots)
+                   if model_spec['family'] == 'without_random_effects']
+    columns     = sorted(set(term for model_spec in model_specs for term in model_spec['fixed_terms']))
+    column_ids  = {col_name: col_idx + 1 for col_idx, col_name in enumerate(columns)}
+    df, design_matrix, standardization, knot_positions = load_analysis_design_matrix(columns)
+    labels      = df['metformin'].values
+
+    batches = dict() # number of parameters -> list of model specs
+    for model_spec in model_specs:
+        batches.setdefault(len(model_spec['fixed_terms']) + 1, []).append(model_spec)
+    batch_column_idxs = [np.array([[0] + [column_ids[term] for term in model_spec['fixed_terms']]
+                                   for model_spec in batches[num_params]])
+                         for num_params in batches]
+
+    if num_workers > 1:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            design_matrix_file = os.path.join(tmp_dir, 'design_matrix.npy')
+            np.save(design_matrix_file, design_matrix)
+            with ProcessPoolExecutor(max_workers = num_workers) as executor:
+                batch_results = list(executor.map(_fit_glm_batch_from_file,
+                                                  [design_matrix_file for _ in batch_column_idxs],
+                                                  [labels for _ in batch_column_idxs],
+                                                  batch_column_idxs,
+                                                  [chunksize for _ in batch_column_idxs]))
+    else:
+        batch_results = [fit_glm_batch(design_matrix, labels, column_idxs, chunksize = chunksize)
+                         for column_idxs in batch_column_idxs]
+
+    predictions = dict()
+    for batch_specs, column_idxs, (coefs, converged) in zip(batches.values(), batch_column_idxs, batch_results):
+        for model_idx, model_spec in enumerate(batch_specs):
+            model_name = model_spec['model_name']
+            if not converged[model_idx]:
+                print('Warning: ' + model_name + ' did not converge')
+            predictions[model_name] = design_matrix[:, column_idxs[model_idx]] @ coefs[model_idx]
+            save_coefficients(model_name,
+                              model_spec['fixed_terms'],
+                              coefs[model_idx])
+
+    save_feature_transforms(standardization,
+                            knot_positions)
+
+    model_names   = [model_spec['model_name'] for model_spec in model_specs]
+    prediction_df = pd.DataFrame(data    = predictions,
+                                 columns = model_names)
+    num_params_df = pd.DataFrame(data    = {'model_name': model_names,
+                                            'num_params': [model_spec['num_params'] for model_spec in model_specs]},
+                                 columns = ['model_name', 'num_params'])
+    write_model_outputs(prediction_df,
+                        num_params_df)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Fit models without random effects.')
+    parser.add_argument('--max_num_knots',
+                        action  = 'store',
+                        type    = int,
+                        default = 6,
+                        help    = 'Specify maximum number of knots per feature. Use 4 to only fit models considered in model selection.')
+    parser.add_argument('--num_workers',
+                        action  = 'store',
+                        type    = int,
+                        default = 1,
+                        help    = 'Specify number of processes for fitting batches of models.')
+    parser.add_argument('--chunksize',
+                        action  = 'store',
+                        type    = int,
+                        default = 50000,
+                        help    = 'Specify number of rows processed at a time.')
+    args = parser.parse_args()
+
+    with instrument_stage('fit_glms.py'):
+        fit_models_without_random_effects(args.max_num_knots,
+                                          args.num_workers,
+                                          args.chunksize)
@@ -0,0 +1,66 @@
+from itertools import product
+
+egfr_knot_options     = ['0', '3', '4', '5', '5s', '6']
+age_knot_options      = [0, 3, 4, 5, 6]
+trt_date_knot_options = [0, 3, 4, 5, 6]
+
+def get_knot_terms(col_name,
+                   num_knots):
+    '''
+    Get names of restricted cubic spline features for a column
+    @param col_name: str, name of normalized column
+    @param num_knots: int, number of knots, 0 for no spline features
+    @return: list of str
+    '''
+    if num_knots == 0:
+        return []
+    return [col_name + '_knot' + str(knot_idx + 1) + 'of' + str(num_knots) for knot_idx in range(num_knots - 2)]
+
+def get_model_specs(max_num_knots = 6):
+    '''
+    Get specifications for the models in write_R_script_to_fit_models.py,
+    names and number of parameters match glm_num_params.csv
+    @param max_num_knots: int, skip knot settings with more knots than this
+    @return: list of dicts with keys
+             1. model_name: str, name of prediction column, starts with glm
+             2. family: str, without_random_effects, with_random_intercepts, or with_random_slopes
+             3. fixed_terms: list of str, fixed effect columns, intercept is implicit
+             4. random_terms: list of str, random effect columns grouped by npi, intercept is implicit,
+                None for models without random effects
+             5. num_params: int
+    '''
+    model_specs = []
+    for num_egfr_knots, num_age_knots, num_trt_date_knots in product(egfr_knot_options, age_knot_options, trt_date_knot_options):
+        if max(int(num_egfr_knots[0]), num_age_knots, num_trt_date_knots) > max_num_knots:
+            continue
+        setting = 'e' + num_egfr_knots + '_a' + str(num_age_knots) + '_t' + str(num_trt_date_knots)
+        if num_egfr_knots == '5s':
+            egfr_terms = get_knot_terms('egfr_z_stage', 5)
+            random_slope_egfr_num_params = 10
+        else:
+            int_num_egfr_knots = int(num_egfr_knots)
+            egfr_terms = get_knot_terms('egfr_z', int_num_egfr_knots)
+            if int_num_egfr_knots == 0:
+                random_slope_egfr_num_params = 3
+            else:
+                random_slope_egfr_num_params = int(int_num_egfr_knots*(int_num_egfr_knots - 1)/2) + int_num_egfr_knots - 2
+        other_knot_terms = get_knot_terms('age_z', num_age_knots) + get_knot_terms('trt_date_z', num_trt_date_knots)
+
+        model_specs.append({'model_name'  : 'glm_without_random_effects_' + setting,
+                            'family'      : 'without_random_effects',
+                            'fixed_terms' : ['egfr_z', 'age_z', 'trt_date_z', 'heart_failure', 'male']
+                                            + egfr_terms + other_knot_terms,
+                            'random_terms': None,
+                            'num_params'  : 6 + len(egfr_terms) + len(other_knot_terms)})
+        model_specs.append({'model_name'  : 'glm_with_random_intercepts_' + setting,
+                            'family'      : 'with_random_intercepts',
+                            'fixed_terms' : ['egfr_z', 'age_z', 'trt_date_z', 'heart_failure', 'male']
+                                            + egfr_terms + other_knot_terms,
+                            'random_terms': [],
+                            'num_params'  : 7 + len(egfr_terms) + len(other_knot_terms)})
+        model_specs.append({'model_name'  : 'glm_with_random_slopes_' + setting,
+                            'family'      : 'with_random_slopes',
+                            'fixed_terms' : ['age_z', 'trt_date_z', 'heart_failure', 'male'] + other_knot_terms,
+                            'random_terms': ['egfr_z'] + egfr_terms,
+                            'num_params'  : 6 + random_slope_egfr_num_params + len(other_knot_terms)})
+    return model_specs
@@ -1,11 +1,16 @@
 import sys
+import argparse
 from os.path import dirname, abspath
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 
 sys.path.append(dirname(dirname(abspath(__file__))))
 import config
+from cohort_data import load_cohort_data
+from log_likelihood import compute_log_likelihood, compute_log_likelihood_per_sample
+from instrumentation import instrument_stage, instrumented, record_rows
 
 def compute_aic_and_log_likelihood(model_name,
                                    prediction_df,
@@ -20,17 +25,72 @@ def compute_aic_and_log_likelihood(model_name,
     @return: 1. float, AIC
              2. float, log likelihood
     '''
-    model_logits = prediction_df[model_name]
-    model_probs  = 1./(1. + np.exp(-1*model_logits))
-    model_log_likelihood_per_sample = np.where(sample_df['metformin'] == 1, np.log(model_probs), np.log(1 - model_probs))
-    model_log_likelihood = np.sum(model_log_likelihood_per_sample)
+    model_log_likelihood = compute_log_likelihood(prediction_df[model_name].values,
+                                                  sample_df['metformin'].values)
     return 2 * num_params - 2 * model_log_likelihood, model_log_likelihood
     
-def identify_best_models():
+def compute_log_likelihoods_from_chunks(model_names,
+                                        chunksize):
+    '''
+    Compute log likelihood of each model by streaming model_predictions.csv in chunks of rows
+    Only the columns for the requested models are read, and all models in a chunk are scored with one matrix operation,
+    so peak memory is bounded by chunksize x # models
+    @param model_names: list of str, names of columns in model_predictions.csv
+    @param chunksize: int, number of rows to read at a time
+    @return: numpy array, log likelihood of each model
+    '''
+    labels          = load_cohort_data(columns = ['metformin'])['metformin'].values
+    log_likelihoods = np.zeros(len(model_names))
+    chunk_start     = 0
+    for prediction_chunk_df in pd.read_csv(config.output_dir + 'model_predictions.csv',
+                                           usecols   = list(model_names),
+                                           dtype     = {model_name: np.float64 for model_name in model_names},
+                                           chunksize = chunksize):
+        chunk_logits = prediction_chunk_df[list(model_names)].to_numpy(copy = True)
+        chunk_labels = labels[chunk_start:chunk_start + len(chunk_logits)]
+        compute_log_likelihood_per_sample(chunk_logits,
+                                          chunk_labels,
+                                          out = chunk_logits)
+        log_likelihoods += np.sum(chunk_logits, axis = 0)
+        chunk_start     += len(chunk_logits)
+    assert chunk_start == len(labels)
+    return log_likelihoods
+
+def compute_aics_and_log_likelihoods_streaming(model_names,
+                                               model_num_params,
+                                               chunksize   = 100000,
+                                               num_workers = 1):
+    '''
+    Compute AIC and log likelihood for models without loading all predictions into memory
+    Models are split into groups of columns that are scored in parallel by separate processes
+    @param model_names: list of str, names of columns in model_predictions.csv
+    @param model_num_params: list of int, number of parameters in each model
+    @param chunksize: int, number of rows each process reads at a time
+    @param num_workers: int, number of processes
+    @return: 1. numpy array, AIC of each model
+             2. numpy array, log likelihood of each model
+    '''
+    if num_workers > 1:
+        model_name_groups = [list(group) for group in np.array_split(np.array(model_names), num_workers) if len(group) > 0]
+        with ProcessPoolExecutor(max_workers = num_workers) as executor:
+            log_likelihoods = np.concatenate(list(executor.map(compute_log_likelihoods_from_chunks,
+                                                               model_name_groups,
+                                                               [chunksize for _ in model_name_groups])))
+    else:
+        log_likelihoods = compute_log_likelihoods_from_chunks(list(model_names),
+                                                              chunksize)
+    return 2 * np.asarray(model_num_params) - 2 * log_likelihoods, log_likelihoods
+
+@instrumented
+def identify_best_models(chunksize   = None,
+                         num_workers = 1):
     '''
     Print names of models with lowest AIC:
     1. model without random effect
     2. model with random intercept or slope
+    @param chunksize: int, if specified, stream model_predictions.csv in chunks of this many rows
+                      instead of reading the whole file
+    @param num_workers: int, number of processes for scoring groups of models when streaming
     @return: None
     '''
     num_params_df    = pd.read_csv(config.output_dir + 'glm_num_params.csv')
@@ -40,24 +100,35 @@ def identify_best_models():
                                                                 ~num_params_df['model_name'].str.contains('a6'),
                                                                 ~num_params_df['model_name'].str.contains('t5'),
                                                                 ~num_params_df['model_name'].str.contains('t6')))]
-    prediction_df    = pd.read_csv(config.output_dir + 'model_predictions.csv')
-    sample_df        = pd.read_csv(config.data_dir + 't2dm_cohort_data_frequent_prv_only.csv')
     model_names      = num_params_df['model_name'].values
     model_num_params = num_params_df['num_params'].values
     
+    if chunksize is not None:
+        aics, log_likelihoods = compute_aics_and_log_likelihoods_streaming(model_names,
+                                                                           model_num_params,
+                                                                           chunksize,
+                                                                           num_workers)
+        # the predictions are read in the worker processes, so count the rows from the cohort
+        record_rows(len(load_cohort_data(columns = ['metformin'])))
+    else:
+        prediction_df   = pd.read_csv(config.output_dir + 'model_predictions.csv')
+        sample_df       = load_cohort_data()
+        record_rows(len(prediction_df))
+        aics            = []
+        log_likelihoods = []
+        for model_name, num_params in zip(model_names, model_num_params):
+            aic, log_likelihood = compute_aic_and_log_likelihood(model_name,
+                                                                 prediction_df,
+                                                                 sample_df,
+                                                                 num_params)
+            aics.append(aic)
+            log_likelihoods.append(log_likelihood)
+    
     lowest_aic_without_random_effects = float('inf')
     lowest_aic_with_random_effects    = float('inf')
     highest_loglik_without_random_effects = float('-inf')
     highest_loglik_with_random_effects    = float('-inf')
-    aics = []
-    log_likelihoods = []
-    for model_name, num_params in zip(model_names, model_num_params):
-        aic, log_likelihood = compute_aic_and_log_likelihood(model_name,
-                                                             prediction_df,
-                                                             sample_df,
-                                                             num_params)
-        aics.append(aic)
-        log_likelihoods.append(log_likelihood)
+    for model_name, aic, log_likelihood in zip(model_names, aics, log_likelihoods):
         if model_name.startswith('glm_without_random_effects_'):
             if aic < lowest_aic_without_random_effects:
                 best_model_without_random_effects_by_aic    = model_name
@@ -88,4 +159,19 @@ def identify_best_models():
     
 if __name__ == '__main__':
     
-    identify_best_models()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description = 'Identify models with lowest AIC and highest log likelihood.')
+    parser.add_argument('--chunksize',
+                        action  = 'store',
+                        type    = int,
+                        default = None,
+                        help    = 'Specify to stream model predictions in chunks of this many rows instead of loading all at once.')
+    parser.add_argument('--num_workers',
+                        action  = 'store',
+                        type    = int,
+                        default = 1,
+                        help    = 'Specify number of processes for scoring groups of models when streaming.')
+    args = parser.parse_args()
+    
+    with instrument_stage('select_best_models.py'):
+        identify_best_models(args.chunksize,
+                             args.num_workers)
\ No newline at end of file
@@ -6,6 +6,7 @@ import pandas as pd
 
 sys.path.append(dirname(dirname(abspath(__file__))))
 import config
+from instrumentation import instrument_stage
 
 def write_R_script_to_fit_models():
     '''
@@ -119,4 +120,5 @@ def write_R_script_to_fit_models():
     
 if __name__ == '__main__':
     
-    write_R_script_to_fit_models()
\ No newline at end of file
+    with instrument_stage('write_R_script_to_fit_models.py'):
+        write_R_script_to_fit_models()
\ No newline at end of file
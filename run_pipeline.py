@@ -0,0 +1,456 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import subprocess
+from os.path import dirname, abspath
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+repo_dir = dirname(abspath(__file__))
+sys.path.append(repo_dir)
+import config
+from cohort_data import compute_file_hash
+
+# stages in README order
+# script: path of script from repository root, run from its own directory
+# args: command line arguments, {placeholders} are filled from the pipeline arguments
+# code: files besides the script whose contents change the results
+# inputs: files read by the stage, {data_dir} and {output_dir} are filled from config.py
+# config: names of values in config.py that change the results
+# requires_config: names of values in config.py that have to be set by hand from an earlier stage's output
+# outputs: files written by the stage
+# after: stages that change state outside files, such as database tables, that this stage reads
+pipeline_stages = [{'name'           : 'extract_data',
+                    'script'         : 'data_extraction/extract_data.py',
+                    'args'           : ['--database_name={database_name}', '--schema_name={schema_name}',
+                                        '--backend={backend}'],
+                    'code'           : ['utils.py',
+                                        'data_extraction/sql/extract_cohort.sql',
+                                        'data_extraction/sql/extract_covariates.sql'],
+                    'inputs'         : [],
+                    'config'         : [],
+                    'requires_config': [],
+                    'outputs'        : [],
+                    'after'          : []},
+                   {'name'           : 'export_cohort',
+                    'script'         : 'data_extraction/export_cohort.py',
+                    'args'           : ['--database_name={database_name}', '--schema_name={schema_name}',
+                                        '--backend={backend}'],
+                    'code'           : ['utils.py', 'cohort_data.py', 'data_extraction/sql/export_cohort.sql'],
+                    'inputs'         : [],
+                    'config'         : [],
+                    'requires_config': [],
+                    'outputs'        : ['{data_dir}t2dm_cohort_data.csv'],
+                    'after'          : ['extract_data']},
+                   {'name'           : 'compute_cohort_stats',
+                    'script'         : 'data_extraction/compute_cohort_stats.py',
+                    'args'           : ['--database_name={database_name}', '--schema_name={schema_name}',
+                                        '--backend={backend}', '--aggregate_in_database'],
+                    'code'           : ['utils.py',
+                                        'data_extraction/sql/compute_cohort_stats.sql',
+                                        'data_extraction/sql/summarize_distribution.sql',
+                                        'data_extraction/sql/bin_distribution.sql'],
+                    'inputs'         : [],
+                    'config'         : [],
+                    'requires_config': [],
+                    'outputs'        : ['{output_dir}cohort_stats/cohort_stats.txt'],
+                    'after'          : ['extract_data']},
+                   {'name'           : 'run_test_for_egfr_variation',
+                    'script'         : 'variation_tests/run_test_for_egfr_variation.py',
+                    'args'           : [],
+                    'code'           : ['cohort_data.py', 'multiple_testing.py'],
+                    'inputs'         : ['{data_dir}t2dm_cohort_data.csv'],
+                    'config'         : [],
+                    'requires_config': [],
+                    'outputs'        : ['{output_dir}egfr_variation_tests.csv',
+                                        '{output_dir}egfr_contingency_tables.csv'],
+                    'after'          : []},
+                   {'name'           : 'filter_frequent_providers',
+                    'script'         : 'data_extraction/filter_data_with_frequent_providers.py',
+                    'args'           : [],
+                    'code'           : [],
+                    'inputs'         : ['{data_dir}t2dm_cohort_data.csv'],
+                    'config'         : ['min_patients_per_provider'],
+                    'requires_config': [],
+                    'outputs'        : ['{data_dir}t2dm_cohort_data_frequent_prv_only.csv'],
+                    'after'          : []},
+                   {'name'           : 'create_provider_v_egfr_plot',
+                    'script'         : 'figure_creation/create_provider_v_egfr_plot.py',
+                    'args'           : [],
+                    'code'           : ['cohort_data.py'],
+                    'inputs'         : ['{data_dir}t2dm_cohort_data_frequent_prv_only.csv'],
+                    'config'         : ['outlying_npis'],
+                    'requires_config': [],
+                    'outputs'        : ['{output_dir}provider_vs_egfr_plot_subset.pdf'],
+                    'after'          : []},
+                   {'name'           : 'make_graphical_abstract',
+                    'script'         : 'figure_creation/make_graphical_abstract.py',
+                    'args'           : [],
+                    'code'           : ['cohort_data.py'],
+                    'inputs'         : ['{data_dir}t2dm_cohort_data_frequent_prv_only.csv'],
+                    'config'         : [],
+                    'requires_config': [],
+                    'outputs'        : ['{output_dir}provider_vs_egfr_plot_graphical_abstract.pdf'],
+                    'after'          : []},
+                   {'name'           : 'fit_glms',
+                    'script'         : 'regression_modeling/fit_glms.py',
+                    'args'           : ['--max_num_knots={max_num_knots}', '--num_workers={num_fit_workers}'],
+                    'code'           : ['cohort_data.py', 'log_likelihood.py',
+                                        'regression_modeling/analysis_setup.py', 'regression_modeling/model_grid.py'],
+                    'inputs'         : ['{data_dir}t2dm_cohort_data_frequent_prv_only.csv'],
+                    'config'         : [],
+                    'requires_config': [],
+                    'outputs'        : ['{output_dir}model_predictions.csv', '{output_dir}glm_num_params.csv'],
+                    'after'          : []},
+                   # fit_glmms.py adds its columns to the files written by fit_glms.py,
+                   # so it runs after fit_glms instead of reading those files as inputs
+                   {'name'           : 'fit_glmms',
+                    'script'         : 'regression_modeling/fit_glmms.py',
+                    'args'           : ['--max_num_knots={max_num_knots}', '--num_workers={num_fit_workers}'],
+                    'code'           : ['cohort_data.py', 'log_likelihood.py', 'regression_modeling/fit_glms.py',
+                                        'regression_modeling/analysis_setup.py', 'regression_modeling/model_grid.py'],
+                    'inputs'         : ['{data_dir}t2dm_cohort_data_frequent_prv_only.csv'],
+                    'config'         : [],
+                    'requires_config': [],
+                    'outputs'        : ['{output_dir}model_predictions.csv', '{output_dir}glm_num_params.csv'],
+                    'after'          : ['fit_glms']},
+                   {'name'           : 'select_best_models',
+                    'script'         : 'regression_modeling/select_best_models.py',
+                    'args'           : [],
+                    'code'           : ['cohort_data.py', 'log_likelihood.py'],
+                    'inputs'         : ['{data_dir}t2dm_cohort_data_frequent_prv_only.csv',
+                                        '{output_dir}model_predictions.csv', '{output_dir}glm_num_params.csv'],
+                    'config'         : [],
+                    'requires_config': [],
+                    'outputs'        : ['{output_dir}model_aics.csv'],
+                    'after'          : []},
+                   {'name'           : 'perform_glrts',
+                    'script'         : 'variation_tests/run_tests_for_provider_variation.py',
+                    'args'           : [],
+                    'code'           : ['cohort_data.py', 'log_likelihood.py', 'multiple_testing.py',
+                                        'variation_tests/run_test_for_egfr_variation.py'],
+                    'inputs'         : ['{data_dir}t2dm_cohort_data_frequent_prv_only.csv',
+                                        '{output_dir}model_predictions.csv', '{output_dir}glm_num_params.csv'],
+                    'config'         : ['best_model_without_random_effects', 'best_model_with_random_effects'],
+                    'requires_config': ['best_model_without_random_effects', 'best_model_with_random_effects'],
+                    'outputs'        : ['{output_dir}npi_glrt_pvalues.csv'],
+                    'after'          : ['select_best_models']},
+                   {'name'           : 'examine_outlying_providers',
+                    'script'         : 'variation_tests/examine_outlying_providers.py',
+                    'args'           : [],
+                    'code'           : ['cohort_data.py', 'stratification.py'],
+                    'inputs'         : ['{data_dir}t2dm_cohort_data_frequent_prv_only.csv',
+                                        '{output_dir}npi_glrt_pvalues.csv'],
+                    'config'         : ['outlying_npis'],
+                    'requires_config': [],
+                    'outputs'        : ['{output_dir}outlying_provider_category_counts.csv'],
+                    'after'          : []},
+                   {'name'           : 'plot_treatment_policy_vs_egfr',
+                    'script'         : 'figure_creation/plot_treatment_policy_vs_egfr.py',
+                    'args'           : [],
+                    'code'           : ['cohort_data.py', 'stratification.py', 'figure_creation/predict_policy_curves.py',
+                                        'regression_modeling/analysis_setup.py'],
+                    # coefficients and feature transforms are written to model_coefficients/ with model_predictions.csv
+                    'inputs'         : ['{data_dir}t2dm_cohort_data_frequent_prv_only.csv',
+                                        '{output_dir}npi_glrt_pvalues.csv',
+                                        '{output_dir}model_predictions.csv'],
+                    'config'         : ['outlying_npis', 'best_model_without_random_effects', 'best_model_with_random_effects'],
+                    'requires_config': ['best_model_without_random_effects', 'best_model_with_random_effects'],
+                    'outputs'        : ['{output_dir}treatment_policy_plot.pdf',
+                                        '{output_dir}single_category_treatment_policy_plot.pdf'],
+                    'after'          : []}]
+
+# stages that read the database, they are left out when no database is given and the pipeline starts from the csv
+database_stages = ['extract_data', 'export_cohort', 'compute_cohort_stats']
+
+def get_state_path():
+    '''
+    Get path of the file recording the key of each finished stage and the hashes of files
+    @return: str
+    '''
+    return config.output_dir + 'pipeline_state.json'
+
+def load_state():
+    '''
+    Load pipeline state, empty if the pipeline has not run before
+    @return: dict with keys
+             1. stage_keys: dict mapping stage name to key of last successful run
+             2. file_hashes: dict mapping path to dict with size, mtime_ns, and hash
+    '''
+    if not os.path.exists(get_state_path()):
+        return {'stage_keys': dict(), 'file_hashes': dict()}
+    with open(get_state_path(), 'r') as f:
+        return json.load(f)
+
+def save_state(state):
+    '''
+    Write pipeline state, replacing the file so an interrupted write does not lose it
+    @param state: dict, output from load_state
+    @return: None
+    '''
+    tmp_state_path = get_state_path() + '.tmp'
+    with open(tmp_state_path, 'w') as f:
+        json.dump(state, f, indent = 2)
+    os.replace(tmp_state_path, get_state_path())
+
+def get_file_hash(file_path,
+                  state):
+    '''
+    Get hash of file contents, reusing the recorded hash if the size and modification time have not changed
+    @param file_path: str, path to file
+    @param state: dict, output from load_state, hash is recorded here
+    @return: str, hash, or missing if file does not exist
+    '''
+    if not os.path.exists(file_path):
+        return 'missing'
+    file_stat = os.stat(file_path)
+    recorded  = state['file_hashes'].get(file_path)
+    if recorded is not None and recorded['size'] == file_stat.st_size and recorded['mtime_ns'] == file_stat.st_mtime_ns:
+        return recorded['hash']
+    file_hash = compute_file_hash(file_path)
+    state['file_hashes'][file_path] = {'size'    : file_stat.st_size,
+                                       'mtime_ns': file_stat.st_mtime_ns,
+                                       'hash'    : file_hash}
+    return file_hash
+
+def resolve_paths(paths):
+    '''
+    Fill in data_dir and output_dir from config.py
+    @param paths: list of str
+    @return: list of str
+    '''
+    return [path.format(data_dir = config.data_dir, output_dir = config.output_dir) for path in paths]
+
+def resolve_args(stage,
+                 pipeline_args):
+    '''
+    Fill in command line arguments of a stage
+    @param stage: dict, from pipeline_stages
+    @param pipeline_args: dict, values for placeholders in args
+    @return: list of str
+    '''
+    return [arg.format(**pipeline_args) for arg in stage['args']]
+
+def compute_stage_key(stage,
+                      pipeline_args,
+                      upstream_keys,
+                      state):
+    '''
+    Compute key that changes whenever anything the stage's results depend on changes:
+    the script and code files, command line arguments, config values, input file contents,
+    and the keys of the stages it runs after
+    @param stage: dict, from pipeline_stages with paths filled in
+    @param pipeline_args: dict, values for placeholders in args
+    @param upstream_keys: dict mapping names of stages in after to their keys
+    @param state: dict, output from load_state
+    @return: str, hex digest
+    '''
+    code_files = [stage['script']] + stage['code']
+    key_data   = {'code'  : {code_file: get_file_hash(os.path.join(repo_dir, code_file), state) for code_file in code_files},
+                  'args'  : resolve_args(stage, pipeline_args),
+                  'config': {config_name: repr(getattr(config, config_name)) for config_name in stage['config']},
+                  'inputs': {input_file: get_file_hash(input_file, state) for input_file in stage['inputs']},
+                  'after' : upstream_keys}
+    return hashlib.blake2b(json.dumps(key_data, sort_keys = True).encode()).hexdigest()
+
+def get_stage_dependencies(stages):
+    '''
+    Get the stages each stage waits for: stages named in after and stages that write one of its inputs
+    @param stages: list of dicts, from pipeline_stages
+    @return: dict mapping stage name to set of stage names
+    '''
+    stage_names  = set([stage['name'] for stage in stages])
+    dependencies = dict()
+    for stage in stages:
+        dependencies[stage['name']] = set([upstream_name for upstream_name in stage['after'] if upstream_name in stage_names])
+        for upstream_stage in stages:
+            if upstream_stage['name'] != stage['name'] \
+                and len(set(upstream_stage['outputs']) & set(stage['inputs'])) > 0:
+                dependencies[stage['name']].add(upstream_stage['name'])
+    return dependencies
+
+def run_stage(stage,
+              pipeline_args):
+    '''
+    Run the script of a stage from its own directory, writing what it prints to pipeline_logs/{stage}.log in output_dir
+    @param stage: dict, from pipeline_stages
+    @param pipeline_args: dict, values for placeholders in args
+    @return: int, exit code
+    '''
+    log_dir = config.output_dir + 'pipeline_logs/'
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    script_path = os.path.join(repo_dir, stage['script'])
+    with open(log_dir + stage['name'] + '.log', 'w') as log_file:
+        completed = subprocess.run([sys.executable, os.path.basename(script_path)] + resolve_args(stage, pipeline_args),
+                                   cwd    = dirname(script_path),
+                                   stdout = log_file,
+                                   stderr = subprocess.STDOUT)
+    return completed.returncode
+
+def run_pipeline(pipeline_args,
+                 num_workers  = 1,
+                 force_stages = (),
+                 until_stage  = None,
+                 dry_run      = False):
+    '''
+    Run the pipeline stages in dependency order, skipping stages whose key matches their last successful run
+    and whose outputs exist. Stages whose dependencies have finished run concurrently in separate processes.
+    A stage that fails or needs a config value set by hand stops the stages that depend on it.
+    @param pipeline_args: dict, values for placeholders in args,
+                          leave database_name as None to start from t2dm_cohort_data.csv
+    @param num_workers: int, number of stages to run at the same time
+    @param force_stages: list of str, stages to rerun even if they are up to date
+    @param until_stage: str, only run this stage and the stages it depends on
+    @param dry_run: bool, print which stages would run without running them
+    @return: bool, whether every stage finished
+    '''
+    stages = [dict(stage,
+                   inputs  = resolve_paths(stage['inputs']),
+                   outputs = resolve_paths(stage['outputs']))
+              for stage in pipeline_stages
+              if pipeline_args['database_name'] is not None or stage['name'] not in database_stages]
+    dependencies = get_stage_dependencies(stages)
+    if until_stage is not None:
+        if until_stage not in dependencies:
+            raise ValueError(until_stage + ' is not a stage in the pipeline')
+        needed_stages = set([until_stage])
+        stage_queue   = [until_stage]
+        while len(stage_queue) > 0:
+            for upstream_name in dependencies[stage_queue.pop()]:
+                if upstream_name not in needed_stages:
+                    needed_stages.add(upstream_name)
+                    stage_queue.append(upstream_name)
+        stages = [stage for stage in stages if stage['name'] in needed_stages]
+
+    state      = load_state()
+    stage_keys = dict()
+    finished   = set()
+    blocked    = set()
+    running    = dict()
+    # stages that a dry run would run, the stages after them would run too since their inputs would change
+    would_run  = set()
+    with ThreadPoolExecutor(max_workers = num_workers) as executor:
+        while len(finished) + len(blocked) < len(stages):
+            for stage in stages:
+                stage_name = stage['name']
+                if stage_name in finished or stage_name in blocked or stage_name in running.values():
+                    continue
+                if len(dependencies[stage_name] & blocked) > 0:
+                    print(stage_name + ': blocked by ' + ', '.join(sorted(dependencies[stage_name] & blocked)))
+                    blocked.add(stage_name)
+                    continue
+                if not dependencies[stage_name] <= finished:
+                    continue
+                unset_config = [config_name for config_name in stage['requires_config']
+                                if getattr(config, config_name) in ('', [], None)]
+                if len(unset_config) > 0:
+                    print(stage_name + ': set ' + ', '.join(unset_config) + ' in config.py')
+                    blocked.add(stage_name)
+                    continue
+
+                stage_keys[stage_name] = compute_stage_key(stage,
+                                                           pipeline_args,
+                                                           {upstream_name: stage_keys[upstream_name]
+                                                            for upstream_name in stage['after']
+                                                            if upstream_name in stage_keys},
+                                                           state)
+                up_to_date = stage_name not in force_stages \
+                    and len(dependencies[stage_name] & would_run) == 0 \
+                    and state['stage_keys'].get(stage_name) == stage_keys[stage_name] \
+                    and all([os.path.exists(output_file) for output_file in stage['outputs']])
+                if up_to_date:
+                    print(stage_name + ': up to date')
+                    finished.add(stage_name)
+                elif dry_run:
+                    print(stage_name + ': would run')
+                    would_run.add(stage_name)
+                    finished.add(stage_name)
+                else:
+                    print(stage_name + ': running')
+                    running[executor.submit(run_stage, stage, pipeline_args)] = stage_name
+
+            if len(running) == 0:
+                continue
+            done_futures, _ = wait(list(running.keys()),
+                                   return_when = FIRST_COMPLETED)
+            for future in done_futures:
+                stage_name = running.pop(future)
+                if future.result() == 0:
+                    print(stage_name + ': finished')
+                    state['stage_keys'][stage_name] = stage_keys[stage_name]
+                    finished.add(stage_name)
+                else:
+                    print(stage_name + ': failed, see pipeline_logs/' + stage_name + '.log in output directory')
+                    state['stage_keys'].pop(stage_name, None)
+                    blocked.add(stage_name)
+                save_state(state)
+
+    if not dry_run:
+        save_state(state)
+    return len(blocked) == 0
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Run the analysis, skipping stages whose inputs have not changed.')
+    parser.add_argument('--database_name',
+                        action  = 'store',
+                        type    = str,
+                        default = None,
+                        help    = 'Specify name of database to extract cohort from. '
+                                  + 'Leave out to start from t2dm_cohort_data.csv in data_dir.')
+    parser.add_argument('--schema_name',
+                        action  = 'store',
+                        type    = str,
+                        default = None,
+                        help    = 'Specify schema name to create tables in.')
+    parser.add_argument('--backend',
+                        action  = 'store',
+                        type    = str,
+                        default = 'postgres',
+                        help    = 'Specify postgres, or duckdb to run on local OMOP extracts.')
+    parser.add_argument('--max_num_knots',
+                        action  = 'store',
+                        type    = int,
+                        default = 4,
+                        help    = 'Specify maximum number of knots per feature in fitted models.')
+    parser.add_argument('--num_fit_workers',
+                        action  = 'store',
+                        type    = int,
+                        default = 1,
+                        help    = 'Specify number of processes for fitting models.')
+    parser.add_argument('--num_workers',
+                        action  = 'store',
+                        type    = int,
+                        default = 1,
+                        help    = 'Specify number of stages to run at the same time.')
+    parser.add_argument('--force',
+                        action  = 'store',
+                        type    = str,
+                        default = '',
+                        help    = 'Specify comma-separated stages to rerun even if up to date, '
+                                  + 'for example extract_data when the database has new data.')
+    parser.add_argument('--until',
+                        action  = 'store',
+                        type    = str,
+                        default = None,
+                        help    = 'Specify to only run this stage and the stages it depends on.')
+    parser.add_argument('--dry_run',
+                        action  = 'store_true',
+                        default = False,
+                        help    = 'Specify to print which stages would run without running them.')
+    args = parser.parse_args()
+
+    pipeline_args = {'database_name'  : args.database_name,
+                     'schema_name'    : args.schema_name,
+                     'backend'        : args.backend,
+                     'max_num_knots'  : args.max_num_knots,
+                     'num_fit_workers': args.num_fit_workers}
+    succeeded = run_pipeline(pipeline_args,
+                             args.num_workers,
+                             [stage_name for stage_name in args.force.split(',') if stage_name != ''],
+                             args.until,
+                             args.dry_run)
+    if not succeeded:
+        sys.exit(1)
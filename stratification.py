@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+
+def compute_category_codes(values,
+                           categories):
+    '''
+    Number the category of each sample
+    @param values: pandas Series, cohort column
+    @param categories: list of values, or of [start, end] ranges that include both ends and do not overlap,
+                       dates can be given as str
+    @return: numpy array, index of each sample's category in categories, -1 if the sample is in none of them
+    '''
+    if len(categories) > 0 and isinstance(categories[0], (list, tuple)):
+        starts = np.asarray([category[0] for category in categories])
+        ends   = np.asarray([category[1] for category in categories])
+        values = values.values
+        if np.issubdtype(values.dtype, np.datetime64):
+            starts = pd.to_datetime(starts).values.astype(values.dtype)
+            ends   = pd.to_datetime(ends).values.astype(values.dtype)
+        range_order = np.argsort(starts, kind = 'stable')
+        assert np.all(starts[range_order][1:] > ends[range_order][:-1])
+        # the only range a sample can be in is the last one starting at or before it
+        range_idxs = np.searchsorted(starts[range_order], values, side = 'right') - 1
+        codes      = range_order[np.maximum(range_idxs, 0)]
+        return np.where(np.logical_and(range_idxs >= 0, values <= ends[codes]), codes, -1)
+    codes = pd.Index(categories).get_indexer(values)
+    return codes
+
+def build_stratification_index(sample_df,
+                               strata):
+    '''
+    Encode the stratum of each sample as one integer, formed by a category of each strata column
+    Each column is read once, so any number of strata is indexed in one pass
+    @param sample_df: pandas DataFrame, cohort
+    @param strata: list of tuples of column name and categories, see compute_category_codes,
+                   such as [('male', [0, 1]), ('age', [[45, 54], [65, 74]])]
+    @return: 1. numpy array, stratum of each sample from 0 to # strata - 1, -1 if outside every stratum,
+                the category of the last column varies fastest
+             2. tuple of int, number of categories of each column, the product is # strata
+    '''
+    stratum_codes = np.zeros(len(sample_df), dtype = np.int64)
+    outside_mask  = np.zeros(len(sample_df), dtype = bool)
+    for col_name, categories in strata:
+        col_codes     = compute_category_codes(sample_df[col_name], categories)
+        outside_mask |= col_codes < 0
+        stratum_codes = stratum_codes * len(categories) + col_codes
+    stratum_codes[outside_mask] = -1
+    return stratum_codes, tuple(len(categories) for _, categories in strata)
+
+def get_stratum_code(strata,
+                     stratum_categories):
+    '''
+    Get the code build_stratification_index gives a stratum
+    @param strata: list of tuples of column name and categories, see build_stratification_index
+    @param stratum_categories: dict mapping column name to its category in the stratum, a value or [start, end] range
+    @return: int
+    '''
+    return int(np.ravel_multi_index([list(categories).index(stratum_categories[col_name]) for col_name, categories in strata],
+                                    [len(categories) for _, categories in strata]))
+
+def get_stratum_labels(strata):
+    '''
+    Get the category of each strata column for every stratum, in the order of the stratum codes
+    @param strata: list of tuples of column name and categories, see build_stratification_index
+    @return: list of tuples, one category per column
+    '''
+    stratum_idxs = np.unravel_index(np.arange(int(np.prod([len(categories) for _, categories in strata]))),
+                                    [len(categories) for _, categories in strata])
+    return list(zip(*[[categories[idx] for idx in col_idxs] for (_, categories), col_idxs in zip(strata, stratum_idxs)]))
+
+def get_stratum_rows(stratum_codes,
+                     num_strata):
+    '''
+    Group the rows of each stratum with one sort instead of one mask over all samples per stratum
+    @param stratum_codes: numpy array, output from build_stratification_index
+    @param num_strata: int, number of strata
+    @return: list of numpy arrays, rows of each stratum in increasing order
+    '''
+    row_order      = np.argsort(stratum_codes, kind = 'stable')
+    stratum_bounds = np.concatenate(([0], np.cumsum(np.bincount(stratum_codes + 1, minlength = num_strata + 1))))
+    # rows outside every stratum have code -1 and are sorted first
+    return [row_order[stratum_bounds[stratum_idx + 1]:stratum_bounds[stratum_idx + 2]] for stratum_idx in range(num_strata)]
+
+def compute_stratum_counts(stratum_codes,
+                           num_strata,
+                           npi_codes,
+                           num_npis,
+                           labels):
+    '''
+    Count samples with each label from each provider in each stratum in one bincount over the samples
+    @param stratum_codes: numpy array, output from build_stratification_index
+    @param num_strata: int, number of strata
+    @param npi_codes: numpy array, provider of each sample from 0 to num_npis - 1
+    @param num_npis: int, number of providers
+    @param labels: numpy array, 1 if metformin, 0 otherwise
+    @return: numpy array, # strata x # providers x 2, counts of samples with label 0 and with label 1,
+             summing over providers gives the counts of each stratum
+    '''
+    inside_mask = stratum_codes >= 0
+    cell_codes  = (stratum_codes[inside_mask] * num_npis + np.asarray(npi_codes)[inside_mask]) * 2 \
+                + np.asarray(labels)[inside_mask].astype(np.int64)
+    return np.bincount(cell_codes,
+                       minlength = num_strata * num_npis * 2).reshape(num_strata, num_npis, 2)
@@ -1,16 +1,157 @@
+import os
+import time
+import logging
 import sqlalchemy
+import pandas as pd
 from contextlib import contextmanager
+from sqlalchemy import event
 from sqlalchemy.orm import sessionmaker
 
-def create_sql_engine(database_name):
+logger = logging.getLogger(__name__)
+
+# engines and session factories are created once per process and database so connections are pooled across calls
+_engines        = dict()
+_session_makers = dict()
+
+def get_connect_args(statement_timeout = None):
+    '''
+    Get psycopg2 connection arguments for the local postgres server
+    @param statement_timeout: int, seconds after which postgres cancels a statement, None for no limit
+    @return: dict
+    '''
+    connect_args = {"host": '/var/run/postgresql/'}
+    if statement_timeout is not None:
+        connect_args["options"] = '-c statement_timeout=' + str(int(statement_timeout * 1000))
+    return connect_args
+
+def log_query(statement,
+              start_time,
+              row_count):
+    '''
+    Log how long a query took and how many rows it returned or modified
+    @param statement: str, query
+    @param start_time: float, time.perf_counter() when query started
+    @param row_count: int, number of rows, -1 if not known
+    @return: None
     '''
-    Create sqlalchemy engine for postgres database
+    logger.info('%.3f s, %s rows: %s',
+                time.perf_counter() - start_time,
+                row_count if row_count >= 0 else 'unknown',
+                ' '.join(statement.split())[:200])
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    log_query(statement,
+              connection.info['query_start_times'].pop(),
+              cursor.rowcount)
+
+def _create_postgres_engine(database_name,
+                            pool_size,
+                            statement_timeout):
+    '''
+    Create sqlalchemy engine for postgres database reached through the local socket
     @param database_name: str, name of database
+    @param pool_size: int, number of connections kept open in the pool
+    @param statement_timeout: int, seconds after which postgres cancels a statement, None for no limit
     @return: sqlalchemy engine
     '''
     return sqlalchemy.create_engine('postgresql://localhost/' + database_name,
-                                     echo         = False,
-                                     connect_args = {"host": '/var/run/postgresql/'})
+                                    echo          = False,
+                                    pool_size     = pool_size,
+                                    pool_pre_ping = True,
+                                    connect_args  = get_connect_args(statement_timeout))
+
+def _create_duckdb_engine(omop_dir,
+                          pool_size,
+                          statement_timeout):
+    '''
+    Create sqlalchemy engine for an embedded duckdb database over local OMOP extracts
+    Each {table}.parquet, {table}.csv, or {table}/ directory of parquet files in omop_dir is exposed as a view cdm.{table},
+    a table with more than one of these raises ValueError
+    Tables created by the extraction are stored in t2dm_provider_variation.duckdb in omop_dir
+    Requires the duckdb and duckdb_engine packages
+    @param omop_dir: str, path to directory containing OMOP tables
+    @param pool_size: int, number of connections kept open in the pool
+    @param statement_timeout: not supported by duckdb, must be None
+    @return: sqlalchemy engine
+    '''
+    if statement_timeout is not None:
+        raise ValueError('statement_timeout is not supported by the duckdb backend')
+    omop_dir = os.path.abspath(omop_dir)
+    table_readers = dict()
+    table_files   = dict()
+    for file_name in sorted(os.listdir(omop_dir)):
+        file_path = os.path.join(omop_dir, file_name)
+        if file_name.endswith('.parquet'):
+            table_name, reader = file_name[:-len('.parquet')], "read_parquet('" + file_path + "')"
+        elif file_name.endswith('.csv'):
+            table_name, reader = file_name[:-len('.csv')], "read_csv_auto('" + file_path + "')"
+        elif os.path.isdir(file_path):
+            table_name, reader = file_name, "read_parquet('" + os.path.join(file_path, '*.parquet') + "')"
+        else:
+            continue
+        # one view per table, so a second source would silently replace the first
+        if table_name in table_files:
+            raise ValueError('Table ' + table_name + ' has more than one source in ' + omop_dir + ': '
+                             + table_files[table_name] + ' and ' + file_name + '. Keep only one.')
+        table_readers[table_name] = reader
+        table_files[table_name]   = file_name
+    engine   = sqlalchemy.create_engine('duckdb:///' + os.path.join(omop_dir, 't2dm_provider_variation.duckdb'),
+                                        pool_size = pool_size)
+    view_sql = 'CREATE SCHEMA IF NOT EXISTS cdm;\n'
+    for table_name, reader in table_readers.items():
+        view_sql += 'CREATE OR REPLACE VIEW cdm.' + table_name + ' AS SELECT * FROM ' + reader + ';\n'
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.text(view_sql))
+    return engine
+
+# functions that create an engine for each backend, all SQL in this repository runs on these
+sql_backends = {'postgres': _create_postgres_engine,
+                'duckdb'  : _create_duckdb_engine}
+
+def create_sql_engine(database_name,
+                      pool_size         = 5,
+                      statement_timeout = None,
+                      backend           = 'postgres'):
+    '''
+    Get sqlalchemy engine for database
+    Engines are cached per database and statement timeout, so repeated calls share one connection pool
+    Every query run through the engine is logged with its time and row count
+    @param database_name: str, name of database, or path to directory of OMOP extracts for the duckdb backend
+    @param pool_size: int, number of connections kept open in the pool, set to the number of concurrent queries,
+                      the pool is rebuilt if a larger size is requested than the cached engine has
+    @param statement_timeout: int, seconds after which postgres cancels a statement, None for no limit
+    @param backend: str, key in sql_backends
+    @return: sqlalchemy engine
+    '''
+    engine_key = (backend, database_name, statement_timeout)
+    if engine_key in _engines:
+        if _engines[engine_key].pool.size() >= pool_size:
+            return _engines[engine_key]
+        # connections that are checked out stay usable, idle ones are closed
+        _engines[engine_key].dispose()
+    engine = sql_backends[backend](database_name,
+                                   pool_size,
+                                   statement_timeout)
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    _engines[engine_key] = engine
+    return engine
+
+def table_exists(session,
+                 schema_name,
+                 table_name):
+    '''
+    Check whether a table exists on any backend
+    @param session: sqlalchemy session
+    @param schema_name: str, schema
+    @param table_name: str, table
+    @return: bool
+    '''
+    connection = session.connection()
+    return connection.dialect.has_table(connection, table_name, schema = schema_name)
 
 @contextmanager
 def session_scope(engine):
@@ -19,8 +160,9 @@ def session_scope(engine):
     @param engine: sqlalchemy engine
     @return: None
     '''
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    if engine not in _session_makers:
+        _session_makers[engine] = sessionmaker(bind=engine)
+    session = _session_makers[engine]()
 
     try:
         yield session
@@ -29,4 +171,34 @@ def session_scope(engine):
         session.rollback()
         raise
     finally:
-        session.close()
\ No newline at end of file
+        session.close()
+
+def stream_query(engine,
+                 query,
+                 chunksize = 100000):
+    '''
+    Iterate over the result of a query in chunks using a server-side cursor,
+    so result sets larger than memory are never fetched at once
+    @param engine: sqlalchemy engine
+    @param query: str, query
+    @param chunksize: int, number of rows per chunk
+    @return: generator of pandas DataFrames, one empty DataFrame if there are no rows
+    '''
+    start_time = time.perf_counter()
+    row_count  = 0
+    with engine.connect() as connection:
+        result  = connection.execution_options(stream_results = True).execute(sqlalchemy.text(query))
+        columns = list(result.keys())
+        while True:
+            rows = result.fetchmany(chunksize)
+            if len(rows) == 0 and row_count > 0:
+                break
+            row_count += len(rows)
+            # convert decimals to floats as pd.read_sql does
+            yield pd.DataFrame.from_records(rows,
+                                            columns      = columns,
+                                            coerce_float = True)
+            if len(rows) == 0:
+                break
+    # the cursor execute above only opens the server-side cursor, so log again once all rows are fetched
+    log_query(query, start_time, row_count)
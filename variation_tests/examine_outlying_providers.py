@@ -1,54 +1,101 @@
 import sys
+import argparse
 from os.path import dirname, abspath
-from itertools import product
 
 import numpy as np
 import pandas as pd
 
 sys.path.append(dirname(dirname(abspath(__file__))))
 import config
+from cohort_data import load_cohort_data
+from stratification import build_stratification_index, get_stratum_labels, compute_stratum_counts
+from instrumentation import instrument_stage, instrumented, record_rows
 
-def examine_outlying_providers():
+# categories of patients without heart failure in which the outlying providers are compared to all providers
+outlying_provider_strata = [('heart_failure'       , [0]),
+                            ('male'                , [0, 1]),
+                            ('age'                 , [[35, 44], [45, 54], [55, 64], [65, 74], [75, 84]]),
+                            ('first_treatment_date', [['2000-01-01', '2013-03-07'], ['2013-07-07', '2015-11-18'],
+                                                      ['2016-03-18', '2017-10-23'], ['2018-02-23', '2020-11-08'],
+                                                      ['2021-03-08', '2024-01-01']])]
+
+@instrumented
+def examine_outlying_providers(npis = None):
     '''
     Examine patients from outlying providers
+    Counts for every category, provider, and treatment come from one pass over the cohort,
+    so any number of providers can be examined
+    Counts for each category and provider with patients are written to outlying_provider_category_counts.csv in output_dir
+    @param npis: list of int, providers to examine, defaults to config.outlying_npis
+    @return: numpy array, # categories x # providers x 2, number of patients prescribed other and metformin
+             for every provider in the cohort, providers sorted by npi
     '''
-    sample_df = pd.read_csv(config.data_dir + 't2dm_cohort_data_frequent_prv_only.csv')
+    if npis is None:
+        npis = config.outlying_npis
+    sample_df = load_cohort_data()
+    record_rows(len(sample_df))
     columns   = ['person_id', 'first_treatment_date', 'metformin', 'npi', 'egfr', 'heart_failure', 'age', 'male', 'race']
-    for npi in config.outlying_providers:
-        print(sample_df.loc[sample_df['npi'] == npi][columns])
+    npi_codes, unique_npis = pd.factorize(sample_df['npi'], sort = True)
+    unique_npis = np.asarray(unique_npis)
+    # patient profiles are only printed for the providers in config, flagged providers can number in the hundreds
+    for npi_idx in pd.Index(unique_npis).get_indexer(config.outlying_npis):
+        print(sample_df.loc[npi_codes == npi_idx][columns])
     
-    sex_categories = [0, 1]
-    age_categories = [[35, 44], [45, 54], [55, 64], [65, 74], [75, 84]]
-    trt_date_categories = [['2000-01-01', '2013-03-07'], ['2013-07-07', '2015-11-18'],
-                           ['2016-03-18', '2017-10-23'], ['2018-02-23', '2020-11-08'],
-                           ['2021-03-08', '2024-01-01']]
-    sex_labels = ['F', 'M']
+    stratum_codes, strata_shape = build_stratification_index(sample_df, outlying_provider_strata)
+    num_strata      = int(np.prod(strata_shape))
+    stratum_counts  = compute_stratum_counts(stratum_codes,
+                                             num_strata,
+                                             npi_codes,
+                                             len(unique_npis),
+                                             sample_df['metformin'].values)
+    category_counts = stratum_counts.sum(axis = 1)
+    # providers not in the cohort have no patients in any category
+    npi_idxs        = pd.Index(unique_npis).get_indexer(npis)
+    npi_counts      = np.where(npi_idxs[None, :, None] >= 0, stratum_counts[:, npi_idxs, :], 0)
     
+    sex_labels = ['F', 'M']
     print('# patients prescribed metformin, prescribed other, '
           + ', '.join(['NPI ' + str(npi) + ' prescribed metformin, NPI ' + str(npi) + ' prescribed other'
-                       for npi in config.outlying_providers]))
-    for sex, age_range, trt_date_range in product(sex_categories, age_categories, trt_date_categories):
-        category_df = sample_df.loc[np.logical_and.reduce((sample_df['heart_failure'] == 0,
-                                                           sample_df['male'] == sex,
-                                                           sample_df['age'] >= age_range[0],
-                                                           sample_df['age'] <= age_range[1],
-                                                           sample_df['first_treatment_date'] >= trt_date_range[0],
-                                                           sample_df['first_treatment_date'] <= trt_date_range[1]))]
-        category_num_metformin = category_df['metformin'].sum()
-        category_num_other     = len(category_df) - category_num_metformin
-        
-        category_counts = [category_num_metformin, category_num_other]
-        for npi in config.outlying_providers:
-            category_npi_df            = category_df.loc[category_df['npi'] == npi]
-            category_npi_num_metformin = category_npi_df['metformin'].sum()
-            category_npi_num_other     = len(category_npi_df) - category_npi_num_metformin
-            category_counts.extend([category_npi_num_metformin, category_npi_num_other])
-        
-        if np.sum(category_counts[3:]) > 1:
+                       for npi in npis]))
+    for stratum_idx, (_, sex, age_range, trt_date_range) in enumerate(get_stratum_labels(outlying_provider_strata)):
+        if npi_counts[stratum_idx].sum() > 1:
             print('No heart failure, ' + sex_labels[sex] + ', age between ' + str(age_range[0]) + ' and ' + str(age_range[1])
                   + ', treatment date between ' + trt_date_range[0] + ' and ' + trt_date_range[1] + ': '
-                  + ', '.join(map(str, category_counts)))
+                  + ', '.join(map(str, [category_counts[stratum_idx, 1], category_counts[stratum_idx, 0]]
+                                       + npi_counts[stratum_idx, :, ::-1].ravel().tolist())))
+    
+    stratum_idxs, npi_list_idxs = np.nonzero(npi_counts.sum(axis = 2))
+    stratum_labels = get_stratum_labels(outlying_provider_strata)
+    count_df = pd.DataFrame(data    = {'male'                    : [stratum_labels[idx][1] for idx in stratum_idxs],
+                                       'age range'               : ['-'.join(map(str, stratum_labels[idx][2]))
+                                                                    for idx in stratum_idxs],
+                                       'treatment date range'    : [' to '.join(stratum_labels[idx][3])
+                                                                    for idx in stratum_idxs],
+                                       'NPI'                     : np.asarray(npis)[npi_list_idxs],
+                                       'NPI # metformin'         : npi_counts[stratum_idxs, npi_list_idxs, 1],
+                                       'NPI # other'             : npi_counts[stratum_idxs, npi_list_idxs, 0],
+                                       'Category # metformin'    : category_counts[stratum_idxs, 1],
+                                       'Category # other'        : category_counts[stratum_idxs, 0]},
+                            columns = ['male', 'age range', 'treatment date range', 'NPI', 'NPI # metformin', 'NPI # other',
+                                       'Category # metformin', 'Category # other'])
+    count_df.to_csv(config.output_dir + 'outlying_provider_category_counts.csv',
+                    index = False)
+    return stratum_counts
 
 if __name__ == '__main__':
     
-    examine_outlying_providers()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description = 'Examine patients from outlying providers.')
+    parser.add_argument('--flagged',
+                        action  = 'store_true',
+                        default = False,
+                        help    = 'Specify to examine every provider flagged in npi_glrt_pvalues.csv '
+                                  + 'instead of only config.outlying_npis.')
+    args = parser.parse_args()
+    
+    with instrument_stage('examine_outlying_providers.py'):
+        npis = None
+        if args.flagged:
+            npi_df = pd.read_csv(config.output_dir + 'npi_glrt_pvalues.csv')
+            npis   = config.outlying_npis + [npi for npi in npi_df.loc[npi_df['Reject null'] == 1]['NPI'].tolist()
+                                             if npi not in set(config.outlying_npis)]
+        examine_outlying_providers(npis)
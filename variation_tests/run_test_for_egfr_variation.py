@@ -1,26 +1,374 @@
+import sys
+import argparse
+from os.path import dirname, abspath
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+import pandas as pd
+from scipy.special import gammaln
 from scipy.stats import chi2
 
+sys.path.append(dirname(dirname(abspath(__file__))))
+import config
+from cohort_data import load_cohort_data
+from multiple_testing import compute_qvalues
+from instrumentation import instrument_stage, instrumented, record_rows
+
+# eGFR bin edges of Table 1
+egfr_bin_edges = [30, 45, 60, 90]
+# age bands when age is a stratum
+age_bin_edges  = [45, 55, 65, 75]
+# numeric columns that are binned instead of taking each value as its own category
+column_bin_edges = {'egfr': egfr_bin_edges,
+                    'age' : age_bin_edges}
+
+def get_bin_labels(bin_edges):
+    '''
+    Get labels for the bins np.digitize assigns with bin_edges, such as < 30, 30-45, and >= 90
+    @param bin_edges: list of numbers, increasing
+    @return: list of str, # bin edges + 1
+    '''
+    return ['< ' + str(bin_edges[0])] \
+         + [str(bin_start) + '-' + str(bin_end) for bin_start, bin_end in zip(bin_edges[:-1], bin_edges[1:])] \
+         + ['>= ' + str(bin_edges[-1])]
+
+def compute_column_codes(values,
+                         col_name):
+    '''
+    Number the categories of a cohort column
+    Columns in column_bin_edges are binned, dates are grouped by year of treatment, other values are their own category
+    @param values: pandas Series, cohort column
+    @param col_name: str, name of column
+    @return: 1. numpy array, category of each sample from 0 to # categories - 1
+             2. list of str, label of each category
+    '''
+    if col_name in column_bin_edges:
+        assert not values.isna().any()
+        return np.digitize(values.values, column_bin_edges[col_name]), get_bin_labels(column_bin_edges[col_name])
+    if pd.api.types.is_datetime64_any_dtype(values):
+        values = values.dt.year
+    codes, categories = pd.factorize(values, sort = True)
+    assert np.all(codes >= 0)
+    return codes, [str(category) for category in categories]
+
+def build_contingency_tables(sample_df,
+                             row_column     = 'metformin',
+                             column_column  = 'egfr',
+                             strata_columns = ()):
+    '''
+    Count samples in each row and column category for every stratum in one pass over the samples
+    Only strata with samples are kept
+    @param sample_df: pandas DataFrame, cohort
+    @param row_column: str, column whose categories are the table rows, such as treatment
+    @param column_column: str, column whose categories are the table columns, eGFR is binned with egfr_bin_edges
+    @param strata_columns: list of str, columns whose combinations of categories form the strata
+    @return: 1. numpy array, # strata x # row categories x # column categories, counts
+             2. pandas DataFrame, label of each stratum in strata_columns, one row per stratum
+             3. list of str, row labels
+             4. list of str, column labels
+    '''
+    row_codes, row_labels       = compute_column_codes(sample_df[row_column], row_column)
+    column_codes, column_labels = compute_column_codes(sample_df[column_column], column_column)
+    num_rows    = len(row_labels)
+    num_columns = len(column_labels)
+
+    stratum_codes  = np.zeros(len(sample_df), dtype = np.int64)
+    strata_labels  = []
+    for col_name in strata_columns:
+        col_codes, col_labels = compute_column_codes(sample_df[col_name], col_name)
+        stratum_codes = stratum_codes * len(col_labels) + col_codes
+        strata_labels.append(col_labels)
+    stratum_codes, stratum_values = pd.factorize(stratum_codes, sort = True)
+    num_strata = len(stratum_values)
+
+    cell_codes = (stratum_codes * num_rows + row_codes) * num_columns + column_codes
+    tables     = np.bincount(cell_codes,
+                             minlength = num_strata * num_rows * num_columns).reshape(num_strata, num_rows, num_columns)
+
+    # recover the category of each strata column from the combined codes, last column varies fastest
+    stratum_data    = dict()
+    stratum_values  = np.asarray(stratum_values)
+    for col_name, col_labels in reversed(list(zip(strata_columns, strata_labels))):
+        stratum_data[col_name] = np.asarray(col_labels)[stratum_values % len(col_labels)]
+        stratum_values         = stratum_values // len(col_labels)
+    stratum_df = pd.DataFrame(data    = stratum_data,
+                              columns = list(strata_columns),
+                              index   = np.arange(num_strata))
+    return tables, stratum_df, row_labels, column_labels
+
+def compute_chi2_stats(tables):
+    '''
+    Compute Pearson chi-squared statistic for each contingency table
+    Rows and columns without samples are left out of the statistic and the degrees of freedom
+    @param tables: numpy array, ... x # rows x # columns, counts, the leading axes index tables
+    @return: 1. numpy array, shape of the leading axes, chi-squared statistics
+             2. numpy array, shape of the leading axes, degrees of freedom
+    '''
+    tables   = np.asarray(tables, dtype = np.float64)
+    row_sums = tables.sum(axis = -1, keepdims = True)
+    col_sums = tables.sum(axis = -2, keepdims = True)
+    totals   = np.maximum(row_sums.sum(axis = -2, keepdims = True), 1)
+    expected_tables = row_sums * col_sums / totals
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        cell_stats = np.where(expected_tables > 0, np.square(tables - expected_tables) / expected_tables, 0)
+    chi2_stats = cell_stats.sum(axis = (-2, -1))
+    dfs        = np.maximum(np.count_nonzero(row_sums[..., 0] > 0, axis = -1) - 1, 0) \
+               * np.maximum(np.count_nonzero(col_sums[..., 0, :] > 0, axis = -1) - 1, 0)
+    return chi2_stats, dfs
+
 def run_chi2_test(cont_table):
     '''
     Compute chi-squared statistic for contingency table
     @param cont_table: numpy array, contingency table
+    @return: 1. float, chi-squared statistic
+             2. float, p-value
     '''
     assert len(cont_table.shape) == 2
-    row_sums = cont_table.sum(axis = 1, keepdims = True)
-    col_sums = cont_table.sum(axis = 0, keepdims = True)
-    total = cont_table.sum()
-    expected_table = row_sums * col_sums / total
-    chi2_stat = np.sum(np.square(cont_table - expected_table))
-    df = (cont_table.shape[0] - 1) * (cont_table.shape[1] - 1)
+    chi2_stat, df = compute_chi2_stats(cont_table)
     pval = chi2.sf(chi2_stat, df)
     print('Chi-squared statistic: ' + str(chi2_stat))
     print('p-value: ' + str(pval))
+    return float(chi2_stat), float(pval)
+
+def compute_exact_pvalue(table,
+                         max_num_tables = 1000000):
+    '''
+    Compute exact p-value of the chi-squared statistic for a table with 2 rows by enumerating every table with the same margins
+    Under the null the first row is a multivariate hypergeometric draw from the column totals
+    @param table: numpy array, 2 x # columns, counts
+    @param max_num_tables: int, give up when more tables than this have the same margins
+    @return: float, probability of a statistic at least the observed statistic, nan if there are too many tables
+    '''
+    assert table.shape[0] == 2
+    col_sums   = table.sum(axis = 0)
+    row_total  = int(table[0].sum())
+    total      = int(col_sums.sum())
+    # totals of the columns after each column, to drop partial rows that cannot reach row_total
+    rest_sums  = np.concatenate((np.cumsum(col_sums[::-1])[::-1][1:], [0]))
+    first_rows = np.zeros((1, 0), dtype = np.int64)
+    for col_idx, col_sum in enumerate(col_sums):
+        if len(first_rows) * (col_sum + 1) > 10 * max_num_tables:
+            return np.nan
+        first_rows   = np.concatenate((np.repeat(first_rows, col_sum + 1, axis = 0),
+                                       np.tile(np.arange(col_sum + 1), len(first_rows))[:, None]),
+                                      axis = 1)
+        partial_sums = first_rows.sum(axis = 1)
+        first_rows   = first_rows[np.logical_and(partial_sums <= row_total,
+                                                 partial_sums + rest_sums[col_idx] >= row_total)]
+        if len(first_rows) > max_num_tables:
+            return np.nan
+    log_probs = np.sum(gammaln(col_sums + 1) - gammaln(first_rows + 1) - gammaln(col_sums - first_rows + 1), axis = 1) \
+              - (gammaln(total + 1) - gammaln(row_total + 1) - gammaln(total - row_total + 1))
+    enumerated_stats, _ = compute_chi2_stats(np.stack((first_rows, col_sums[None, :] - first_rows), axis = 1))
+    observed_stat, _    = compute_chi2_stats(table)
+    # tables with the same statistic as the observed table should count despite rounding
+    return float(min(1., np.exp(log_probs)[enumerated_stats >= observed_stat * (1. - 1e-10)].sum()))
+
+def simulate_tables(tables,
+                    num_simulations,
+                    rng):
+    '''
+    Draw random tables with the same margins as each table, as if rows and columns were independent
+    Each row is drawn from the column totals left by earlier rows one column at a time with hypergeometric draws,
+    which are vectorized over simulations and tables
+    @param tables: numpy array, # tables x # rows x # columns, counts
+    @param num_simulations: int, number of random tables for each table
+    @param rng: numpy Generator
+    @return: numpy array, # simulations x # tables x # rows x # columns
+    '''
+    num_tables, num_rows, num_columns = tables.shape
+    row_sums  = tables.sum(axis = 2)
+    remaining = np.broadcast_to(tables.sum(axis = 1), (num_simulations, num_tables, num_columns)).copy()
+    simulated_tables = np.empty((num_simulations, num_tables, num_rows, num_columns), dtype = np.int64)
+    for row_idx in range(num_rows - 1):
+        num_needed   = np.broadcast_to(row_sums[:, row_idx], (num_simulations, num_tables)).copy()
+        num_in_later = remaining.sum(axis = 2)
+        for col_idx in range(num_columns - 1):
+            num_in_later -= remaining[:, :, col_idx]
+            cell_counts   = rng.hypergeometric(remaining[:, :, col_idx], num_in_later, num_needed)
+            simulated_tables[:, :, row_idx, col_idx] = cell_counts
+            num_needed   -= cell_counts
+        simulated_tables[:, :, row_idx, num_columns - 1] = num_needed
+        remaining -= simulated_tables[:, :, row_idx]
+    simulated_tables[:, :, num_rows - 1] = remaining
+    return simulated_tables
+
+def run_simulation_batches(tables,
+                           observed_stats,
+                           batch_seeds,
+                           batch_sizes):
+    '''
+    Count how often the chi-squared statistics of random tables are at least the observed statistics
+    Each batch has a random number generator seeded by its own seed,
+    so results do not depend on how batches are split across processes
+    @param tables: numpy array, # strata x # rows x # columns, counts
+    @param observed_stats: numpy array, chi-squared statistic of each stratum
+    @param batch_seeds: list of numpy SeedSequence, one per batch
+    @param batch_sizes: list of int, number of random tables for each stratum in each batch
+    @return: 1. numpy array, number of random statistics at least the observed statistic for each stratum
+             2. int, number of random statistics summed over strata at least the observed sum
+    '''
+    # ties should count as at least as extreme despite rounding
+    stratum_thresholds = observed_stats * (1. - 1e-10)
+    combined_threshold = observed_stats.sum() * (1. - 1e-10)
+    stratum_counts     = np.zeros(len(observed_stats), dtype = np.int64)
+    combined_count     = 0
+    for batch_seed, batch_size in zip(batch_seeds, batch_sizes):
+        simulated_stats, _ = compute_chi2_stats(simulate_tables(tables,
+                                                                batch_size,
+                                                                np.random.default_rng(batch_seed)))
+        stratum_counts += np.sum(simulated_stats >= stratum_thresholds[None, :], axis = 0)
+        combined_count += int(np.sum(simulated_stats.sum(axis = 1) >= combined_threshold))
+    return stratum_counts, combined_count
+
+def compute_monte_carlo_pvalues(tables,
+                                num_simulations = 10000,
+                                num_workers     = 1,
+                                batch_size      = 100,
+                                seed            = 0):
+    '''
+    Compute Monte Carlo p-values of the chi-squared statistic for each stratum
+    and of the statistic summed over strata by drawing tables with the same margins
+    @param tables: numpy array, # strata x # rows x # columns, counts
+    @param num_simulations: int, number of random tables for each stratum
+    @param num_workers: int, number of processes
+    @param batch_size: int, number of random tables for each stratum drawn at once,
+                       memory is about 50 bytes x # strata x # cells x batch_size
+    @param seed: int, seed for random number generator, results are the same for any num_workers
+    @return: 1. numpy array, p-value of each stratum
+             2. float, p-value of the statistic summed over strata
+    '''
+    observed_stats, _ = compute_chi2_stats(tables)
+    batch_sizes = [batch_size] * (num_simulations // batch_size)
+    if num_simulations % batch_size > 0:
+        batch_sizes.append(num_simulations % batch_size)
+    batch_seeds = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+    if num_workers > 1:
+        # tables are small, so they are passed to the workers directly
+        worker_batch_idxs = [idxs for idxs in np.array_split(np.arange(len(batch_sizes)), num_workers * 4) if len(idxs) > 0]
+        with ProcessPoolExecutor(max_workers = num_workers) as executor:
+            worker_results = list(executor.map(run_simulation_batches,
+                                               [tables for _ in worker_batch_idxs],
+                                               [observed_stats for _ in worker_batch_idxs],
+                                               [[batch_seeds[idx] for idx in idxs] for idxs in worker_batch_idxs],
+                                               [[batch_sizes[idx] for idx in idxs] for idxs in worker_batch_idxs]))
+        stratum_counts = np.sum([stratum_counts for stratum_counts, _ in worker_results], axis = 0)
+        combined_count = sum([combined_count for _, combined_count in worker_results])
+    else:
+        stratum_counts, combined_count = run_simulation_batches(tables,
+                                                                observed_stats,
+                                                                batch_seeds,
+                                                                batch_sizes)
+    return (stratum_counts + 1.) / (num_simulations + 1.), (combined_count + 1.) / (num_simulations + 1.)
+
+@instrumented
+def run_egfr_variation_tests(strata_columns  = (),
+                             num_simulations = 0,
+                             max_exact_size  = 100,
+                             num_workers     = 1,
+                             seed            = 0,
+                             file_name       = 't2dm_cohort_data.csv'):
+    '''
+    Test for variation in first-line treatment across eGFR bins within each stratum
+    Writes the tables to egfr_contingency_tables.csv and the tests to egfr_variation_tests.csv in output_dir
+    P-value column is the Monte Carlo p-value if simulated, otherwise the exact p-value where computed,
+    otherwise the chi-squared approximation
+    @param strata_columns: list of str, cohort columns whose combinations form the strata,
+                           age is banded with age_bin_edges and dates by year
+    @param num_simulations: int, number of random tables for Monte Carlo p-values, 0 to skip
+    @param max_exact_size: int, compute exact p-values for strata with at most this many patients
+    @param num_workers: int, number of processes for Monte Carlo p-values
+    @param seed: int, seed for random number generator
+    @param file_name: str, name of cohort csv in data_dir
+    @return: pandas DataFrame, test for each stratum
+    '''
+    sample_df = load_cohort_data(file_name = file_name,
+                                 columns   = ['metformin', 'egfr'] + list(strata_columns))
+    record_rows(len(sample_df))
+    tables, stratum_df, row_labels, column_labels = build_contingency_tables(sample_df,
+                                                                             strata_columns = strata_columns)
+    del sample_df
+
+    table_df = pd.concat([stratum_df.loc[np.repeat(stratum_df.index, len(row_labels))].reset_index(drop = True),
+                          pd.DataFrame(data    = {'metformin': np.tile(row_labels, len(stratum_df))},
+                                       columns = ['metformin']),
+                          pd.DataFrame(data    = tables.reshape(-1, len(column_labels)),
+                                       columns = ['eGFR ' + label for label in column_labels])],
+                         axis = 1)
+    table_df.to_csv(config.output_dir + 'egfr_contingency_tables.csv',
+                    index = False)
+
+    chi2_stats, dfs = compute_chi2_stats(tables)
+    test_df = stratum_df.copy()
+    test_df['Num patients']          = tables.sum(axis = (1, 2))
+    test_df['Chi2 stat']             = chi2_stats
+    test_df['df']                    = dfs
+    test_df['Asymptotic P-value']    = chi2.sf(chi2_stats, dfs)
+    test_df['Exact P-value']         = [compute_exact_pvalue(table) if len(row_labels) == 2 and table.sum() <= max_exact_size
+                                        else np.nan
+                                        for table in tables]
+    p_values = np.where(np.isnan(test_df['Exact P-value'].values),
+                        test_df['Asymptotic P-value'].values,
+                        test_df['Exact P-value'].values)
+    if num_simulations > 0:
+        monte_carlo_pvals, combined_monte_carlo_pval = compute_monte_carlo_pvalues(tables,
+                                                                                   num_simulations,
+                                                                                   num_workers,
+                                                                                   seed = seed)
+        test_df['Monte Carlo P-value'] = monte_carlo_pvals
+        p_values = monte_carlo_pvals
+    test_df['P-value'] = p_values
+    test_df['Q-value'] = compute_qvalues(p_values)
+    test_df.to_csv(config.output_dir + 'egfr_variation_tests.csv',
+                   index = False)
+
+    print('Contingency table summed over strata')
+    print(pd.DataFrame(data    = tables.sum(axis = 0),
+                       index   = ['metformin ' + label for label in row_labels],
+                       columns = ['eGFR ' + label for label in column_labels]))
+    run_chi2_test(tables.sum(axis = 0))
+    if len(strata_columns) > 0:
+        print('Stratified chi-squared statistic summed over ' + str(len(test_df)) + ' strata: ' + str(chi2_stats.sum()))
+        print('Stratified p-value: ' + str(chi2.sf(chi2_stats.sum(), dfs.sum())))
+        if num_simulations > 0:
+            print('Stratified Monte Carlo p-value: ' + str(combined_monte_carlo_pval))
+        print('Strata with variation at 5% false discovery rate: ' + str(int(np.sum(test_df['Q-value'].values <= .05))))
+    return test_df
 
 if __name__ == '__main__':
 
-    contingency_table = # TODO: put number of patients in each eGFR and treatment bin into a 2 x 5 numpy array
-    # these numbers are printed by compute_cohort_stats.py
-    # these are the numbers in Table 1 of the paper
-    
-    run_chi2_test(contingency_table)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description = 'Run chi-squared tests for variation in treatment across eGFR levels.')
+    parser.add_argument('--strata',
+                        action  = 'store',
+                        type    = str,
+                        default = '',
+                        help    = 'Specify comma-separated cohort columns to stratify on, such as male,age,first_treatment_date. '
+                                  + '(age is banded and dates are grouped by year.)')
+    parser.add_argument('--num_simulations',
+                        action  = 'store',
+                        type    = int,
+                        default = 0,
+                        help    = 'Specify number of random tables for Monte Carlo p-values. 0 skips them.')
+    parser.add_argument('--max_exact_size',
+                        action  = 'store',
+                        type    = int,
+                        default = 100,
+                        help    = 'Specify largest number of patients in a stratum for exact p-values.')
+    parser.add_argument('--num_workers',
+                        action  = 'store',
+                        type    = int,
+                        default = 1,
+                        help    = 'Specify number of processes for Monte Carlo p-values.')
+    parser.add_argument('--seed',
+                        action  = 'store',
+                        type    = int,
+                        default = 0,
+                        help    = 'Specify seed for random number generator.')
+    args = parser.parse_args()
+
+    with instrument_stage('run_test_for_egfr_variation.py'):
+        run_egfr_variation_tests([col_name for col_name in args.strata.split(',') if col_name != ''],
+                                 args.num_simulations,
+                                 args.max_exact_size,
+                                 args.num_workers,
+                                 args.seed)
@@ -1,46 +1,311 @@
+import os
 import sys
+import argparse
+import tempfile
 from os.path import dirname, abspath
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
-from scipy.stats import chi2, rankdata, norm
+from scipy.special import expit
+from scipy.stats import chi2, norm
 
 sys.path.append(dirname(dirname(abspath(__file__))))
 import config
+from cohort_data import load_cohort_data
+from log_likelihood import compute_log_likelihood_per_sample
+from multiple_testing import sort_p_values, compute_sorted_qvalues
+from run_test_for_egfr_variation import egfr_bin_edges
+from instrumentation import instrument_stage, instrumented, record_rows
 
 def run_benjamini_hochberg(p_value_df,
-                           fdr = .05):
+                           fdr           = .05,
+                           method        = 'bh',
+                           pvalue_column = 'P-value'):
     '''
     Run Benjamini-Hochberg multiple hypothesis correction 
     to identify which null hypotheses can be rejected while maintaining expected false discovery rate
-    @param p_value_df: pandas dataframe, contains column called 'P-values' with float p-values from hypothesis tests,
-                       will be modified and returned
+    @param p_value_df: pandas dataframe, contains column pvalue_column with float p-values from hypothesis tests,
+                       not modified
     @param fdr: float, desired false discovery rate
-    @return: pandas dataframe indicating which null hypotheses were rejected
+    @param method: str, bh, by, or storey, see multiple_testing.compute_sorted_qvalues
+    @param pvalue_column: str, column with the p-values to correct
+    @return: pandas dataframe with Rank, Critical value, Q-value, and Reject null columns added, sorted by pvalue_column
     '''
-    p_values = p_value_df['P-value'].values
-    assert np.all(np.logical_and(p_values >= 0, p_values <= 1))
     assert fdr >= 0
     assert fdr <= 1
+    sorted_p_values, order = sort_p_values(p_value_df[pvalue_column].values)
+    qvalues = compute_sorted_qvalues(sorted_p_values, method)
     
-    p_value_ranks                  = rankdata(p_values, method = 'min')
-    critical_vals                  = p_value_ranks / float(len(p_values)) * fdr
-    p_value_df['Rank']             = p_value_ranks
-    p_value_df['Critical value']   = critical_vals
-    p_value_df.sort_values(by      = 'Rank',
-                           inplace = True)
-    reject_to_rank                 = p_value_df.loc[p_value_df['P-value'] < p_value_df['Critical value']]['Rank'].max()
-    p_value_df['Reject null']      = np.where(p_value_df['Rank'] <= reject_to_rank, 1, 0)
-    return p_value_df
+    sorted_df = p_value_df.iloc[order].reset_index(drop = True)
+    # tied p-values share the lowest rank
+    sorted_df['Rank']           = np.searchsorted(sorted_p_values, sorted_p_values, side = 'left') + 1
+    sorted_df['Critical value'] = sorted_df['Rank'].values / float(len(sorted_p_values)) * fdr
+    sorted_df['Q-value']        = qvalues
+    sorted_df['Reject null']    = np.where(qvalues <= fdr, 1, 0)
+    return sorted_df
 
-def perform_glrts():
+def compute_npi_glrts(npis,
+                      m1_log_likelihood_per_sample,
+                      m2_log_likelihood_per_sample,
+                      num_params_diff):
+    '''
+    Perform a GLRT for whether each provider differs from general policy
+    Log likelihoods are summed per provider in one pass over the samples
+    @param npis: numpy array, npi of each sample
+    @param m1_log_likelihood_per_sample: numpy array, log likelihood of each sample under model without random effects
+    @param m2_log_likelihood_per_sample: numpy array, log likelihood of each sample under model with random effects
+    @param num_params_diff: int, degrees of freedom for chi-squared distribution
+    @return: pandas dataframe with NPI, G-stat, and P-value columns, sorted by NPI
+    '''
+    npi_codes, unique_npis = pd.factorize(npis, sort = True)
+    npi_gstats = 2 * np.bincount(npi_codes,
+                                 weights   = np.asarray(m2_log_likelihood_per_sample) - np.asarray(m1_log_likelihood_per_sample),
+                                 minlength = len(unique_npis))
+    npi_pvals  = chi2.sf(npi_gstats, df = num_params_diff)
+    return pd.DataFrame(data    = {'NPI'    : np.asarray(unique_npis),
+                                   'G-stat' : npi_gstats,
+                                   'P-value': npi_pvals},
+                        columns = ['NPI', 'G-stat', 'P-value'])
+
+def compute_stratum_codes(sample_df,
+                          strata_columns):
+    '''
+    Number the strata formed by combinations of values in strata_columns, eGFR is binned with egfr_bin_edges
+    @param sample_df: pandas DataFrame, cohort
+    @param strata_columns: list of str, columns in sample_df
+    @return: numpy array, stratum of each sample from 0 to # strata - 1
+    '''
+    stratum_codes = np.zeros(len(sample_df), dtype = np.int64)
+    for col_name in strata_columns:
+        if col_name == 'egfr':
+            col_codes     = np.digitize(sample_df['egfr'].values, egfr_bin_edges)
+            num_col_codes = len(egfr_bin_edges) + 1
+        else:
+            col_codes, col_values = pd.factorize(sample_df[col_name], sort = True)
+            num_col_codes = len(col_values)
+        stratum_codes = stratum_codes * num_col_codes + col_codes
+    return pd.factorize(stratum_codes, sort = True)[0]
+
+def compute_npi_score_stats(prv_codes,
+                            residuals,
+                            variances,
+                            num_prvs):
+    '''
+    Compute score statistic for a random intercept for each provider and across all providers
+    from the residuals of the model without random effects:
+    (sum of residuals)^2 / sum of variances for each provider, summed over providers for the global statistic
+    The first axis of residuals and variances can index permutations
+    @param prv_codes: numpy array, provider of each sample from 0 to num_prvs - 1
+    @param residuals: numpy array, # samples or # permutations x # samples, label minus predicted probability
+    @param variances: numpy array, same shape as residuals, predicted probability x (1 - predicted probability)
+    @param num_prvs: int, number of providers
+    @return: 1. numpy array, # providers or # permutations x # providers, statistic for each provider
+             2. float or numpy array over permutations, global statistic
+    '''
+    is_single  = np.ndim(residuals) == 1
+    residuals  = np.atleast_2d(residuals)
+    variances  = np.atleast_2d(variances)
+    num_rows   = residuals.shape[0]
+    # offset the provider codes of each permutation so one bincount sums every permutation
+    flat_codes = (np.arange(num_rows)[:, None] * num_prvs + prv_codes[None, :]).ravel()
+    residual_sums = np.bincount(flat_codes,
+                                weights   = residuals.ravel(),
+                                minlength = num_rows * num_prvs).reshape(num_rows, num_prvs)
+    variance_sums = np.bincount(flat_codes,
+                                weights   = variances.ravel(),
+                                minlength = num_rows * num_prvs).reshape(num_rows, num_prvs)
+    npi_stats = np.square(residual_sums) / variance_sums
+    if is_single:
+        return npi_stats[0], npi_stats[0].sum()
+    return npi_stats, npi_stats.sum(axis = 1)
+
+def run_permutation_batches(prv_codes,
+                            probabilities,
+                            labels,
+                            stratum_bounds,
+                            observed_npi_stats,
+                            observed_global_stat,
+                            batch_seeds,
+                            batch_sizes,
+                            method = 'permutation'):
+    '''
+    Count how often the resampled statistics are at least the observed statistics
+    Each batch resamples batch_size data sets at once with a random number generator seeded by its own seed,
+    so results do not depend on how batches are split across processes
+    @param prv_codes: numpy array, provider of each sample, samples sorted by stratum
+    @param probabilities: numpy array, predicted probability of metformin from model without random effects
+    @param labels: numpy array, 1 if metformin
+    @param stratum_bounds: numpy array, # strata + 1, samples in stratum s are at stratum_bounds[s]:stratum_bounds[s+1]
+    @param observed_npi_stats: numpy array, statistic for each provider
+    @param observed_global_stat: float, global statistic
+    @param batch_seeds: list of numpy SeedSequence, one per batch
+    @param batch_sizes: list of int, number of resampled data sets in each batch
+    @param method: str, permutation to shuffle samples between providers within strata,
+                   bootstrap to draw labels from the model without random effects
+    @return: 1. numpy array, number of resampled statistics at least the observed statistic for each provider
+             2. int, number of resampled global statistics at least the observed global statistic
+    '''
+    num_prvs       = len(observed_npi_stats)
+    residuals      = labels - probabilities
+    variances      = probabilities * (1. - probabilities)
+    # ties from providers with identical samples should count as at least as extreme despite rounding
+    npi_thresholds = observed_npi_stats * (1. - 1e-10)
+    npi_counts     = np.zeros(num_prvs, dtype = np.int64)
+    global_count   = 0
+    for batch_seed, batch_size in zip(batch_seeds, batch_sizes):
+        rng = np.random.default_rng(batch_seed)
+        if method == 'permutation':
+            sample_idxs = np.empty((batch_size, len(prv_codes)), dtype = np.int64)
+            for stratum_start, stratum_end in zip(stratum_bounds[:-1], stratum_bounds[1:]):
+                sample_idxs[:, stratum_start:stratum_end] \
+                    = rng.permuted(np.broadcast_to(np.arange(stratum_start, stratum_end),
+                                                   (batch_size, stratum_end - stratum_start)),
+                                   axis = 1)
+            batch_npi_stats, batch_global_stats = compute_npi_score_stats(prv_codes,
+                                                                          residuals[sample_idxs],
+                                                                          variances[sample_idxs],
+                                                                          num_prvs)
+        elif method == 'bootstrap':
+            batch_labels = rng.random((batch_size, len(prv_codes))) < probabilities[None, :]
+            batch_npi_stats, batch_global_stats = compute_npi_score_stats(prv_codes,
+                                                                          batch_labels - probabilities[None, :],
+                                                                          np.broadcast_to(variances,
+                                                                                          batch_labels.shape),
+                                                                          num_prvs)
+        else:
+            raise ValueError('method must be permutation or bootstrap')
+        npi_counts   += np.sum(batch_npi_stats >= npi_thresholds[None, :], axis = 0)
+        global_count += int(np.sum(batch_global_stats >= observed_global_stat * (1. - 1e-10)))
+    return npi_counts, global_count
+
+def _run_permutation_batches_from_files(array_dir,
+                                        observed_npi_stats,
+                                        observed_global_stat,
+                                        batch_seeds,
+                                        batch_sizes,
+                                        method):
+    '''
+    Worker for the process pool, memory maps the shared sample arrays instead of copying them to each worker
+    @param array_dir: str, directory with prv_codes.npy, probabilities.npy, labels.npy, and stratum_bounds.npy
+    @return: output from run_permutation_batches, see there for other parameters
+    '''
+    return run_permutation_batches(np.load(os.path.join(array_dir, 'prv_codes.npy'), mmap_mode = 'r'),
+                                   np.load(os.path.join(array_dir, 'probabilities.npy'), mmap_mode = 'r'),
+                                   np.load(os.path.join(array_dir, 'labels.npy'), mmap_mode = 'r'),
+                                   np.load(os.path.join(array_dir, 'stratum_bounds.npy')),
+                                   observed_npi_stats,
+                                   observed_global_stat,
+                                   batch_seeds,
+                                   batch_sizes,
+                                   method)
+
+def run_npi_permutation_tests(npis,
+                              logits,
+                              labels,
+                              stratum_codes,
+                              num_permutations = 10000,
+                              method           = 'permutation',
+                              num_workers      = 1,
+                              batch_size       = 16,
+                              seed             = 0):
+    '''
+    Test whether each provider and providers as a whole differ from the model without random effects
+    by comparing score statistics to their distribution when provider labels are shuffled within strata
+    or when labels are drawn from the model without random effects
+    Does not rely on the chi-squared approximation, which is poor for providers with few patients
+    Shuffling assumes samples are exchangeable between providers within each stratum,
+    but the model without random effects also depends on covariates that are not in the strata,
+    so permutation p-values are only valid to the extent those covariates are balanced across providers within strata
+    @param npis: numpy array, npi of each sample
+    @param logits: numpy array, logits of model without random effects
+    @param labels: numpy array, 1 if metformin
+    @param stratum_codes: numpy array, stratum of each sample, output from compute_stratum_codes,
+                          only used for permutation
+    @param num_permutations: int, number of resampled data sets
+    @param method: str, permutation or bootstrap, see run_permutation_batches
+    @param num_workers: int, number of processes
+    @param batch_size: int, number of resampled data sets computed at once, memory is about 40 bytes x # samples x batch_size
+    @param seed: int, seed for random number generator, results are the same for any num_workers
+    @return: 1. pandas DataFrame with NPI, Score stat, and P-value columns, sorted by NPI
+             2. float, global score statistic
+             3. float, global p-value
+    '''
+    sample_order  = np.argsort(stratum_codes, kind = 'stable')
+    prv_codes, unique_npis = pd.factorize(np.asarray(npis)[sample_order], sort = True)
+    probabilities = expit(np.asarray(logits, dtype = np.float64)[sample_order])
+    labels        = np.asarray(labels, dtype = np.float64)[sample_order]
+    stratum_bounds = np.concatenate(([0], np.cumsum(np.bincount(np.asarray(stratum_codes)))))
+    observed_npi_stats, observed_global_stat = compute_npi_score_stats(prv_codes,
+                                                                       labels - probabilities,
+                                                                       probabilities * (1. - probabilities),
+                                                                       len(unique_npis))
+
+    batch_sizes = [batch_size] * (num_permutations // batch_size)
+    if num_permutations % batch_size > 0:
+        batch_sizes.append(num_permutations % batch_size)
+    batch_seeds = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+    if num_workers > 1:
+        worker_batch_idxs = [idxs for idxs in np.array_split(np.arange(len(batch_sizes)), num_workers * 4) if len(idxs) > 0]
+        with tempfile.TemporaryDirectory() as array_dir:
+            np.save(os.path.join(array_dir, 'prv_codes.npy'), prv_codes)
+            np.save(os.path.join(array_dir, 'probabilities.npy'), probabilities)
+            np.save(os.path.join(array_dir, 'labels.npy'), labels)
+            np.save(os.path.join(array_dir, 'stratum_bounds.npy'), stratum_bounds)
+            with ProcessPoolExecutor(max_workers = num_workers) as executor:
+                worker_results = list(executor.map(_run_permutation_batches_from_files,
+                                                   [array_dir for _ in worker_batch_idxs],
+                                                   [observed_npi_stats for _ in worker_batch_idxs],
+                                                   [observed_global_stat for _ in worker_batch_idxs],
+                                                   [[batch_seeds[idx] for idx in idxs] for idxs in worker_batch_idxs],
+                                                   [[batch_sizes[idx] for idx in idxs] for idxs in worker_batch_idxs],
+                                                   [method for _ in worker_batch_idxs]))
+        npi_counts   = np.sum([npi_counts for npi_counts, _ in worker_results], axis = 0)
+        global_count = sum([global_count for _, global_count in worker_results])
+    else:
+        npi_counts, global_count = run_permutation_batches(prv_codes,
+                                                           probabilities,
+                                                           labels,
+                                                           stratum_bounds,
+                                                           observed_npi_stats,
+                                                           observed_global_stat,
+                                                           batch_seeds,
+                                                           batch_sizes,
+                                                           method)
+
+    npi_pval_df = pd.DataFrame(data    = {'NPI'       : np.asarray(unique_npis),
+                                         'Score stat': observed_npi_stats,
+                                         'P-value'   : (npi_counts + 1.) / (num_permutations + 1.)},
+                               columns = ['NPI', 'Score stat', 'P-value'])
+    return npi_pval_df, observed_global_stat, (global_count + 1.) / (num_permutations + 1.)
+
+@instrumented
+def perform_glrts(num_permutations = 0,
+                  method           = 'permutation',
+                  strata_columns   = ('egfr',),
+                  num_workers      = 1,
+                  seed             = 0,
+                  qvalue_method    = 'bh'):
     '''
     Perform a GLRT for whether including provider-specific random effects results in better fit
     Then perform a GLRT for whether each provider differs from general policy
+    @param num_permutations: int, if positive, also compute p-values for each provider from this many resampled data sets,
+                             see run_npi_permutation_tests, written to Score stat and Permutation P-value
+                             or Bootstrap P-value next to the chi-squared G-stat and P-value,
+                             and the resampled p-values are corrected for testing every provider instead
+    @param method: str, permutation or bootstrap
+    @param strata_columns: list of str, cohort columns whose values provider labels are shuffled within,
+                           samples are only assumed exchangeable between providers within these strata,
+                           so the default eGFR bins do not account for age, sex, treatment date, or heart failure
+    @param num_workers: int, number of processes for resampling
+    @param seed: int, seed for random number generator
+    @param qvalue_method: str, bh, by, or storey, correction for testing every provider
+    @return: None
     '''
-    sample_df      = pd.read_csv(config.data_dir + 't2dm_cohort_data_frequent_prv_only.csv')
+    sample_df      = load_cohort_data()
     prediction_df  = pd.read_csv(config.output_dir + 'model_predictions.csv')
     num_params_df  = pd.read_csv(config.output_dir + 'glm_num_params.csv')
+    record_rows(len(sample_df))
     m1_model_name  = config.best_model_without_random_effects
     m2_model_name  = config.best_model_with_random_effects
     m1_num_params  = 12 # if family includes up to 4 knots per feature, note this is maximum # of params in family not # params in best model
@@ -48,14 +313,10 @@ def perform_glrts():
     print('Comparing ' + m1_model_name + ' from family with ' + str(m1_num_params) + ' parameters and '
           + m2_model_name + ' from family with ' + str(m2_num_params) + ' parameters')
     
-    m1_logits = prediction_df[m1_model_name]
-    m2_logits = prediction_df[m2_model_name]
-    
-    m1_probs = 1./(1. + np.exp(-1*m1_logits))
-    m2_probs = 1./(1. + np.exp(-1*m2_logits))
-    
-    m1_log_likelihood_per_sample = np.where(sample_df['metformin'] == 1, np.log(m1_probs), np.log(1 - m1_probs))
-    m2_log_likelihood_per_sample = np.where(sample_df['metformin'] == 1, np.log(m2_probs), np.log(1 - m2_probs))
+    m1_log_likelihood_per_sample = compute_log_likelihood_per_sample(prediction_df[m1_model_name].values,
+                                                                     sample_df['metformin'].values)
+    m2_log_likelihood_per_sample = compute_log_likelihood_per_sample(prediction_df[m2_model_name].values,
+                                                                     sample_df['metformin'].values)
     
     m1_log_likelihood = np.sum(m1_log_likelihood_per_sample)
     m2_log_likelihood = np.sum(m2_log_likelihood_per_sample)
@@ -67,29 +328,79 @@ def perform_glrts():
     pval = 1. - chi2.cdf(g_stat, df = m2_num_params - m1_num_params)
     print('P-value: ' + str(pval))
     
-    npis        = sample_df['npi'].values
-    unique_npis = np.unique(npis)
-    npi_gstats  = np.empty(len(unique_npis))
-    npi_pvals   = np.empty(len(unique_npis))
-    for i, npi in enumerate(unique_npis):
-        npi_idxs = np.argwhere(npis == npi).flatten()
-        npi_m1_log_likelihood_per_sample = m1_log_likelihood_per_sample[npi_idxs]
-        npi_m2_log_likelihood_per_sample = m2_log_likelihood_per_sample[npi_idxs]
-        npi_m1_log_likelihood = np.sum(npi_m1_log_likelihood_per_sample)
-        npi_m2_log_likelihood = np.sum(npi_m2_log_likelihood_per_sample)
-        g_stat = 2 * (npi_m2_log_likelihood - npi_m1_log_likelihood)
-        pval   = 1. - chi2.cdf(g_stat, df = m2_num_params - m1_num_params)
-        npi_gstats[i] = g_stat
-        npi_pvals[i]  = pval
-    
-    npi_pval_df = pd.DataFrame(data    = {'NPI'    : unique_npis,
-                                          'G-stat' : npi_gstats,
-                                          'P-value': npi_pvals},
-                               columns = ['NPI', 'G-stat', 'P-value'])
-    npi_pval_df = run_benjamini_hochberg(npi_pval_df, fdr = .10)
+    npi_pval_df = compute_npi_glrts(sample_df['npi'].values,
+                                    m1_log_likelihood_per_sample,
+                                    m2_log_likelihood_per_sample,
+                                    m2_num_params - m1_num_params)
+    if num_permutations > 0:
+        perm_pval_df, global_stat, global_pval \
+            = run_npi_permutation_tests(sample_df['npi'].values,
+                                        prediction_df[m1_model_name].values,
+                                        sample_df['metformin'].values,
+                                        compute_stratum_codes(sample_df, strata_columns),
+                                        num_permutations,
+                                        method,
+                                        num_workers,
+                                        seed = seed)
+        print('Global score statistic: ' + str(global_stat))
+        print(method.capitalize() + ' p-value from ' + str(num_permutations) + ' resamples: ' + str(global_pval))
+        pvalue_column = method.capitalize() + ' P-value'
+        npi_pval_df['Score stat']  = perm_pval_df['Score stat'].values
+        npi_pval_df[pvalue_column] = perm_pval_df['P-value'].values
+    else:
+        pvalue_column = 'P-value'
+    print('Correcting ' + pvalue_column + ' for testing ' + str(len(npi_pval_df)) + ' providers')
+    npi_pval_df = run_benjamini_hochberg(npi_pval_df,
+                                         fdr           = .10,
+                                         method        = qvalue_method,
+                                         pvalue_column = pvalue_column)
     npi_pval_df.to_csv(config.output_dir + 'npi_glrt_pvalues.csv',
                        index = False)
     
 if __name__ == '__main__':
     
-    perform_glrts()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description = 'Test for variation across providers.')
+    parser.add_argument('--num_permutations',
+                        action  = 'store',
+                        type    = int,
+                        default = 0,
+                        help    = 'Specify to also compute p-values for each provider from this many resampled data sets, '
+                                  + 'which are corrected for multiple testing instead of the chi-squared p-values.')
+    parser.add_argument('--method',
+                        action  = 'store',
+                        type    = str,
+                        default = 'permutation',
+                        help    = 'Specify permutation to shuffle provider labels within strata, '
+                                  + 'or bootstrap to draw treatments from the model without random effects.')
+    parser.add_argument('--strata',
+                        action  = 'store',
+                        type    = str,
+                        default = 'egfr',
+                        help    = 'Specify comma-separated cohort columns defining strata for permutations. '
+                                  + 'eGFR is split into the bins of Table 1. Samples are only assumed exchangeable '
+                                  + 'between providers within strata, so the default does not account for other covariates.')
+    parser.add_argument('--num_workers',
+                        action  = 'store',
+                        type    = int,
+                        default = 1,
+                        help    = 'Specify number of processes for resampling.')
+    parser.add_argument('--seed',
+                        action  = 'store',
+                        type    = int,
+                        default = 0,
+                        help    = 'Specify seed for random number generator.')
+    parser.add_argument('--qvalue_method',
+                        action  = 'store',
+                        type    = str,
+                        default = 'bh',
+                        help    = 'Specify bh for Benjamini-Hochberg, by for Benjamini-Yekutieli, '
+                                  + 'or storey for Storey q-values when correcting for testing every provider.')
+    args = parser.parse_args()
+
+    with instrument_stage('run_tests_for_provider_variation.py'):
+        perform_glrts(args.num_permutations,
+                      args.method,
+                      [col_name for col_name in args.strata.split(',') if col_name != ''],
+                      args.num_workers,
+                      args.seed,
+                      args.qvalue_method)
\ No newline at end of file